@@ -1,17 +1,39 @@
 import os
-from flask import Flask, redirect, url_for, render_template, request, flash, jsonify, send_file
+import threading
+import time
+from collections import OrderedDict
+from flask import Flask, redirect, url_for, render_template, request, flash, jsonify, send_file, stream_with_context, session
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, current_user, login_user, logout_user
-from datetime import datetime
+from datetime import datetime, timedelta
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin
+from sqlalchemy import event, tuple_
+from sqlalchemy.orm import joinedload, object_session, selectinload
+
+from config import Config
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'inventory-system-secret-key-2024'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///inventory.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///inventory.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['WTF_CSRF_ENABLED'] = False
 
+# config.py の設定値を取り込む
+for _key in ('ITEMS_PER_PAGE', 'HISTORY_PER_PAGE', 'CACHE_DEFAULT_TIMEOUT', 'HISTORY_COUNT_CACHE_TIMEOUT',
+             'WAREHOUSE_COMPLETED_PER_PAGE', 'WAREHOUSE_COMPLETED_DAYS',
+             'EXPORT_CHUNK_SIZE', 'IMPORT_CHUNK_SIZE',
+             'UPLOAD_FOLDER', 'JOB_WORKERS', 'JOB_STALE_TIMEOUT', 'JOB_RESULT_TTL', 'JOB_CLEANUP_INTERVAL',
+             'IMPORT_PREVIEW_TIMEOUT',
+             'QR_WORKERS', 'QR_CACHE_SIZE', 'QR_BATCH_LIMIT',
+             'QR_DISK_CACHE_TTL', 'QR_DISK_CACHE_MAX_FILES', 'QR_DISK_CACHE_PRUNE_INTERVAL',
+             'EVENT_REDIS_URL', 'SSE_HEARTBEAT', 'SSE_STREAM_TIMEOUT', 'SSE_MAX_STREAMS',
+             'IDEMPOTENCY_KEY_TTL', 'IDEMPOTENCY_PURGE_INTERVAL',
+             'SYNC_PAGE_SIZE', 'SYNC_SAFETY_LAG',
+             'HISTORY_ROLLUP_INTERVAL', 'HISTORY_ROLLUP_BATCH_SIZE', 'HISTORY_ROLLUP_GAP_TIMEOUT',
+             'MAIL_SERVER', 'MAIL_PORT', 'MAIL_USE_TLS', 'MAIL_USERNAME', 'MAIL_PASSWORD', 'MAIL_DEFAULT_SENDER'):
+    app.config[_key] = getattr(Config, _key)
+
 db = SQLAlchemy(app)
 login_manager = LoginManager()
 login_manager.init_app(app)
@@ -35,17 +57,31 @@ class ItemGroup(db.Model):
     name = db.Column(db.String(100), nullable=False, unique=True)
     display_order = db.Column(db.Integer, nullable=False, default=0)
     created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
 
 class Stock(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    product_name = db.Column(db.String(100), nullable=False)
-    quantity = db.Column(db.Integer, nullable=False, default=0)
-    supplier = db.Column(db.String(100))
-    group_id = db.Column(db.Integer, db.ForeignKey('item_group.id'))
+    product_name = db.Column(db.String(100), nullable=False, index=True)
+    quantity = db.Column(db.Integer, nullable=False, default=0, index=True)
+    # 未完了の出庫予定で引き当て済みの数量（出荷可能数 = quantity - reserved_quantity）
+    reserved_quantity = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # この数量以下になったら在庫不足として通知する（未設定なら在庫ゼロのみ通知）
+    min_stock = db.Column(db.Integer)
+    supplier = db.Column(db.String(100), index=True)
+    group_id = db.Column(db.Integer, db.ForeignKey('item_group.id'), index=True)
     created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
-    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
     deleted_at = db.Column(db.DateTime)
     group = db.relationship('ItemGroup', backref='stocks')
+    
+    @property
+    def available_quantity(self):
+        return self.quantity - (self.reserved_quantity or 0)
+    
+    # 差分同期のキーセット（updated_at, id）
+    __table_args__ = (
+        db.Index('ix_stock_updated_at_id', 'updated_at', 'id'),
+    )
 
 class StockHistory(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -58,6 +94,33 @@ class StockHistory(db.Model):
     created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     stock = db.relationship('Stock', backref='history')
     user = db.relationship('User', backref='operations')
+    
+    __table_args__ = (
+        db.Index('ix_stock_history_created_at_id', 'created_at', 'id'),
+    )
+
+class HistoryDaily(db.Model):
+    # 入出庫履歴の日次集計（UTC の日付・在庫・種別ごと）。refresh_history_rollup で追加分だけ反映する
+    day = db.Column(db.Date, primary_key=True)
+    stock_id = db.Column(db.Integer, db.ForeignKey('stock.id'), primary_key=True)
+    transaction_type = db.Column(db.String(20), primary_key=True)
+    group_id = db.Column(db.Integer, db.ForeignKey('item_group.id'))
+    record_count = db.Column(db.Integer, nullable=False, default=0)
+    quantity = db.Column(db.Integer, nullable=False, default=0)  # quantity_change の合計（出庫は負）
+    
+    __table_args__ = (
+        db.Index('ix_history_daily_group_id_day', 'group_id', 'day'),
+    )
+
+class RollupWatermark(db.Model):
+    # 集計済みの最後の履歴ID
+    name = db.Column(db.String(50), primary_key=True)
+    last_id = db.Column(db.Integer, nullable=False, default=0)
+
+class HistoryRollupGap(db.Model):
+    # 集計済みの範囲で集計時に見えなかった履歴ID（コミット待ち）。コミットされた後の集計で反映する
+    history_id = db.Column(db.Integer, primary_key=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
 
 class OutboundOrder(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -68,7 +131,468 @@ class OutboundOrder(db.Model):
     created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     warehouse_confirmed_at = db.Column(db.DateTime)
     completed_at = db.Column(db.DateTime)
+    shipment_id = db.Column(db.String(32), index=True)
+    # 引当方式で登録した出庫予定は True（NULL は登録時に在庫を減算済みの旧方式の予定）
+    reserved = db.Column(db.Boolean)
     stock = db.relationship('Stock', backref='outbound_orders')
+    
+    # 倉庫確認画面の各列（状態ごとに日時順）をインデックスだけで取り出す
+    __table_args__ = (
+        db.Index('ix_outbound_order_status_created_at', 'status', 'created_at'),
+        db.Index('ix_outbound_order_status_warehouse_confirmed_at', 'status', 'warehouse_confirmed_at'),
+        db.Index('ix_outbound_order_status_completed_at', 'status', 'completed_at'),
+    )
+
+class StockAlert(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    stock_id = db.Column(db.Integer, db.ForeignKey('stock.id'), nullable=False)
+    alert_type = db.Column(db.String(10), nullable=False)  # low / zero
+    quantity = db.Column(db.Integer, nullable=False)
+    threshold = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+    notified_at = db.Column(db.DateTime, index=True)  # 通知した日時（未通知のアラートは flask check-low-stock で通知する）
+    stock = db.relationship('Stock')
+
+class Notification(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    title = db.Column(db.String(200), nullable=False)
+    message = db.Column(db.Text, nullable=False)
+    type = db.Column(db.String(20), nullable=False, default='info')  # info / warning / error / success
+    link = db.Column(db.String(255))
+    is_read = db.Column(db.Boolean, nullable=False, default=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    
+    # 同じ通知をまとめる判定（ユーザー・タイトル・直近の期間）をインデックスで行う
+    __table_args__ = (
+        db.Index('ix_notification_user_id_title_created_at', 'user_id', 'title', 'created_at'),
+    )
+
+class MailOutbox(db.Model):
+    # 送信待ちメール。send_email は登録だけを行い、送信はバックグラウンドの送信スレッド（utils/notifications.py）が行う
+    id = db.Column(db.Integer, primary_key=True)
+    recipients = db.Column(db.Text, nullable=False)  # カンマ区切り
+    subject = db.Column(db.String(255), nullable=False)
+    body = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='pending')  # pending / sending / sent / failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime)
+    
+    __table_args__ = (
+        db.Index('ix_mail_outbox_status_next_attempt_at', 'status', 'next_attempt_at'),
+    )
+
+class IdempotencyKey(db.Model):
+    # 利用者・エンドポイント・クライアント指定のキーをまとめた SHA-256（主キーで1回の検索）
+    key = db.Column(db.String(64), primary_key=True)
+    response = db.Column(db.Text)  # 最初の結果（処理中は NULL）
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+class CacheGeneration(db.Model):
+    # ワーカー間で共有するキャッシュの世代。データの更新のコミット後に進める
+    namespace = db.Column(db.String(50), primary_key=True)
+    generation = db.Column(db.Integer, nullable=False, default=0)
+
+class Job(db.Model):
+    id = db.Column(db.String(32), primary_key=True)
+    job_type = db.Column(db.String(20), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='queued')
+    params = db.Column(db.Text, nullable=False, default='{}')
+    progress = db.Column(db.Integer, nullable=False, default=0)
+    total = db.Column(db.Integer)
+    message = db.Column(db.Text)
+    result_path = db.Column(db.String(255))
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    heartbeat_at = db.Column(db.DateTime)  # 実行中のプロセスが最後に進捗を記録した日時
+
+# ========== 簡易キャッシュ ==========
+
+# キーは (名前空間, ...) のタプル。プロセス内のみで共有される。
+# 他のワーカーの更新も反映する必要があるものは、DB の世代（cache_generation）をキーに含める。
+_cache = {}
+_cache_lock = threading.Lock()
+
+def cache_get(key):
+    with _cache_lock:
+        entry = _cache.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at < time.monotonic():
+            del _cache[key]
+            return None
+        return value
+
+def cache_set(key, value, timeout=None):
+    if timeout is None:
+        timeout = app.config['CACHE_DEFAULT_TIMEOUT']
+    with _cache_lock:
+        _cache[key] = (value, time.monotonic() + timeout)
+
+def cache_clear(namespace):
+    """キーの先頭要素が namespace のエントリをすべて破棄する"""
+    with _cache_lock:
+        for key in [k for k in _cache if k[0] == namespace]:
+            del _cache[key]
+
+def cache_generation(namespace):
+    """namespace の現在の世代（全ワーカーで共通）"""
+    return db.session.scalar(
+        db.select(CacheGeneration.generation).where(CacheGeneration.namespace == namespace)
+    ) or 0
+
+def bump_cache_generation(namespace, connection=None):
+    """namespace の世代を進める（コミットされると全ワーカーで古いキャッシュが使われなくなる）"""
+    connection = connection or db.session
+    updated = connection.execute(
+        db.update(CacheGeneration).where(CacheGeneration.namespace == namespace)
+        .values(generation=CacheGeneration.generation + 1)
+    ).rowcount
+    if not updated:
+        connection.execute(db.insert(CacheGeneration).values(namespace=namespace, generation=1))
+
+# ========== 検索インデックス ==========
+# SQLite: trigram トークナイザの FTS5 外部コンテンツテーブルをトリガーで stock と同期する
+# PostgreSQL: pg_trgm の GIN インデックスで ilike の部分一致検索を高速化する
+
+SQLITE_SEARCH_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS stock_search USING fts5(
+        product_name, supplier, content='stock', content_rowid='id', tokenize='trigram')""",
+    """CREATE TRIGGER IF NOT EXISTS stock_search_ai AFTER INSERT ON stock BEGIN
+        INSERT INTO stock_search(rowid, product_name, supplier) VALUES (new.id, new.product_name, new.supplier);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS stock_search_ad AFTER DELETE ON stock BEGIN
+        INSERT INTO stock_search(stock_search, rowid, product_name, supplier) VALUES ('delete', old.id, old.product_name, old.supplier);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS stock_search_au AFTER UPDATE OF product_name, supplier ON stock BEGIN
+        INSERT INTO stock_search(stock_search, rowid, product_name, supplier) VALUES ('delete', old.id, old.product_name, old.supplier);
+        INSERT INTO stock_search(rowid, product_name, supplier) VALUES (new.id, new.product_name, new.supplier);
+    END""",
+]
+
+POSTGRES_SEARCH_DDL = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS ix_stock_product_name_trgm ON stock USING gin (product_name gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_stock_supplier_trgm ON stock USING gin (supplier gin_trgm_ops)",
+]
+
+# trigram は3文字未満の語を索引できないため、それより短い語は ilike で検索する
+SEARCH_MIN_LENGTH = 3
+
+_search_index_ready = None
+
+def create_search_index():
+    """検索インデックスを作成する（作成済みなら何もしない）"""
+    global _search_index_ready
+    dialect = db.engine.dialect.name
+    try:
+        if dialect == 'sqlite':
+            exists = db.session.execute(db.text(
+                "SELECT 1 FROM sqlite_master WHERE name = 'stock_search'"
+            )).scalar()
+            for ddl in SQLITE_SEARCH_DDL:
+                db.session.execute(db.text(ddl))
+            if not exists:
+                db.session.execute(db.text("INSERT INTO stock_search(stock_search) VALUES ('rebuild')"))
+        elif dialect == 'postgresql':
+            for ddl in POSTGRES_SEARCH_DDL:
+                db.session.execute(db.text(ddl))
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        app.logger.warning(f'検索インデックスを作成できませんでした: {e}')
+    _search_index_ready = None
+
+def search_index_ready():
+    global _search_index_ready
+    if _search_index_ready is None:
+        if db.engine.dialect.name == 'sqlite':
+            _search_index_ready = bool(db.session.execute(db.text(
+                "SELECT 1 FROM sqlite_master WHERE name = 'stock_search'"
+            )).scalar())
+        else:
+            _search_index_ready = db.engine.dialect.name == 'postgresql'
+    return _search_index_ready
+
+def apply_stock_search(query, column_name, term):
+    """Stock の部分一致検索を検索インデックス経由で query に適用する
+    
+    Returns:
+        (query, rank): rank は関連度順に並べるための式（昇順で関連度が高い）
+    """
+    column = getattr(Stock, column_name)
+    if len(term) < SEARCH_MIN_LENGTH or not search_index_ready():
+        return query.filter(column.ilike(f'%{term}%')), None
+    
+    if db.engine.dialect.name == 'postgresql':
+        return query.filter(column.ilike(f'%{term}%')), -db.func.similarity(column, term)
+    
+    phrase = '"' + term.replace('"', '""') + '"'
+    match = db.select(
+        db.literal_column('rowid').label('stock_id'),
+        db.literal_column('bm25(stock_search)').label('rank')
+    ).select_from(db.text('stock_search')).where(
+        db.text('stock_search MATCH :match').bindparams(match=f'{column_name} : {phrase}')
+    ).subquery()
+    return query.join(match, match.c.stock_id == Stock.id), match.c.rank
+
+# ========== 在庫数の更新 ==========
+# 読み出してから書き戻すと同時実行で在庫がずれるため、在庫数は条件付きUPDATEで原子的に増減する
+# 出庫予定は reserved_quantity で引き当て、倉庫での出庫完了時に quantity と合わせて減算する
+
+def adjust_stock_quantity(stock_id, delta=0, reserved_delta=0):
+    """在庫数を delta、引当数を reserved_delta だけ増減する（在庫が足りない場合は更新せず False）
+    
+    出荷可能数（quantity - reserved_quantity）が減る更新は、減った後も 0 以上であることを
+    WHERE 句で判定する。条件付きUPDATEは行ロックを取って判定と更新を1文で行うため、
+    PostgreSQL・SQLite のどちらでも引当が在庫を超えることはない
+    
+        入庫: adjust_stock_quantity(id, n)
+        引当: adjust_stock_quantity(id, reserved_delta=n)
+        引当解除: adjust_stock_quantity(id, reserved_delta=-n)
+        出庫完了: adjust_stock_quantity(id, -n, -n)
+    """
+    statement = db.update(Stock).where(Stock.id == stock_id).values(
+        quantity=Stock.quantity + delta,
+        reserved_quantity=Stock.reserved_quantity + reserved_delta,
+        updated_at=datetime.utcnow()
+    )
+    if delta - reserved_delta < 0:
+        statement = statement.where(
+            Stock.quantity - Stock.reserved_quantity >= reserved_delta - delta, Stock.deleted_at.is_(None)
+        )
+    if delta < 0:
+        statement = statement.where(Stock.quantity >= -delta)
+    if reserved_delta < 0:
+        statement = statement.where(Stock.reserved_quantity >= -reserved_delta)
+    
+    row = db.session.execute(
+        statement.returning(Stock.quantity, Stock.min_stock).execution_options(synchronize_session=False)
+    ).first()
+    if row is None:
+        return False
+    
+    if delta:
+        # 一括UPDATEはフラッシュを経由しないため、グループ集計のキャッシュ破棄を明示する
+        # （引当数だけの変更はグループ集計に影響しない）
+        db.session.info['group_summary_dirty'] = True
+        record_stock_change(stock_id, row.quantity - delta, row.quantity, row.min_stock)
+    return True
+
+# ========== 在庫しきい値アラート ==========
+# 在庫数・最小在庫数が変わるたびに変更前後の値だけでしきい値の通過を判定し、
+# 通知の登録はコミット後にバックグラウンドのスレッドで行う（リクエストは待たない）
+
+def stock_threshold_crossing(old_quantity, new_quantity, min_stock):
+    """在庫数の変化で下回ったしきい値（'zero' / 'low'、下回っていなければ None）"""
+    if old_quantity > 0 >= new_quantity:
+        return 'zero'
+    if min_stock is not None and old_quantity > min_stock >= new_quantity:
+        return 'low'
+    return None
+
+def record_stock_change(stock_id, old_quantity, new_quantity, min_stock, session=None):
+    """在庫数の変更を記録し、しきい値を下回った場合はコミット後に通知を登録する"""
+    alert_type = stock_threshold_crossing(old_quantity, new_quantity, min_stock)
+    if alert_type:
+        queue_stock_alert(session or db.session, stock_id, alert_type, new_quantity, 0 if alert_type == 'zero' else min_stock)
+
+def queue_stock_alert(session, stock_id, alert_type, quantity, threshold):
+    """コミット後に登録するしきい値アラートを追加する"""
+    session.info.setdefault('stock_alerts', []).append({
+        'stock_id': stock_id,
+        'alert_type': alert_type,
+        'quantity': quantity,
+        'threshold': threshold
+    })
+
+@event.listens_for(Stock.quantity, 'set', active_history=True)
+def track_stock_quantity(stock, value, oldvalue, initiator):
+    """ORM での在庫数の変更（在庫編集など）"""
+    session = object_session(stock)
+    if session is not None and stock.id is not None and isinstance(oldvalue, int) and value != oldvalue:
+        record_stock_change(stock.id, oldvalue, value, stock.min_stock, session)
+
+@event.listens_for(Stock.min_stock, 'set', active_history=True)
+def track_stock_min_stock(stock, value, oldvalue, initiator):
+    """ORM での最小在庫数の変更（現在の在庫数以上に上げた場合も在庫不足として通知する）"""
+    session = object_session(stock)
+    if session is None or stock.id is None or value is None or value == oldvalue or not isinstance(stock.quantity, int):
+        return
+    # 変更前は最小在庫数を上回っていて（または未設定で）、変更後は下回っている
+    if (oldvalue is None or isinstance(oldvalue, int) and stock.quantity > oldvalue) and stock.quantity <= value:
+        queue_stock_alert(session, stock.id, 'low', stock.quantity, value)
+
+_stock_alert_executor = None
+_stock_alert_executor_lock = threading.Lock()
+
+def get_stock_alert_executor():
+    global _stock_alert_executor
+    with _stock_alert_executor_lock:
+        if _stock_alert_executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            _stock_alert_executor = ThreadPoolExecutor(max_workers=1)
+        return _stock_alert_executor
+
+def insert_stock_alerts(alerts, notified_at=None):
+    """しきい値アラートを一括登録する（コミットは呼び出し側）"""
+    now = datetime.utcnow()
+    db.session.execute(db.insert(StockAlert), [dict(alert, created_at=now, notified_at=notified_at) for alert in alerts])
+
+def save_stock_alerts(alerts):
+    """しきい値アラートを一括登録し、通知と送信待ちメールを同じトランザクションで登録する
+    （バックグラウンドのスレッドで実行）
+    
+    通知の登録に失敗した場合はアラートを未通知のまま登録し、定期実行（flask check-low-stock）で通知する
+    """
+    from utils.notifications import get_low_stocks, notify_low_stock_digest, wake_mail_sender
+    
+    with app.app_context():
+        try:
+            # 登録までの間に在庫が戻った（または削除された）商品は通知しない
+            stocks = get_low_stocks({alert['stock_id'] for alert in alerts})
+            if stocks:
+                notify_low_stock_digest(stocks, commit=False)
+            insert_stock_alerts(alerts, notified_at=datetime.utcnow())
+            db.session.commit()
+            if stocks:
+                wake_mail_sender()
+        except Exception as e:
+            db.session.rollback()
+            app.logger.warning(f'在庫アラートを通知できませんでした: {e}')
+            try:
+                insert_stock_alerts(alerts)
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                app.logger.warning(f'在庫アラートを登録できませんでした: {e}')
+        finally:
+            db.session.remove()
+
+@event.listens_for(db.session, 'after_commit')
+def dispatch_stock_alerts(session):
+    alerts = session.info.pop('stock_alerts', None)
+    if alerts:
+        get_stock_alert_executor().submit(save_stock_alerts, alerts)
+
+@event.listens_for(db.session, 'after_rollback')
+def discard_stock_alerts(session):
+    session.info.pop('stock_alerts', None)
+
+# ========== 冪等キー ==========
+# 通信が不安定な端末が POST を再送しても入出庫が二重に登録されないよう、
+# 同じ冪等キーの2回目以降のリクエストには処理をせず最初の結果を返す
+
+def new_idempotency_key():
+    """フォームに埋め込む冪等キー（画面を開くたびに発行）"""
+    import uuid
+    
+    return uuid.uuid4().hex
+
+def idempotency_key_hash(client_key):
+    import hashlib
+    
+    return hashlib.sha256(f'{current_user.id}:{request.endpoint}:{client_key}'.encode()).hexdigest()
+
+def purge_expired_idempotency_keys(now):
+    """期限切れのキーを削除する（プロセスごとに一定間隔で1回）"""
+    cache_key = ('idempotency_purge',)
+    if cache_get(cache_key) is None:
+        db.session.execute(db.delete(IdempotencyKey).where(IdempotencyKey.expires_at < now))
+        cache_set(cache_key, True, app.config['IDEMPOTENCY_PURGE_INTERVAL'])
+
+def serialize_idempotent_response(response, flashes):
+    """保存する結果（リダイレクトと JSON のみ。フォームの再表示やサーバーエラーは保存しない）"""
+    import json
+    
+    if response.status_code >= 500:
+        return None
+    if response.status_code in (301, 302, 303):
+        return json.dumps({'location': response.location, 'flashes': flashes}, ensure_ascii=False)
+    if response.is_json:
+        return json.dumps({'status': response.status_code, 'body': response.get_data(as_text=True)}, ensure_ascii=False)
+    return None
+
+def replay_idempotent_response(stored):
+    import json
+    
+    data = json.loads(stored)
+    if 'location' in data:
+        for category, message in data['flashes']:
+            flash(message, category)
+        response = redirect(data['location'])
+    else:
+        response = app.response_class(data['body'], status=data['status'], mimetype='application/json')
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+def idempotent(view):
+    """Idempotency-Key ヘッダー（フォームでは idempotency_key）付きの POST を1回だけ処理する"""
+    from functools import wraps
+    from sqlalchemy.exc import IntegrityError
+    
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        client_key = request.headers.get('Idempotency-Key') or request.form.get('idempotency_key')
+        if request.method != 'POST' or not client_key or not current_user.is_authenticated:
+            return view(*args, **kwargs)
+        
+        key = idempotency_key_hash(client_key)
+        now = datetime.utcnow()
+        row = db.session.get(IdempotencyKey, key)
+        if row is not None and row.expires_at < now:
+            db.session.delete(row)
+            db.session.commit()
+            row = None
+        
+        if row is None:
+            # 処理の前にキーを確保してコミットする（同時に届いた再送は一意制約で弾かれる）
+            try:
+                purge_expired_idempotency_keys(now)
+                db.session.add(IdempotencyKey(key=key, expires_at=now + timedelta(seconds=app.config['IDEMPOTENCY_KEY_TTL'])))
+                db.session.commit()
+            except IntegrityError:
+                db.session.rollback()
+                row = db.session.get(IdempotencyKey, key)
+                if row is None:
+                    return idempotency_conflict()
+        
+        if row is not None:
+            if row.response is None:
+                return idempotency_conflict()
+            return replay_idempotent_response(row.response)
+        
+        flash_count = len(session.get('_flashes', []))
+        try:
+            response = app.make_response(view(*args, **kwargs))
+        except Exception:
+            db.session.rollback()
+            db.session.execute(db.delete(IdempotencyKey).where(IdempotencyKey.key == key))
+            db.session.commit()
+            raise
+        
+        stored = serialize_idempotent_response(response, session.get('_flashes', [])[flash_count:])
+        if stored is None:
+            # 何も登録されていない結果は保存せず、同じキーで再実行できるようにする
+            db.session.execute(db.delete(IdempotencyKey).where(IdempotencyKey.key == key))
+        else:
+            db.session.execute(db.update(IdempotencyKey).where(IdempotencyKey.key == key).values(response=stored))
+        db.session.commit()
+        return response
+    
+    return wrapper
+
+def idempotency_conflict():
+    if request.is_json:
+        return jsonify({'success': False, 'message': '同じリクエストを処理中です'}), 409
+    flash('同じ操作を処理中です。しばらくしてから結果を確認してください', 'error')
+    return redirect(request.path)
 
 @login_manager.user_loader
 def load_user(user_id):
@@ -118,8 +642,33 @@ def dashboard():
     total_items = Stock.query.filter(Stock.deleted_at.is_(None)).count()
     total_quantity = db.session.query(func.sum(Stock.quantity)).filter(Stock.deleted_at.is_(None)).scalar() or 0
     total_groups = ItemGroup.query.count()
+    stock_alerts = StockAlert.query.options(joinedload(StockAlert.stock)).order_by(StockAlert.created_at.desc()).limit(10).all()
+    
+    # 入出庫の実績は日次集計から読む（集計はバックグラウンドのスレッドで行い、ここでは書き込まない）
+    start_history_rollup()
+    today = datetime.utcnow().date()
+    today_totals = history_totals(today)
+    week_totals = history_totals(today - timedelta(days=6), by_group=True)
+    group_names = dict(db.session.execute(db.select(ItemGroup.id, ItemGroup.name)).all())
+    weekly_groups = []
+    for group_id in sorted({group_id for group_id, _ in week_totals}, key=lambda group_id: group_names.get(group_id, '')):
+        weekly_groups.append({
+            'name': group_names.get(group_id, '-'),
+            'inbound': week_totals.get((group_id, 'inbound'), (0, 0))[1],
+            'outbound': -week_totals.get((group_id, 'outbound'), (0, 0))[1],
+            'adjustment': week_totals.get((group_id, 'adjustment'), (0, 0))[1],
+        })
     
-    return render_template('dashboard/index.html', total_items=total_items, total_quantity=total_quantity, total_groups=total_groups)
+    return render_template('dashboard/index.html', total_items=total_items, total_quantity=total_quantity, total_groups=total_groups, stock_alerts=stock_alerts,
+                         today_inbound=today_totals.get('inbound', (0, 0)), today_outbound=today_totals.get('outbound', (0, 0)),
+                         weekly_groups=weekly_groups)
+
+INVENTORY_SORT_COLUMNS = {
+    'name': Stock.product_name,
+    'quantity': Stock.quantity,
+    'supplier': Stock.supplier,
+    'updated_at': Stock.updated_at,
+}
 
 @app.route('/inventory')
 def inventory_list():
@@ -129,16 +678,38 @@ def inventory_list():
     search = request.args.get('search', '').strip()
     group_filter = request.args.get('group', type=int)
     supplier_filter = request.args.get('supplier', '').strip()
+    page = request.args.get('page', 1, type=int)
+    # 検索語があり並び順の指定がなければ関連度順
+    sort_by = request.args.get('sort', 'relevance' if search else 'name')
+    sort_order = request.args.get('order', 'asc')
+    if sort_by not in INVENTORY_SORT_COLUMNS and sort_by != 'relevance':
+        sort_by = 'name'
+    if sort_order not in ('asc', 'desc'):
+        sort_order = 'asc'
     
     query = Stock.query.filter(Stock.deleted_at.is_(None))
+    rank = None
     if search:
-        query = query.filter(Stock.product_name.ilike(f'%{search}%'))
+        query, rank = apply_stock_search(query, 'product_name', search)
     if group_filter:
         query = query.filter(Stock.group_id == group_filter)
     if supplier_filter:
-        query = query.filter(Stock.supplier.ilike(f'%{supplier_filter}%'))
+        query, _ = apply_stock_search(query, 'supplier', supplier_filter)
     
-    stocks = query.all()
+    if sort_by == 'relevance':
+        if rank is not None:
+            query = query.order_by(rank.asc(), Stock.id.asc())
+        else:
+            query = query.order_by(Stock.product_name.asc(), Stock.id.asc())
+    elif sort_order == 'asc':
+        query = query.order_by(INVENTORY_SORT_COLUMNS[sort_by].asc(), Stock.id.asc())
+    else:
+        query = query.order_by(INVENTORY_SORT_COLUMNS[sort_by].desc(), Stock.id.desc())
+    
+    pagination = query.options(selectinload(Stock.group)).paginate(
+        page=page, per_page=app.config['ITEMS_PER_PAGE'], error_out=False
+    )
+    stocks = pagination.items
     groups = ItemGroup.query.all()
     
     # 仕入先の一覧を取得（ユニーク）
@@ -148,7 +719,7 @@ def inventory_list():
     ).distinct().order_by(Stock.supplier.asc()).all()
     suppliers = [s[0] for s in suppliers]
     
-    return render_template('inventory/index.html', stocks=stocks, groups=groups, suppliers=suppliers, search=search, group_filter=group_filter, supplier_filter=supplier_filter)
+    return render_template('inventory/index.html', stocks=stocks, pagination=pagination, groups=groups, suppliers=suppliers, search=search, group_filter=group_filter, supplier_filter=supplier_filter, sort_by=sort_by, sort_order=sort_order)
 
 @app.route('/inventory/<int:stock_id>/edit', methods=['GET', 'POST'])
 def inventory_edit(stock_id):
@@ -158,18 +729,26 @@ def inventory_edit(stock_id):
     stock = Stock.query.get_or_404(stock_id)
     
     if request.method == 'POST':
+        # 保存までの間に引当数が増えないよう行をロックして読み直す
+        db.session.refresh(stock, with_for_update=True)
         product_name = request.form.get('product_name', '').strip()
         quantity = request.form.get('quantity', type=int)
         group_id = request.form.get('group_id', type=int)
         supplier = request.form.get('supplier', '').strip()
+        min_stock = request.form.get('min_stock', type=int)
         
         if not product_name:
             flash('商品名を入力してください', 'error')
         elif quantity is None or quantity < 0:
             flash('数量を正しく入力してください', 'error')
+        elif quantity < stock.reserved_quantity:
+            flash(f'出庫予定に引き当て済みの数量（{stock.reserved_quantity}個）より少なくできません', 'error')
+        elif min_stock is not None and min_stock < 0:
+            flash('最小在庫数を正しく入力してください', 'error')
         else:
             try:
                 stock.product_name = product_name
+                stock.min_stock = min_stock
                 stock.quantity = quantity
                 stock.group_id = group_id
                 stock.supplier = supplier
@@ -207,6 +786,7 @@ def inbound_index():
     return render_template('inbound/index.html')
 
 @app.route('/inbound/new', methods=['GET', 'POST'])
+@idempotent
 def inbound_new():
     if not current_user.is_authenticated:
         return redirect(url_for('login_page'))
@@ -235,9 +815,8 @@ def inbound_new():
                 existing_stock = Stock.query.filter_by(group_id=group_id, product_name=product_name).filter(Stock.deleted_at.is_(None)).first()
                 
                 if existing_stock:
-                    existing_stock.quantity += quantity
+                    adjust_stock_quantity(existing_stock.id, quantity)
                     existing_stock.supplier = supplier
-                    existing_stock.updated_at = datetime.utcnow()
                 else:
                     stock = Stock(product_name=product_name, quantity=quantity, group_id=group_id, supplier=supplier)
                     db.session.add(stock)
@@ -255,7 +834,7 @@ def inbound_new():
                 flash(f'エラー: {str(e)}', 'error')
     
     groups = ItemGroup.query.order_by(ItemGroup.display_order.asc(), ItemGroup.created_at.desc()).all()
-    return render_template('inbound/new.html', groups=groups)
+    return render_template('inbound/new.html', groups=groups, idempotency_key=new_idempotency_key())
 
 @app.route('/inbound/api/stocks/<group_id>')
 def inbound_get_stocks(group_id):
@@ -274,6 +853,7 @@ def outbound_index():
     return render_template('outbound/index.html', pending_orders=pending_orders)
 
 @app.route('/outbound/new', methods=['GET', 'POST'])
+@idempotent
 def outbound_new():
     if not current_user.is_authenticated:
         return redirect(url_for('login_page'))
@@ -294,21 +874,17 @@ def outbound_new():
             flash('出荷先を入力してください', 'error')
         else:
             try:
+                # 在庫は倉庫で出庫完了になるまで減らさず、出荷可能数から引き当てる
                 stock = Stock.query.get(stock_id)
-                if not stock or stock.quantity < quantity:
+                if not stock or not adjust_stock_quantity(stock_id, reserved_delta=quantity):
+                    db.session.rollback()
                     flash('在庫が不足しています', 'error')
                     return redirect(url_for('outbound_new'))
                 
-                order = OutboundOrder(stock_id=stock_id, quantity=quantity, destination=destination, status='pending')
+                order = OutboundOrder(stock_id=stock_id, quantity=quantity, destination=destination, status='pending', reserved=True)
                 db.session.add(order)
-                db.session.flush()
-                
-                stock.quantity -= quantity
-                stock.updated_at = datetime.utcnow()
-                
-                history = StockHistory(stock_id=stock_id, quantity_change=-quantity, transaction_type='outbound', reference_id=order.id, notes=f'出庫: {destination}', user_id=current_user.id)
-                db.session.add(history)
                 db.session.commit()
+                publish_order_event('updated', [order.id])
                 
                 flash(f'{stock.product_name} を {quantity}個 出庫予定にしました', 'success')
                 return redirect(url_for('outbound_index'))
@@ -317,14 +893,14 @@ def outbound_new():
                 flash(f'エラー: {str(e)}', 'error')
     
     groups = ItemGroup.query.order_by(ItemGroup.display_order.asc(), ItemGroup.created_at.desc()).all()
-    return render_template('outbound/new.html', groups=groups)
+    return render_template('outbound/new.html', groups=groups, idempotency_key=new_idempotency_key())
 
 @app.route('/outbound/api/stocks/<group_id>')
 def outbound_get_stocks(group_id):
     try:
         group_id = int(group_id)
-        stocks = Stock.query.filter(Stock.group_id == group_id, Stock.deleted_at.is_(None), Stock.quantity > 0).all()
-        return jsonify([{'id': s.id, 'product_name': s.product_name, 'quantity': s.quantity} for s in stocks])
+        stocks = Stock.query.filter(Stock.group_id == group_id, Stock.deleted_at.is_(None), Stock.quantity - Stock.reserved_quantity > 0).all()
+        return jsonify([{'id': s.id, 'product_name': s.product_name, 'quantity': s.available_quantity} for s in stocks])
     except:
         return jsonify([])
 
@@ -339,12 +915,24 @@ def outbound_cancel(order_id):
             flash('キャンセルできません', 'error')
             return redirect(url_for('outbound_index'))
         
-        stock = Stock.query.get(order.stock_id)
-        stock.quantity += order.quantity
-        stock.updated_at = datetime.utcnow()
+        # 同時に確認・キャンセルされた場合に二重で在庫を戻さないよう、状態を条件に削除する
+        stock_id, quantity, reserved = order.stock_id, order.quantity, order.reserved
+        deleted = db.session.execute(
+            db.delete(OutboundOrder).where(
+                OutboundOrder.id == order_id, OutboundOrder.status == 'pending'
+            ).execution_options(synchronize_session=False)
+        ).rowcount
+        if deleted != 1:
+            db.session.rollback()
+            flash('キャンセルできません', 'error')
+            return redirect(url_for('outbound_index'))
         
-        db.session.delete(order)
+        if reserved:
+            adjust_stock_quantity(stock_id, reserved_delta=-quantity)
+        else:
+            adjust_stock_quantity(stock_id, quantity)
         db.session.commit()
+        publish_order_event('removed', [order_id])
         
         flash('出庫予定をキャンセルしました', 'success')
     except Exception as e:
@@ -353,16 +941,133 @@ def outbound_cancel(order_id):
     
     return redirect(url_for('outbound_index'))
 
+@app.route('/outbound/api/batch', methods=['POST'])
+@idempotent
+def outbound_batch():
+    """複数明細の出庫を1トランザクションで登録する（全明細成功か、すべて取り消し）
+    
+    JSON: {"destination": "出荷先", "lines": [{"stock_id": 1, "quantity": 3}, ...]}
+    """
+    if not current_user.is_authenticated:
+        return jsonify({'success': False, 'message': 'ログインしてください'}), 401
+    
+    data = request.get_json(silent=True) or {}
+    destination = (data.get('destination') or '').strip()
+    lines = data.get('lines') or []
+    
+    if not destination:
+        return jsonify({'success': False, 'message': '出荷先を入力してください'}), 400
+    if not lines:
+        return jsonify({'success': False, 'message': '明細を入力してください'}), 400
+    
+    try:
+        lines = [(int(line['stock_id']), int(line['quantity'])) for line in lines]
+    except (KeyError, ValueError, TypeError):
+        return jsonify({'success': False, 'message': '明細の形式が正しくありません'}), 400
+    if any(quantity <= 0 for _, quantity in lines):
+        return jsonify({'success': False, 'message': '数量を正しく入力してください'}), 400
+    
+    # 同じ商品の明細は合算して在庫を確認する
+    required = {}
+    for stock_id, quantity in lines:
+        required[stock_id] = required.get(stock_id, 0) + quantity
+    
+    try:
+        available = dict(db.session.query(Stock.id, Stock.quantity - Stock.reserved_quantity).filter(
+            Stock.id.in_(required), Stock.deleted_at.is_(None)
+        ).all())
+        shortages = [
+            {'stock_id': stock_id, 'required': quantity, 'available': available.get(stock_id, 0)}
+            for stock_id, quantity in required.items()
+            if available.get(stock_id, 0) < quantity
+        ]
+        if shortages:
+            return jsonify({'success': False, 'message': '在庫が不足しています', 'shortages': shortages}), 409
+        
+        # 全商品をまとめて条件付きで引き当てる（確認後に他の出庫が入った場合は更新件数が足りなくなる）
+        required_case = db.case(required, value=Stock.id)
+        updated = db.session.execute(
+            db.update(Stock).where(
+                Stock.id.in_(required), Stock.deleted_at.is_(None),
+                Stock.quantity - Stock.reserved_quantity >= required_case
+            ).values(
+                reserved_quantity=Stock.reserved_quantity + required_case, updated_at=datetime.utcnow()
+            ).execution_options(synchronize_session=False)
+        ).rowcount
+        if updated != len(required):
+            db.session.rollback()
+            return jsonify({'success': False, 'message': '在庫が不足しています'}), 409
+        
+        import uuid
+        
+        shipment_id = uuid.uuid4().hex
+        now = datetime.utcnow()
+        order_ids = db.session.execute(
+            db.insert(OutboundOrder).returning(OutboundOrder.id, sort_by_parameter_order=True),
+            [
+                {'stock_id': stock_id, 'quantity': quantity, 'destination': destination,
+                 'status': 'pending', 'shipment_id': shipment_id, 'reserved': True, 'created_at': now}
+                for stock_id, quantity in lines
+            ]
+        ).scalars().all()
+        db.session.commit()
+        publish_order_event('updated', order_ids)
+        
+        return jsonify({
+            'success': True,
+            'message': f'{len(lines)}件の出庫予定を登録しました',
+            'shipment_id': shipment_id,
+            'order_ids': order_ids
+        })
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'message': f'エラー: {str(e)}'}), 500
+
+def change_order_status(order_id, from_status, **values):
+    """出庫予定が from_status のときだけ更新する（更新できたら True）"""
+    result = db.session.execute(
+        db.update(OutboundOrder).where(
+            OutboundOrder.id == order_id, OutboundOrder.status == from_status
+        ).values(**values).execution_options(synchronize_session=False)
+    )
+    return result.rowcount == 1
+
 @app.route('/warehouse')
 def warehouse_index():
     if not current_user.is_authenticated:
         return redirect(url_for('login_page'))
     
-    pending_orders = OutboundOrder.query.filter_by(status='pending').order_by(OutboundOrder.created_at).all()
-    confirmed_orders = OutboundOrder.query.filter_by(status='warehouse_confirmed').order_by(OutboundOrder.warehouse_confirmed_at.desc()).all()
-    completed_orders = OutboundOrder.query.filter_by(status='completed').order_by(OutboundOrder.completed_at.desc()).all()
-    
-    return render_template('warehouse/index.html', pending_orders=pending_orders, confirmed_orders=confirmed_orders, completed_orders=completed_orders)
+    board_query = OutboundOrder.query.options(joinedload(OutboundOrder.stock).joinedload(Stock.group))
+    pending_orders = board_query.filter_by(status='pending').order_by(OutboundOrder.created_at).all()
+    confirmed_orders = board_query.filter_by(status='warehouse_confirmed').order_by(OutboundOrder.warehouse_confirmed_at.desc()).all()
+    
+    # 出庫完了は直近の期間だけを (completed_at, id) の降順でキーセットページングする
+    per_page = app.config['WAREHOUSE_COMPLETED_PER_PAGE']
+    completed_days = app.config['WAREHOUSE_COMPLETED_DAYS']
+    after = decode_cursor(request.args.get('completed_after', ''))
+    completed_query = board_query.filter(
+        OutboundOrder.status == 'completed',
+        OutboundOrder.completed_at >= datetime.utcnow() - timedelta(days=completed_days)
+    )
+    if after:
+        completed_query = completed_query.filter(tuple_(OutboundOrder.completed_at, OutboundOrder.id) < after)
+    rows = completed_query.order_by(
+        OutboundOrder.completed_at.desc(), OutboundOrder.id.desc()
+    ).limit(per_page + 1).all()
+    completed_orders = rows[:per_page]
+    
+    next_completed_url = None
+    if len(rows) > per_page:
+        last = completed_orders[-1]
+        next_completed_url = url_for('warehouse_index', completed_after=encode_cursor(last.completed_at, last.id))
+    
+    return render_template('warehouse/index.html',
+                         pending_orders=pending_orders,
+                         confirmed_orders=confirmed_orders,
+                         completed_orders=completed_orders,
+                         completed_days=completed_days,
+                         completed_paged=after is not None,
+                         next_completed_url=next_completed_url)
 
 @app.route('/warehouse/<int:order_id>/confirm', methods=['POST'])
 def warehouse_confirm(order_id):
@@ -377,6 +1082,7 @@ def warehouse_confirm(order_id):
         order.status = 'warehouse_confirmed'
         order.warehouse_confirmed_at = datetime.utcnow()
         db.session.commit()
+        publish_order_event('updated', [order_id])
         
         return jsonify({'success': True, 'message': '倉庫確認を完了しました'})
     except Exception as e:
@@ -393,9 +1099,20 @@ def warehouse_complete(order_id):
         if order.status != 'warehouse_confirmed':
             return jsonify({'success': False, 'message': 'この操作はできません'}), 400
         
-        order.status = 'completed'
-        order.completed_at = datetime.utcnow()
+        # 同時に完了された場合に在庫を二重に減らさないよう、状態を条件に更新する
+        if not change_order_status(order_id, 'warehouse_confirmed', status='completed', completed_at=datetime.utcnow()):
+            db.session.rollback()
+            return jsonify({'success': False, 'message': 'この操作はできません'}), 400
+        
+        # 引き当てていた数量を在庫から出庫する
+        if order.reserved:
+            if not adjust_stock_quantity(order.stock_id, -order.quantity, -order.quantity):
+                db.session.rollback()
+                return jsonify({'success': False, 'message': '在庫が不足しています'}), 409
+            history = StockHistory(stock_id=order.stock_id, quantity_change=-order.quantity, transaction_type='outbound', reference_id=order.id, notes=f'出庫: {order.destination}', user_id=current_user.id)
+            db.session.add(history)
         db.session.commit()
+        publish_order_event('updated', [order_id])
         
         return jsonify({'success': True, 'message': '出庫完了にしました'})
     except Exception as e:
@@ -411,20 +1128,492 @@ def warehouse_revert(order_id):
         order = OutboundOrder.query.get_or_404(order_id)
         
         if order.status == 'completed':
-            order.status = 'warehouse_confirmed'
-            order.completed_at = None
+            reverted = change_order_status(order_id, 'completed', status='warehouse_confirmed', completed_at=None)
+            # 出庫した数量を在庫に戻し、再び引き当てる
+            if reverted and order.reserved:
+                adjust_stock_quantity(order.stock_id, order.quantity, order.quantity)
+                # 取消は出庫の件数に数えないよう調整として記録する
+                history = StockHistory(stock_id=order.stock_id, quantity_change=order.quantity, transaction_type='adjustment', reference_id=order.id, notes=f'出庫完了取消: {order.destination}', user_id=current_user.id)
+                db.session.add(history)
         elif order.status == 'warehouse_confirmed':
-            order.status = 'pending'
-            order.warehouse_confirmed_at = None
+            reverted = change_order_status(order_id, 'warehouse_confirmed', status='pending', warehouse_confirmed_at=None)
         else:
+            reverted = False
+        
+        if not reverted:
+            db.session.rollback()
             return jsonify({'success': False, 'message': 'この操作はできません'}), 400
         
         db.session.commit()
+        publish_order_event('updated', [order_id])
         return jsonify({'success': True, 'message': 'ステータスを戻しました'})
     except Exception as e:
         db.session.rollback()
         return jsonify({'success': False, 'message': f'エラー: {str(e)}'}), 500
 
+# 目的の状態ごとに、遷移元の状態と同時に更新する列
+WAREHOUSE_TRANSITIONS = {
+    'warehouse_confirmed': {
+        'pending': lambda now: {'warehouse_confirmed_at': now},
+        'completed': lambda now: {'completed_at': None},
+    },
+    'completed': {
+        'warehouse_confirmed': lambda now: {'completed_at': now},
+    },
+    'pending': {
+        'warehouse_confirmed': lambda now: {'warehouse_confirmed_at': None},
+    },
+}
+
+def move_reserved_stock(orders, order_ids, sign, now):
+    """引当方式のオーダーごとに、条件付きUPDATEで在庫と引当数を増減する
+    
+    sign=-1 で出庫（在庫・引当数を減算）、sign=1 で出庫の取り消し。
+    オーダーは1件ずつ反映するため、同じ商品でも在庫の範囲内のオーダーは完了できる。
+    在庫が足りず減算できなかったオーダーのIDを返す
+    """
+    # 取消は出庫の件数に数えないよう調整として記録する
+    label, transaction_type = ('出庫', 'outbound') if sign < 0 else ('出庫完了取消', 'adjustment')
+    failed = set()
+    histories = []
+    for order_id in order_ids:
+        order = orders[order_id]
+        if not order.reserved:
+            continue
+        if not adjust_stock_quantity(order.stock_id, sign * order.quantity, sign * order.quantity):
+            failed.add(order_id)
+            continue
+        histories.append({
+            'stock_id': order.stock_id, 'quantity_change': sign * order.quantity,
+            'transaction_type': transaction_type, 'reference_id': order_id,
+            'notes': f'{label}: {order.destination}', 'user_id': current_user.id, 'created_at': now
+        })
+    if histories:
+        db.session.execute(db.insert(StockHistory), histories)
+    return failed
+
+@app.route('/warehouse/api/bulk', methods=['POST'])
+@idempotent
+def warehouse_bulk():
+    """複数の出庫予定の状態をまとめて変更する（確認・完了・戻す）
+    
+    JSON: {"order_ids": [1, 2, ...], "status": "warehouse_confirmed" | "completed" | "pending"}
+    遷移できるかは1回のSELECTで判定し、遷移元の状態ごとに1回のUPDATEで更新する。
+    結果はオーダーごとに返し、遷移できないものがあっても他のオーダーは更新する
+    """
+    if not current_user.is_authenticated:
+        return jsonify({'success': False, 'message': 'ログインしてください'}), 401
+    
+    data = request.get_json(silent=True) or {}
+    target = data.get('status')
+    if target not in WAREHOUSE_TRANSITIONS:
+        return jsonify({'success': False, 'message': '変更後のステータスが正しくありません'}), 400
+    try:
+        order_ids = list(dict.fromkeys(int(order_id) for order_id in data.get('order_ids') or []))
+    except (ValueError, TypeError):
+        return jsonify({'success': False, 'message': 'オーダーIDの形式が正しくありません'}), 400
+    if not order_ids:
+        return jsonify({'success': False, 'message': 'オーダーを選択してください'}), 400
+    
+    transitions = WAREHOUSE_TRANSITIONS[target]
+    results = {order_id: 'オーダーが見つかりません' for order_id in order_ids}
+    
+    try:
+        orders = {
+            row.id: row for row in db.session.query(
+                OutboundOrder.id, OutboundOrder.status, OutboundOrder.stock_id, OutboundOrder.quantity,
+                OutboundOrder.destination, OutboundOrder.reserved
+            ).filter(OutboundOrder.id.in_(order_ids))
+        }
+        by_source = {}
+        for order_id, order in orders.items():
+            if order.status in transitions:
+                by_source.setdefault(order.status, []).append(order_id)
+            else:
+                results[order_id] = 'この操作はできません'
+        
+        now = datetime.utcnow()
+        moved = {}
+        for source, ids in by_source.items():
+            # 状態を条件にするため、SELECT 後に他の操作で状態が変わったオーダーは更新されない
+            moved[source] = db.session.execute(
+                db.update(OutboundOrder).where(
+                    OutboundOrder.id.in_(ids), OutboundOrder.status == source
+                ).values(status=target, **transitions[source](now)).returning(OutboundOrder.id)
+                .execution_options(synchronize_session=False)
+            ).scalars().all()
+            for order_id in ids:
+                results[order_id] = 'この操作はできません'
+        
+        # 出庫完了は引き当てた数量を在庫から減らし、完了の取り消しは在庫に戻す
+        failed = set()
+        if target == 'completed':
+            failed = move_reserved_stock(orders, moved.get('warehouse_confirmed', []), -1, now)
+            if failed:
+                # 在庫が足りなかった商品のオーダーは確認済みのままにする
+                db.session.execute(
+                    db.update(OutboundOrder).where(OutboundOrder.id.in_(failed)).values(
+                        status='warehouse_confirmed', completed_at=None
+                    ).execution_options(synchronize_session=False)
+                )
+                for order_id in failed:
+                    results[order_id] = '在庫が不足しています'
+        elif target == 'warehouse_confirmed':
+            move_reserved_stock(orders, moved.get('completed', []), 1, now)
+        
+        for ids in moved.values():
+            for order_id in ids:
+                if order_id not in failed:
+                    results[order_id] = None
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'message': f'エラー: {str(e)}'}), 500
+    
+    succeeded_ids = [order_id for order_id in order_ids if results[order_id] is None]
+    publish_order_event('updated', succeeded_ids)
+    return jsonify({
+        'success': True,
+        'message': f'{len(succeeded_ids)}件のステータスを変更しました',
+        'results': [
+            {'id': order_id, 'success': results[order_id] is None, 'message': results[order_id] or '変更しました'}
+            for order_id in order_ids
+        ]
+    })
+
+# ========== 倉庫確認のライブ更新 ==========
+# 出庫予定の登録・キャンセル・状態変更をコミット後に配信し、倉庫確認画面を SSE で差分更新する
+
+WAREHOUSE_CHANNEL = 'warehouse'
+
+_event_broker = None
+_event_broker_lock = threading.Lock()
+
+def get_event_broker():
+    global _event_broker
+    with _event_broker_lock:
+        if _event_broker is None:
+            from utils.pubsub import LocalBroker, RedisBroker
+            
+            if app.config['EVENT_REDIS_URL']:
+                try:
+                    _event_broker = RedisBroker(app.config['EVENT_REDIS_URL'])
+                except ImportError:
+                    # 他のワーカーの変更は届かないが、画面は操作後に読み直して最新にする
+                    app.logger.warning('redis パッケージが無いため、ライブ更新はワーカー内だけに配信します')
+            if _event_broker is None:
+                _event_broker = LocalBroker()
+        return _event_broker
+
+def order_event_dict(order):
+    def format_time(value):
+        return value.strftime('%Y-%m-%d %H:%M:%S') if value else None
+    
+    return {
+        'id': order.id,
+        'status': order.status,
+        'group_name': order.stock.group.name if order.stock.group else '-',
+        'product_name': order.stock.product_name,
+        'quantity': order.quantity,
+        'destination': order.destination,
+        'created_at': format_time(order.created_at),
+        'warehouse_confirmed_at': format_time(order.warehouse_confirmed_at),
+        'completed_at': format_time(order.completed_at),
+    }
+
+def publish_order_event(action, order_ids):
+    """出庫予定の変更を配信する（コミット後に呼ぶ。配信の失敗は操作を失敗させない）
+    
+    action: 'updated'（登録・状態変更）または 'removed'（キャンセル）
+    """
+    if not order_ids:
+        return
+    try:
+        if action == 'removed':
+            orders = [{'id': order_id} for order_id in order_ids]
+        else:
+            orders = [
+                order_event_dict(order) for order in OutboundOrder.query.options(
+                    joinedload(OutboundOrder.stock).joinedload(Stock.group)
+                ).filter(OutboundOrder.id.in_(order_ids)).all()
+            ]
+        get_event_broker().publish(WAREHOUSE_CHANNEL, {'action': action, 'orders': orders})
+    except Exception as e:
+        app.logger.warning(f'出庫予定の変更を配信できませんでした: {e}')
+
+_event_stream_slots = None
+_event_stream_slots_lock = threading.Lock()
+
+def get_event_stream_slots():
+    """プロセス内で同時に開ける SSE 接続の数（残りのスレッドを通常のリクエスト用に空けておく）"""
+    global _event_stream_slots
+    with _event_stream_slots_lock:
+        if _event_stream_slots is None:
+            _event_stream_slots = threading.BoundedSemaphore(app.config['SSE_MAX_STREAMS'])
+        return _event_stream_slots
+
+@app.route('/warehouse/events')
+def warehouse_events():
+    """倉庫確認画面向けの Server-Sent Events
+    
+    1本の接続は SSE_STREAM_TIMEOUT 秒で終了し、ブラウザが再接続する（ワーカーの
+    スレッドを使い続けない）。再接続時は Last-Event-ID（または last_event_id）の続きから送る
+    """
+    import json
+    
+    if not current_user.is_authenticated:
+        return jsonify({'success': False, 'message': 'ログインしてください'}), 401
+    
+    try:
+        last_event_id = float(request.headers.get('Last-Event-ID') or request.args.get('last_event_id') or '')
+    except ValueError:
+        last_event_id = None
+    
+    slots = get_event_stream_slots()
+    if not slots.acquire(blocking=False):
+        response = jsonify({'success': False, 'message': 'しばらくしてから再接続してください'})
+        response.status_code = 503
+        response.headers['Retry-After'] = str(app.config['SSE_HEARTBEAT'])
+        return response
+    
+    try:
+        subscription = get_event_broker().subscribe(WAREHOUSE_CHANNEL, last_event_id)
+    except Exception as e:
+        slots.release()
+        app.logger.warning(f'ライブ更新の購読を開始できませんでした: {e}')
+        response = jsonify({'success': False, 'message': 'しばらくしてから再接続してください'})
+        response.status_code = 503
+        response.headers['Retry-After'] = str(app.config['SSE_HEARTBEAT'])
+        return response
+    heartbeat = app.config['SSE_HEARTBEAT']
+    deadline = time.monotonic() + app.config['SSE_STREAM_TIMEOUT']
+    
+    def stream():
+        # 接続時点の ID（イベントが届かないまま切れても、再接続時にこの続きから受け取る）
+        yield f'retry: 1000\nevent: ready\nid: {subscription.last_id!r}\ndata: {{}}\n\n'
+        while True:
+            event = subscription.get(timeout=max(min(heartbeat, deadline - time.monotonic()), 0))
+            if subscription.overflowed:
+                yield 'event: reload\ndata: {}\n\n'
+                return
+            if event is not None:
+                yield f'id: {subscription.last_id!r}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n'
+            elif time.monotonic() >= deadline:
+                return
+            else:
+                yield ': keepalive\n\n'
+    
+    def close():
+        subscription.close()
+        slots.release()
+    
+    response = app.response_class(stream(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    # ジェネレーターが始まる前に切断された場合も、購読と接続数を確実に解放する
+    response.call_on_close(close)
+    return response
+
+# ========== 履歴の日次集計 ==========
+# レポートやダッシュボードの件数・数量は履歴を直接集計せず、日次集計テーブルから読む
+
+HISTORY_ROLLUP = 'history_daily'
+
+def refresh_history_rollup(limit=None):
+    """前回の集計以降に追加された履歴を日次集計に反映する
+    
+    集計済みの最後の履歴IDを透かしとして保存し、その続きだけを集計する。
+    透かしまでの範囲でまだ見えない履歴ID（PostgreSQL ではコミット待ちの履歴が
+    後からコミットされた履歴より小さいIDを持つことがある）は HistoryRollupGap に残し、
+    コミットされた後の実行で集計する。
+    
+    Args:
+        limit: 今回集計する履歴IDの範囲の上限（None なら最後まで）
+    
+    Returns:
+        int: 集計した履歴IDの範囲の件数（欠番として残したIDを含む）
+    """
+    from sqlalchemy import func
+    from sqlalchemy.exc import IntegrityError
+    
+    if db.session.get(RollupWatermark, HISTORY_ROLLUP) is None:
+        try:
+            db.session.add(RollupWatermark(name=HISTORY_ROLLUP, last_id=0))
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+    
+    processed = rollup_history_gaps()
+    
+    last_id = db.session.scalar(db.select(RollupWatermark.last_id).where(RollupWatermark.name == HISTORY_ROLLUP))
+    end_id = db.session.scalar(db.select(func.max(StockHistory.id))) or 0
+    if limit is not None:
+        end_id = min(end_id, last_id + limit)
+    
+    while last_id < end_id:
+        upper = min(last_id + app.config['HISTORY_ROLLUP_BATCH_SIZE'], end_id)
+        # 透かしを先に進める。他のプロセスが同じ範囲を集計済みなら何もしない
+        claimed = db.session.execute(
+            db.update(RollupWatermark)
+            .where(RollupWatermark.name == HISTORY_ROLLUP, RollupWatermark.last_id == last_id)
+            .values(last_id=upper)
+        ).rowcount
+        if not claimed:
+            db.session.rollback()
+            return processed
+        
+        in_range = db.and_(StockHistory.id > last_id, StockHistory.id <= upper)
+        # 範囲内で見えない履歴IDを先に記録し、集計からは除く（記録後にコミットされた履歴も二重に数えない）
+        if db.session.scalar(db.select(func.count()).where(in_range)) < upper - last_id:
+            visible = set(db.session.scalars(db.select(StockHistory.id).where(in_range)))
+            now = datetime.utcnow()
+            db.session.execute(db.insert(HistoryRollupGap), [
+                {'history_id': history_id, 'created_at': now}
+                for history_id in range(last_id + 1, upper + 1) if history_id not in visible
+            ])
+            in_range = db.and_(in_range, ~db.exists().where(HistoryRollupGap.history_id == StockHistory.id))
+        
+        rollup_history_rows(in_range)
+        db.session.commit()
+        processed += upper - last_id
+        last_id = upper
+    
+    return processed
+
+def rollup_history_gaps():
+    """前回までに見えなかった履歴のうち、コミットされたものを集計する"""
+    expired = datetime.utcnow() - timedelta(seconds=app.config['HISTORY_ROLLUP_GAP_TIMEOUT'])
+    # 待っても現れないID（ロールバックされた登録など）は欠番とみなす
+    db.session.execute(db.delete(HistoryRollupGap).where(HistoryRollupGap.created_at < expired))
+    # 削除できた行だけを集計する（他のプロセスと同じ履歴を二重に集計しない）
+    history_ids = db.session.scalars(
+        db.delete(HistoryRollupGap).where(
+            db.exists().where(StockHistory.id == HistoryRollupGap.history_id)
+        ).returning(HistoryRollupGap.history_id).execution_options(synchronize_session=False)
+    ).all()
+    if history_ids:
+        rollup_history_rows(StockHistory.id.in_(history_ids))
+    db.session.commit()
+    return len(history_ids)
+
+def rollup_history_rows(criteria):
+    """条件に合う履歴を日次・在庫・種別ごとに集計して加算する"""
+    from sqlalchemy import func
+    
+    day = func.date(StockHistory.created_at)
+    rows = db.session.execute(
+        db.select(
+            day, StockHistory.stock_id, Stock.group_id, StockHistory.transaction_type,
+            func.count(), func.sum(StockHistory.quantity_change)
+        ).join(Stock, StockHistory.stock_id == Stock.id).where(
+            criteria
+        ).group_by(day, StockHistory.stock_id, Stock.group_id, StockHistory.transaction_type)
+    ).all()
+    if rows:
+        upsert_history_daily([
+            {
+                'day': row_day if not isinstance(row_day, str) else datetime.strptime(row_day, '%Y-%m-%d').date(),
+                'stock_id': stock_id, 'group_id': group_id, 'transaction_type': transaction_type,
+                'record_count': record_count, 'quantity': quantity
+            }
+            for row_day, stock_id, group_id, transaction_type, record_count, quantity in rows
+        ])
+
+def upsert_history_daily(rows):
+    if db.engine.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    
+    statement = insert(HistoryDaily)
+    statement = statement.on_conflict_do_update(
+        index_elements=['day', 'stock_id', 'transaction_type'],
+        set_={
+            'group_id': statement.excluded.group_id,
+            'record_count': HistoryDaily.record_count + statement.excluded.record_count,
+            'quantity': HistoryDaily.quantity + statement.excluded.quantity,
+        }
+    )
+    db.session.execute(statement, rows)
+
+_history_rollup_thread = None
+_history_rollup_lock = threading.Lock()
+
+def start_history_rollup():
+    """未集計の履歴を定期的に日次集計に反映するバックグラウンドスレッドを起動する（プロセスごとに1本）
+    
+    画面の表示は日次集計を読むだけで、集計は待たない。HISTORY_ROLLUP_INTERVAL が 0 の場合は
+    起動せず、crontab の flask rollup-history だけで集計する。
+    """
+    global _history_rollup_thread
+    if not app.config['HISTORY_ROLLUP_INTERVAL']:
+        return
+    with _history_rollup_lock:
+        if _history_rollup_thread is None or not _history_rollup_thread.is_alive():
+            _history_rollup_thread = threading.Thread(target=run_history_rollup, daemon=True)
+            _history_rollup_thread.start()
+
+def run_history_rollup():
+    while True:
+        with app.app_context():
+            try:
+                # 透かしの更新で範囲を取り合うため、複数のプロセスで動いても二重に集計しない
+                refresh_history_rollup()
+            except Exception as e:
+                db.session.rollback()
+                app.logger.warning(f'履歴の日次集計エラー: {e}')
+            finally:
+                db.session.remove()
+        time.sleep(app.config['HISTORY_ROLLUP_INTERVAL'])
+
+def history_totals(start_day, end_day=None, by_group=False):
+    """期間内の種別ごとの件数・数量を日次集計から返す
+    
+    Returns:
+        {種別: (件数, 数量)}。by_group=True なら {(グループID, 種別): (件数, 数量)}
+    """
+    from sqlalchemy import func
+    
+    columns = [HistoryDaily.group_id, HistoryDaily.transaction_type] if by_group else [HistoryDaily.transaction_type]
+    statement = db.select(
+        *columns, func.sum(HistoryDaily.record_count), func.sum(HistoryDaily.quantity)
+    ).where(HistoryDaily.day >= start_day).group_by(*columns)
+    if end_day is not None:
+        statement = statement.where(HistoryDaily.day <= end_day)
+    
+    totals = {}
+    for row in db.session.execute(statement):
+        key = tuple(row[:2]) if by_group else row[0]
+        totals[key] = (row[-2], row[-1])
+    return totals
+
+# ========== 履歴のキーセットページング ==========
+
+def encode_cursor(created_at, row_id):
+    return f'{created_at.isoformat()}_{row_id}'
+
+def decode_cursor(value):
+    try:
+        created_at, row_id = value.rsplit('_', 1)
+        return datetime.fromisoformat(created_at), int(row_id)
+    except (ValueError, AttributeError):
+        return None
+
+def history_approx_count(query, filter_key):
+    """フィルター条件ごとの件数（キャッシュ付きの概算値）"""
+    cache_key = ('history_count', filter_key)
+    total = cache_get(cache_key)
+    if total is None:
+        if not any(filter_key) and db.engine.dialect.name == 'postgresql':
+            # フィルターなしの場合は統計情報の推定行数を使う（未 ANALYZE のテーブルは -1 になる）
+            total = db.session.execute(db.text(
+                "SELECT reltuples::bigint FROM pg_class WHERE relname = 'stock_history'"
+            )).scalar()
+        if total is None or total < 0:
+            total = query.order_by(None).count()
+        cache_set(cache_key, total, app.config['HISTORY_COUNT_CACHE_TIMEOUT'])
+    return total
+
 @app.route('/history')
 def history_list():
     if not current_user.is_authenticated:
@@ -437,17 +1626,23 @@ def history_list():
     destination_filter = request.args.get('destination', '').strip()
     start_date = request.args.get('start_date', '').strip()
     end_date = request.args.get('end_date', '').strip()
+    after = decode_cursor(request.args.get('after', ''))
+    before = decode_cursor(request.args.get('before', ''))
+    per_page = app.config['HISTORY_PER_PAGE']
     
-    query = StockHistory.query.order_by(StockHistory.created_at.desc())
+    query = StockHistory.query
     
     if transaction_type in ['inbound', 'outbound', 'adjustment']:
         query = query.filter_by(transaction_type=transaction_type)
     
+    if search_product or group_filter:
+        query = query.join(Stock, StockHistory.stock_id == Stock.id)
+    
     if search_product:
-        query = query.join(Stock).filter(Stock.product_name.ilike(f'%{search_product}%'))
+        query, _ = apply_stock_search(query, 'product_name', search_product)
     
     if group_filter:
-        query = query.join(Stock).filter(Stock.group_id == group_filter)
+        query = query.filter(Stock.group_id == group_filter)
     
     if user_filter:
         query = query.filter_by(user_id=user_filter)
@@ -460,7 +1655,7 @@ def history_list():
             start_datetime = datetime.strptime(start_date, '%Y-%m-%d')
             query = query.filter(StockHistory.created_at >= start_datetime)
         except:
-            pass
+            start_date = ''
     
     if end_date:
         try:
@@ -468,9 +1663,42 @@ def history_list():
             end_datetime = end_datetime.replace(hour=23, minute=59, second=59)
             query = query.filter(StockHistory.created_at <= end_datetime)
         except:
-            pass
-    
-    history = query.all()
+            end_date = ''
+    
+    filter_key = (transaction_type, search_product, group_filter, user_filter, destination_filter, start_date, end_date)
+    total = history_approx_count(query, filter_key)
+    
+    # (created_at, id) の降順で1件多く取得し、次ページの有無を判定する
+    key = tuple_(StockHistory.created_at, StockHistory.id)
+    page_query = query.options(
+        joinedload(StockHistory.stock).joinedload(Stock.group),
+        joinedload(StockHistory.user)
+    )
+    if before:
+        rows = page_query.filter(key > before).order_by(
+            StockHistory.created_at.asc(), StockHistory.id.asc()
+        ).limit(per_page + 1).all()
+        has_prev = len(rows) > per_page
+        history = list(reversed(rows[:per_page]))
+        has_next = True
+    else:
+        if after:
+            page_query = page_query.filter(key < after)
+        rows = page_query.order_by(
+            StockHistory.created_at.desc(), StockHistory.id.desc()
+        ).limit(per_page + 1).all()
+        has_next = len(rows) > per_page
+        history = rows[:per_page]
+        has_prev = after is not None
+    
+    args = request.args.to_dict()
+    args.pop('after', None)
+    args.pop('before', None)
+    next_url = prev_url = None
+    if history and has_next:
+        next_url = url_for('history_list', **args, after=encode_cursor(history[-1].created_at, history[-1].id))
+    if history and has_prev:
+        prev_url = url_for('history_list', **args, before=encode_cursor(history[0].created_at, history[0].id))
     
     # フィルター用のデータ取得
     groups = ItemGroup.query.order_by(ItemGroup.display_order.asc()).all()
@@ -478,6 +1706,9 @@ def history_list():
     
     return render_template('history/index.html', 
                          history=history, 
+                         total=total,
+                         next_url=next_url,
+                         prev_url=prev_url,
                          transaction_type=transaction_type, 
                          search_product=search_product,
                          group_filter=group_filter,
@@ -488,34 +1719,106 @@ def history_list():
                          groups=groups,
                          users=users)
 
+def get_group_summary():
+    """グループ一覧と有効な在庫の件数・数量合計（1クエリで集計、キャッシュ付き）"""
+    cache_key = ('group_summary', cache_generation('group_summary'))
+    group_data = cache_get(cache_key)
+    if group_data is None:
+        rows = db.session.query(
+            ItemGroup.id,
+            ItemGroup.name,
+            ItemGroup.created_at,
+            db.func.count(Stock.id),
+            db.func.coalesce(db.func.sum(Stock.quantity), 0)
+        ).outerjoin(
+            Stock, db.and_(Stock.group_id == ItemGroup.id, Stock.deleted_at.is_(None))
+        ).group_by(ItemGroup.id).order_by(
+            ItemGroup.display_order.asc(), ItemGroup.created_at.desc()
+        ).all()
+        group_data = [
+            {
+                'group': {'id': group_id, 'name': name, 'created_at': created_at},
+                'count': count,
+                'total_quantity': total_quantity,
+                'order': idx
+            }
+            for idx, (group_id, name, created_at, count, total_quantity) in enumerate(rows)
+        ]
+        cache_set(cache_key, group_data)
+    return group_data
+
+# グループ集計（グループ名・並び順、有効な在庫の件数・数量合計）に影響する列
+GROUP_SUMMARY_COLUMNS = {
+    Stock: ('quantity', 'group_id', 'deleted_at'),
+    ItemGroup: ('name', 'display_order'),
+}
+
+@event.listens_for(db.session, 'before_flush')
+def mark_group_summary_dirty(session, flush_context, instances):
+    for obj in list(session.new) + list(session.deleted):
+        if isinstance(obj, (Stock, ItemGroup)):
+            session.info['group_summary_dirty'] = True
+            return
+    for obj in session.dirty:
+        columns = GROUP_SUMMARY_COLUMNS.get(type(obj))
+        if columns and any(db.inspect(obj).attrs[name].history.has_changes() for name in columns):
+            session.info['group_summary_dirty'] = True
+            return
+
+@event.listens_for(db.session, 'after_commit')
+def bump_group_summary_generation(session):
+    if not session.info.pop('group_summary_dirty', False):
+        return
+    cache_clear('group_summary')
+    # 在庫を更新したトランザクションの間は世代の行をロックしないよう、コミット後に別の短いトランザクションで進める
+    try:
+        with db.engine.begin() as connection:
+            bump_cache_generation('group_summary', connection)
+    except Exception as e:
+        # 他のワーカーのキャッシュは CACHE_DEFAULT_TIMEOUT で切れる
+        app.logger.warning(f'グループ集計の世代を更新できませんでした: {e}')
+
+@event.listens_for(db.session, 'after_rollback')
+def reset_group_summary_flag(session):
+    session.info.pop('group_summary_dirty', None)
+
 @app.route('/item_master')
 def item_master_index():
     if not current_user.is_authenticated:
         return redirect(url_for('login_page'))
     
-    groups = ItemGroup.query.order_by(ItemGroup.display_order.asc(), ItemGroup.created_at.desc()).all()
-    
-    group_data = []
-    for idx, group in enumerate(groups):
-        count = Stock.query.filter(Stock.group_id == group.id, Stock.deleted_at.is_(None)).count()
-        group_data.append({'group': group, 'count': count, 'order': idx})
+    group_data = get_group_summary()
     
     return render_template('item_master/index.html', group_data=group_data)
 
 @app.route('/item_master/api/reorder', methods=['POST'])
 def item_master_reorder():
+    """グループの並び順を1回のUPDATEで保存する
+    
+    orders: 並べ替えた範囲のグループID（表示順）
+    start: orders[0] の表示位置（省略時は0 = 全件の並べ替え）
+    """
     if not current_user.is_authenticated:
         return jsonify({'success': False, 'message': 'ログインしてください'}), 401
     
+    data = request.get_json(silent=True)
     try:
-        data = request.get_json()
-        orders = data.get('orders', [])
-        
-        for idx, group_id in enumerate(orders):
-            group = ItemGroup.query.get(int(group_id))
-            if group:
-                group.display_order = idx
+        orders = [int(group_id) for group_id in data['orders']]
+        start = int(data.get('start', 0))
+    except (TypeError, KeyError, ValueError, AttributeError):
+        orders = None
+    if not orders:
+        return jsonify({'success': False, 'message': '並べ替えるグループを指定してください'}), 400
+    
+    try:
+        positions = {group_id: start + idx for idx, group_id in enumerate(orders)}
+        db.session.execute(
+            db.update(ItemGroup)
+            .where(ItemGroup.id.in_(positions))
+            .values(display_order=db.case(positions, value=ItemGroup.id))
+        )
         
+        db.session.info['group_summary_dirty'] = True
         db.session.commit()
         return jsonify({'success': True, 'message': '並べ替えを保存しました'})
     except Exception as e:
@@ -688,9 +1991,41 @@ def user_management_delete(user_id):
     
     return redirect(url_for('user_management'))
 
+def add_missing_columns():
+    """既存テーブルに後から追加した列（NULL許容、またはサーバー側の既定値あり）を追加する"""
+    inspector = db.inspect(db.engine)
+    existing_tables = set(inspector.get_table_names())
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                column_type = column.type.compile(dialect=db.engine.dialect)
+                if column.nullable:
+                    conn.execute(db.text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+                elif column.server_default is not None:
+                    default = column.server_default.arg
+                    conn.execute(db.text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type} NOT NULL DEFAULT {default}'))
+
+def create_missing_indexes():
+    """既存テーブルに後から追加したインデックスを作成する"""
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+
 def init_db():
     with app.app_context():
         db.create_all()
+        add_missing_columns()
+        create_missing_indexes()
+        create_search_index()
+        
+        if db.session.get(CacheGeneration, 'group_summary') is None:
+            db.session.add(CacheGeneration(namespace='group_summary', generation=0))
+            db.session.commit()
         
         existing_user = User.query.filter_by(email='admin@example.com').first()
         if not existing_user:
@@ -706,80 +2041,355 @@ def init_db():
 
 # ========== Excel出力・アップロード ==========
 
+# 出力列（見出し, 列幅, 型）
+EXPORT_COLUMNS = [
+    ('ID', 10, 'int'),
+    ('グループ', 20, 'str'),
+    ('商品名（枝番）', 30, 'str'),
+    ('仕入先', 20, 'str'),
+    ('数量', 12, 'int'),
+]
+
+HISTORY_EXPORT_COLUMNS = [
+    ('ID', 10, 'int'),
+    ('日時', 20, 'datetime'),
+    ('グループ', 20, 'str'),
+    ('商品名（枝番）', 30, 'str'),
+    ('種別', 12, 'str'),
+    ('数量', 12, 'int'),
+    ('ユーザー', 20, 'str'),
+    ('備考', 40, 'str'),
+]
+
+EXPORT_FORMATS = {
+    'xlsx': ('application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', 'xlsx'),
+    'csv': ('text/csv', 'csv'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+}
+
+def iter_export_chunks(statement, convert):
+    """サーバーサイドカーソルで EXPORT_CHUNK_SIZE 件ずつ取得し、変換した行のリストを返す"""
+    result = db.session.execute(statement.execution_options(
+        stream_results=True, yield_per=app.config['EXPORT_CHUNK_SIZE']
+    ))
+    for partition in result.partitions():
+        yield [convert(row) for row in partition]
+
+def stock_export_chunks():
+    statement = db.select(
+        Stock.id, ItemGroup.name, Stock.product_name, Stock.supplier, Stock.quantity
+    ).outerjoin(ItemGroup, Stock.group_id == ItemGroup.id).where(
+        Stock.deleted_at.is_(None)
+    ).order_by(Stock.id)
+    return iter_export_chunks(statement, lambda row: [
+        row[0], row[1] or '-', row[2], row[3] or '-', row[4]
+    ])
+
+def history_export_chunks(start_datetime=None, end_datetime=None):
+    statement = db.select(
+        StockHistory.id, StockHistory.created_at, ItemGroup.name, Stock.product_name,
+        StockHistory.transaction_type, StockHistory.quantity_change, User.username, StockHistory.notes
+    ).join(Stock, StockHistory.stock_id == Stock.id).outerjoin(
+        ItemGroup, Stock.group_id == ItemGroup.id
+    ).outerjoin(User, StockHistory.user_id == User.id).order_by(
+        StockHistory.created_at, StockHistory.id
+    )
+    if start_datetime:
+        statement = statement.where(StockHistory.created_at >= start_datetime)
+    if end_datetime:
+        statement = statement.where(StockHistory.created_at <= end_datetime)
+    return iter_export_chunks(statement, lambda row: [
+        row[0], row[1], row[2] or '-', row[3], row[4], row[5], row[6] or '-', row[7] or '-'
+    ])
+
+def write_xlsx(output, title, columns, chunks):
+    """書き込み専用モードのブックに行を書き出す（全行をメモリに保持しない）"""
+    from openpyxl import Workbook
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import Font, PatternFill, Alignment, Border, Side, NamedStyle
+    from openpyxl.utils import get_column_letter
+    
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(title)
+    
+    thin_border = Border(
+        left=Side(style='thin'),
+        right=Side(style='thin'),
+        top=Side(style='thin'),
+        bottom=Side(style='thin')
+    )
+    header_style = NamedStyle(
+        name='export_header',
+        font=Font(bold=True, color='FFFFFF'),
+        fill=PatternFill(start_color='4472C4', end_color='4472C4', fill_type='solid'),
+        alignment=Alignment(horizontal='center', vertical='center'),
+        border=thin_border
+    )
+    cell_style = NamedStyle(
+        name='export_cell',
+        alignment=Alignment(horizontal='center', vertical='center'),
+        border=thin_border
+    )
+    wb.add_named_style(header_style)
+    wb.add_named_style(cell_style)
+    
+    # 列幅調整（書き込み専用モードでは行の追加前に設定する）
+    for idx, (_, width, _) in enumerate(columns, start=1):
+        ws.column_dimensions[get_column_letter(idx)].width = width
+    
+    def styled_row(values, style):
+        cells = []
+        for value in values:
+            cell = WriteOnlyCell(ws, value=value)
+            cell.style = style
+            cells.append(cell)
+        return cells
+    
+    ws.append(styled_row([header for header, _, _ in columns], 'export_header'))
+    for chunk in chunks:
+        for row in chunk:
+            ws.append(styled_row(row, 'export_cell'))
+    
+    wb.save(output)
+
+def iter_csv(columns, chunks):
+    """CSVをチャンク単位で生成する"""
+    import csv
+    from io import StringIO
+    
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([header for header, _, _ in columns])
+    for chunk in chunks:
+        writer.writerows(chunk)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+def write_parquet(output, columns, chunks):
+    """チャンクごとに RecordBatch を組み立てて Parquet に書き出す"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    
+    arrow_types = {'int': pa.int64(), 'str': pa.string(), 'datetime': pa.timestamp('us')}
+    schema = pa.schema([(header, arrow_types[type_]) for header, _, type_ in columns])
+    
+    with pq.ParquetWriter(output, schema) as writer:
+        for chunk in chunks:
+            if chunk:
+                arrays = [pa.array(values, type=field.type) for values, field in zip(zip(*chunk), schema)]
+                writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=schema))
+
+def write_export(output, fmt, title, columns, chunks):
+    """指定形式でファイルオブジェクト（バイナリ）に書き出す"""
+    if fmt == 'csv':
+        for text in iter_csv(columns, chunks):
+            output.write(text.encode('utf-8'))
+    elif fmt == 'parquet':
+        write_parquet(output, columns, chunks)
+    else:
+        write_xlsx(output, title, columns, chunks)
+
+def export_download_name(name, fmt):
+    return f'{name}_{datetime.now().strftime("%Y%m%d_%H%M%S")}.{EXPORT_FORMATS[fmt][1]}'
+
+def export_response(name, title, columns, chunks, fmt):
+    import tempfile
+    
+    mimetype = EXPORT_FORMATS[fmt][0]
+    download_name = export_download_name(name, fmt)
+    
+    if fmt == 'csv':
+        response = app.response_class(stream_with_context(iter_csv(columns, chunks)), mimetype=mimetype)
+        response.headers['Content-Disposition'] = f'attachment; filename={download_name}'
+        return response
+    
+    # 一時ファイルに書き出してから配信する（xlsx/Parquet はフッター等を全行の書き込み後に確定する）
+    output = tempfile.TemporaryFile()
+    write_export(output, fmt, title, columns, chunks)
+    output.seek(0)
+    
+    return send_file(output, mimetype=mimetype, as_attachment=True, download_name=download_name)
+
+def parse_date_range(start_date, end_date):
+    """'YYYY-MM-DD' 形式の開始日・終了日を日時の範囲に変換する（不正な値は ValueError）"""
+    start_datetime = end_datetime = None
+    if start_date:
+        start_datetime = datetime.strptime(start_date, '%Y-%m-%d')
+    if end_date:
+        end_datetime = datetime.strptime(end_date, '%Y-%m-%d').replace(hour=23, minute=59, second=59)
+    return start_datetime, end_datetime
+
 @app.route('/inventory/export')
 def inventory_export():
     if not current_user.is_authenticated:
         return redirect(url_for('login_page'))
     
+    fmt = request.args.get('format', 'xlsx')
+    if fmt not in EXPORT_FORMATS:
+        flash('出力形式が正しくありません', 'error')
+        return redirect(url_for('inventory_list'))
+    
+    try:
+        return export_response('inventory', '在庫一覧', EXPORT_COLUMNS, stock_export_chunks(), fmt)
+    except Exception as e:
+        flash(f'エラー: {str(e)}', 'error')
+        return redirect(url_for('inventory_list'))
+
+@app.route('/history/export')
+def history_export():
+    if not current_user.is_authenticated:
+        return redirect(url_for('login_page'))
+    
+    fmt = request.args.get('format', 'xlsx')
+    if fmt not in EXPORT_FORMATS:
+        flash('出力形式が正しくありません', 'error')
+        return redirect(url_for('history_list'))
+    
+    try:
+        start_datetime, end_datetime = parse_date_range(
+            request.args.get('start_date', '').strip(), request.args.get('end_date', '').strip()
+        )
+    except ValueError:
+        flash('日付を正しく入力してください', 'error')
+        return redirect(url_for('history_list'))
+    
+    try:
+        return export_response('history', '在庫履歴', HISTORY_EXPORT_COLUMNS, history_export_chunks(start_datetime, end_datetime), fmt)
+    except Exception as e:
+        flash(f'エラー: {str(e)}', 'error')
+        return redirect(url_for('history_list'))
+
+def read_import_rows(file_obj, error_rows):
+    """読み取り専用モードでシートを走査し (行番号, 在庫ID, 数量) を返す
+    
+    入力エラーは error_rows に追記して読み飛ばす
+    """
+    from openpyxl import load_workbook
+    
+    wb = load_workbook(file_obj, read_only=True, data_only=True)
     try:
-        from openpyxl import Workbook
-        from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
-        
-        stocks = Stock.query.filter(Stock.deleted_at.is_(None)).all()
-        
-        wb = Workbook()
         ws = wb.active
-        ws.title = '在庫一覧'
-        
-        # ヘッダー行
-        headers = ['ID', 'グループ', '商品名（枝番）', '仕入先', '数量']
-        ws.append(headers)
-        
-        # ヘッダーのスタイル
-        header_fill = PatternFill(start_color='4472C4', end_color='4472C4', fill_type='solid')
-        header_font = Font(bold=True, color='FFFFFF')
-        
-        for cell in ws[1]:
-            cell.fill = header_fill
-            cell.font = header_font
-            cell.alignment = Alignment(horizontal='center', vertical='center')
-        
-        # データ行
-        for stock in stocks:
-            ws.append([
-                stock.id,
-                stock.group.name if stock.group else '-',
-                stock.product_name,
-                stock.supplier if stock.supplier else '-',
-                stock.quantity
-            ])
+        for idx, row in enumerate(ws.iter_rows(min_row=2, values_only=True), start=2):
+            # 列のデータを取得
+            stock_id = row[0] if len(row) > 0 else None  # A列
+            quantity = row[4] if len(row) > 4 else None  # E列（5番目）
+            
+            if stock_id is None or quantity is None:
+                continue
+            
+            # 型変換
+            try:
+                stock_id = int(stock_id)
+            except (ValueError, TypeError):
+                error_rows.append(f'{idx}行目: ID「{stock_id}」は数値で入力してください')
+                continue
+            
+            try:
+                quantity = int(quantity)
+            except (ValueError, TypeError):
+                error_rows.append(f'{idx}行目: 数量「{quantity}」は数値で入力してください（E列を確認）')
+                continue
+            
+            yield idx, stock_id, quantity
+    finally:
+        wb.close()
+
+def apply_import_chunk(chunk, user_id, error_rows):
+    """1チャンク分の数量をまとめて反映し、調整履歴を一括登録してコミットする"""
+    stock_ids = {stock_id for _, stock_id, _ in chunk}
+    current = {}
+    reserved = {}
+    min_stocks = {}
+    # 反映までの間に引当数が増えないよう行をロックして読む
+    for stock_id, quantity, reserved_quantity, min_stock in db.session.query(
+        Stock.id, Stock.quantity, Stock.reserved_quantity, Stock.min_stock
+    ).filter(Stock.id.in_(stock_ids)).with_for_update():
+        current[stock_id] = quantity
+        reserved[stock_id] = reserved_quantity
+        min_stocks[stock_id] = min_stock
+    
+    now = datetime.utcnow()
+    updates = {}
+    histories = []
+    for idx, stock_id, quantity in chunk:
+        if stock_id not in current:
+            error_rows.append(f'{idx}行目: ID {stock_id} が見つかりません')
+            continue
+        if quantity < reserved[stock_id]:
+            error_rows.append(f'{idx}行目: ID {stock_id} は出庫予定に引き当て済みの数量（{reserved[stock_id]}個）より少なくできません')
+            continue
         
-        # 列幅調整
-        ws.column_dimensions['A'].width = 10
-        ws.column_dimensions['B'].width = 20
-        ws.column_dimensions['C'].width = 30
-        ws.column_dimensions['D'].width = 20
-        ws.column_dimensions['E'].width = 12
-        
-        # 枠線
-        thin_border = Border(
-            left=Side(style='thin'),
-            right=Side(style='thin'),
-            top=Side(style='thin'),
-            bottom=Side(style='thin')
-        )
+        old_quantity = current[stock_id]
+        quantity_change = quantity - old_quantity
+        if quantity_change == 0:
+            continue
         
-        for row in ws.iter_rows(min_row=1, max_row=ws.max_row, min_col=1, max_col=5):
-            for cell in row:
-                cell.border = thin_border
-                if cell.row != 1:
-                    cell.alignment = Alignment(horizontal='center', vertical='center')
+        current[stock_id] = quantity
+        updates[stock_id] = quantity
+        record_stock_change(stock_id, old_quantity, quantity, min_stocks[stock_id])
         
-        # ダウンロード
-        from io import BytesIO
-        output = BytesIO()
-        wb.save(output)
-        output.seek(0)
-        
-        return send_file(
-            output,
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-            as_attachment=True,
-            download_name=f'inventory_{datetime.now().strftime("%Y%m%d_%H%M%S")}.xlsx'
-        )
-    except Exception as e:
-        flash(f'エラー: {str(e)}', 'error')
-        return redirect(url_for('inventory_list'))
+        # 差分を履歴に記録
+        histories.append({
+            'stock_id': stock_id,
+            'quantity_change': quantity_change,
+            'transaction_type': 'adjustment',
+            'notes': f'一括変更: {old_quantity}個 → {quantity}個',
+            'user_id': user_id,
+            'created_at': now
+        })
+    
+    if updates:
+        db.session.execute(db.update(Stock), [
+            {'id': stock_id, 'quantity': quantity, 'updated_at': now}
+            for stock_id, quantity in updates.items()
+        ])
+        # 一括UPDATEはフラッシュを経由しないため、グループ集計のキャッシュ破棄を明示する
+        db.session.info['group_summary_dirty'] = True
+    if histories:
+        db.session.execute(db.insert(StockHistory), histories)
+    db.session.commit()
+    
+    return len(histories)
+
+def import_stock_quantities(rows, user_id, error_rows, progress=None):
+    """IMPORT_CHUNK_SIZE 件ごとに在庫IDを先読みして数量を一括更新する
+    
+    Args:
+        progress: チャンクの反映ごとに処理済み行数を受け取るコールバック
+    
+    Returns:
+        int: 数量が変わった行数
+    """
+    chunk_size = app.config['IMPORT_CHUNK_SIZE']
+    updated_count = 0
+    processed = 0
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            updated_count += apply_import_chunk(chunk, user_id, error_rows)
+            processed += len(chunk)
+            chunk = []
+            if progress:
+                progress(processed)
+    if chunk:
+        updated_count += apply_import_chunk(chunk, user_id, error_rows)
+        processed += len(chunk)
+        if progress:
+            progress(processed)
+    
+    return updated_count
+
+def import_result_message(updated_count, error_rows):
+    if not error_rows:
+        return f'{updated_count}個の商品を更新しました'
+    error_msg = '更新完了しましたが、以下の行でエラーが発生しました:\n' + '\n'.join(error_rows[:10])
+    if len(error_rows) > 10:
+        error_msg += f'\n... 他 {len(error_rows) - 10} 件'
+    return error_msg
 
 @app.route('/inventory/import', methods=['GET', 'POST'])
 def inventory_import():
@@ -801,71 +2411,15 @@ def inventory_import():
                 flash('Excelファイル（.xlsx）をアップロードしてください', 'error')
                 return redirect(url_for('inventory_import'))
             
-            from openpyxl import load_workbook
-            from io import BytesIO
-            
-            wb = load_workbook(BytesIO(file.read()))
-            ws = wb.active
-            
-            updated_count = 0
             error_rows = []
-            
-            for idx, row in enumerate(ws.iter_rows(min_row=2, values_only=True), start=2):
-                try:
-                    # 列のデータを取得
-                    stock_id = row[0]  # A列
-                    quantity = row[4]  # E列（5番目）
-                    
-                    if stock_id is None or quantity is None:
-                        continue
-                    
-                    # 型変換
-                    try:
-                        stock_id = int(stock_id)
-                    except (ValueError, TypeError):
-                        error_rows.append(f'{idx}行目: ID「{stock_id}」は数値で入力してください')
-                        continue
-                    
-                    try:
-                        quantity = int(quantity)
-                    except (ValueError, TypeError):
-                        error_rows.append(f'{idx}行目: 数量「{quantity}」は数値で入力してください（E列を確認）')
-                        continue
-                    
-                    stock = Stock.query.get(stock_id)
-                    if not stock:
-                        error_rows.append(f'{idx}行目: ID {stock_id} が見つかりません')
-                        continue
-                    
-                    old_quantity = stock.quantity
-                    stock.quantity = quantity
-                    stock.updated_at = datetime.utcnow()
-                    
-                    # 差分を履歴に記録
-                    quantity_change = quantity - old_quantity
-                    if quantity_change != 0:
-                        history = StockHistory(
-                            stock_id=stock.id,
-                            quantity_change=quantity_change,
-                            transaction_type='adjustment',
-                            notes=f'一括変更: {old_quantity}個 → {quantity}個',
-                            user_id=current_user.id
-                        )
-                        db.session.add(history)
-                        updated_count += 1
-                
-                except Exception as e:
-                    error_rows.append(f'{idx}行目: {str(e)}')
-            
-            db.session.commit()
+            updated_count = import_stock_quantities(
+                read_import_rows(file.stream, error_rows), current_user.id, error_rows
+            )
             
             if error_rows:
-                error_msg = '更新完了しましたが、以下の行でエラーが発生しました:\n' + '\n'.join(error_rows[:10])
-                if len(error_rows) > 10:
-                    error_msg += f'\n... 他 {len(error_rows) - 10} 件'
-                flash(error_msg, 'error')
+                flash(import_result_message(updated_count, error_rows), 'error')
             else:
-                flash(f'{updated_count}個の商品を更新しました', 'success')
+                flash(import_result_message(updated_count, error_rows), 'success')
             
             return redirect(url_for('inventory_list'))
         
@@ -876,6 +2430,509 @@ def inventory_import():
     
     return render_template('inventory/import.html')
 
+# ========== バックグラウンドジョブ ==========
+# 取込・出力をプロセスプールで実行し、進捗は job テーブルに記録する
+
+_job_executor = None
+_job_executor_lock = threading.Lock()
+
+def get_job_executor():
+    global _job_executor
+    with _job_executor_lock:
+        if _job_executor is None:
+            from concurrent.futures import ProcessPoolExecutor
+            from multiprocessing import get_context
+            # ワーカーは別スレッド（SSE・アラート・メール送信）が動いているため fork せず、新しいプロセスで起動する
+            _job_executor = ProcessPoolExecutor(
+                max_workers=app.config['JOB_WORKERS'], mp_context=get_context('spawn')
+            )
+        return _job_executor
+
+def job_folder():
+    folder = os.path.join(app.config['UPLOAD_FOLDER'], 'jobs')
+    os.makedirs(folder, exist_ok=True)
+    return folder
+
+def cleanup_jobs():
+    """中断されたジョブを失敗にし、保持期間を過ぎたファイルを削除する（プロセスごとに一定間隔で1回）"""
+    cache_key = ('job_cleanup',)
+    if cache_get(cache_key) is not None:
+        return
+    cache_set(cache_key, True, app.config['JOB_CLEANUP_INTERVAL'])
+    
+    now = datetime.utcnow()
+    # 再起動などで実行していたプロセスが無くなったジョブは、進捗が更新されないまま残る
+    # （待機中のジョブは順番待ちで長く待つことがあるため対象にしない）
+    stale_before = now - timedelta(seconds=app.config['JOB_STALE_TIMEOUT'])
+    db.session.execute(
+        db.update(Job).where(Job.status == 'running', Job.heartbeat_at < stale_before).values(status='failed', message='ジョブが中断されました。もう一度実行してください', finished_at=now)
+    )
+    expired_before = now - timedelta(seconds=app.config['JOB_RESULT_TTL'])
+    db.session.execute(
+        db.update(Job).where(Job.result_path.isnot(None), Job.finished_at < expired_before).values(
+            result_path=None, message='保持期間を過ぎたため出力ファイルを削除しました'
+        )
+    )
+    db.session.commit()
+    
+    # 出力ファイル・アップロードされたブック・取込プレビュー
+    folder = job_folder()
+    for name in os.listdir(folder):
+        path = os.path.join(folder, name)
+        timeout = app.config['IMPORT_PREVIEW_TIMEOUT'] if name.startswith('preview_') else app.config['JOB_RESULT_TTL']
+        try:
+            if time.time() - os.path.getmtime(path) > timeout:
+                os.remove(path)
+        except OSError:
+            pass
+
+def submit_job(job_type, params, user_id, total=None):
+    import json
+    import uuid
+    
+    cleanup_jobs()
+    job = Job(id=uuid.uuid4().hex, job_type=job_type, params=json.dumps(params), user_id=user_id, total=total)
+    db.session.add(job)
+    db.session.commit()
+    get_job_executor().submit(run_job, job.id)
+    return job
+
+def update_job(job_id, **values):
+    db.session.execute(db.update(Job).where(Job.id == job_id).values(heartbeat_at=datetime.utcnow(), **values))
+    db.session.commit()
+
+def run_job(job_id):
+    """ワーカープロセスで実行されるジョブ本体"""
+    import json
+    
+    with app.app_context():
+        job = db.session.get(Job, job_id)
+        # 登録後に削除されたジョブは実行しない
+        if job is None:
+            db.session.remove()
+            return
+        params = json.loads(job.params)
+        # 待機中に中断扱い（失敗）にされたジョブは実行しない
+        now = datetime.utcnow()
+        claimed = db.session.execute(
+            db.update(Job).where(Job.id == job_id, Job.status == 'queued').values(
+                status='running', started_at=now, heartbeat_at=now
+            )
+        ).rowcount
+        db.session.commit()
+        if not claimed:
+            db.session.remove()
+            return
+        try:
+            if job.job_type == 'import':
+                values = run_import_job(job_id, params)
+            else:
+                values = run_export_job(job_id, params)
+            update_job(job_id, status='completed', finished_at=datetime.utcnow(),
+                       progress=db.func.coalesce(Job.total, Job.progress), **values)
+        except Exception as e:
+            db.session.rollback()
+            update_job(job_id, status='failed', message=f'エラー: {str(e)}', finished_at=datetime.utcnow())
+        finally:
+            db.session.remove()
+
+def run_import_job(job_id, params):
+    progress = lambda processed: update_job(job_id, progress=processed)
+    
+    if 'preview' in params:
+        # プレビューで計算済みの差分を反映する（ブックは再解析しない）
+        preview = load_import_preview(params['preview'])
+        if preview is None:
+            raise ValueError('プレビューの有効期限が切れました。もう一度アップロードしてください')
+        error_rows = list(preview['error_rows'])
+        error_rows += [f'ID {stock_id} が見つかりません' for stock_id in preview['unknown_ids']]
+        updated_count = import_stock_quantities(
+            [tuple(change) for change in preview['changes']], params['user_id'], error_rows, progress=progress
+        )
+        return {'message': import_result_message(updated_count, error_rows)}
+    
+    # 件数はシートの行数なので、入力エラーで読み飛ばした行も含めて何行目まで処理したかを進捗にする
+    error_rows = []
+    last_row = [1]
+    
+    def track(rows):
+        for row in rows:
+            last_row[0] = row[0]
+            yield row
+    
+    try:
+        with open(params['path'], 'rb') as f:
+            updated_count = import_stock_quantities(
+                track(read_import_rows(f, error_rows)), params['user_id'], error_rows,
+                progress=lambda processed: update_job(job_id, progress=last_row[0] - 1)
+            )
+    finally:
+        os.remove(params['path'])
+    return {'message': import_result_message(updated_count, error_rows)}
+
+def run_export_job(job_id, params):
+    fmt = params['format']
+    if params['target'] == 'history':
+        start_datetime, end_datetime = parse_date_range(params.get('start_date', ''), params.get('end_date', ''))
+        title, columns = '在庫履歴', HISTORY_EXPORT_COLUMNS
+        chunks = history_export_chunks(start_datetime, end_datetime)
+        query = StockHistory.query
+        if start_datetime:
+            query = query.filter(StockHistory.created_at >= start_datetime)
+        if end_datetime:
+            query = query.filter(StockHistory.created_at <= end_datetime)
+    else:
+        title, columns = '在庫一覧', EXPORT_COLUMNS
+        chunks = stock_export_chunks()
+        query = Stock.query.filter(Stock.deleted_at.is_(None))
+    update_job(job_id, total=query.count())
+    
+    def track(chunks):
+        done = 0
+        for chunk in chunks:
+            done += len(chunk)
+            update_job(job_id, progress=done)
+            yield chunk
+    
+    path = os.path.join(job_folder(), f'{job_id}.{EXPORT_FORMATS[fmt][1]}')
+    with open(path, 'wb') as output:
+        write_export(output, fmt, title, columns, track(chunks))
+    return {'result_path': path}
+
+def job_to_dict(job):
+    data = {
+        'job_id': job.id,
+        'job_type': job.job_type,
+        'status': job.status,
+        'progress': job.progress,
+        'total': job.total,
+        'message': job.message,
+        'created_at': job.created_at.isoformat(),
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+    }
+    if job.status == 'completed' and job.result_path:
+        data['download_url'] = url_for('job_download', job_id=job.id)
+    return data
+
+@app.route('/jobs/import', methods=['POST'])
+def job_import():
+    if not current_user.is_authenticated:
+        return jsonify({'success': False, 'message': 'ログインしてください'}), 401
+    
+    file = request.files.get('file')
+    if not file or file.filename == '':
+        return jsonify({'success': False, 'message': 'ファイルを選択してください'}), 400
+    if not file.filename.endswith('.xlsx'):
+        return jsonify({'success': False, 'message': 'Excelファイル（.xlsx）をアップロードしてください'}), 400
+    
+    try:
+        import uuid
+        from openpyxl import load_workbook
+        
+        path = os.path.join(job_folder(), f'upload_{uuid.uuid4().hex}.xlsx')
+        file.save(path)
+        
+        # 読み取り専用モードではシートの範囲情報だけを読むため件数の取得は軽い
+        wb = load_workbook(path, read_only=True)
+        total = max((wb.active.max_row or 1) - 1, 0)
+        wb.close()
+        
+        job = submit_job('import', {'path': path, 'user_id': current_user.id}, current_user.id, total=total)
+        return jsonify({'success': True, 'job_id': job.id, 'status_url': url_for('job_status', job_id=job.id)}), 202
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'message': f'エラー: {str(e)}'}), 500
+
+@app.route('/jobs/export', methods=['POST'])
+def job_export():
+    if not current_user.is_authenticated:
+        return jsonify({'success': False, 'message': 'ログインしてください'}), 401
+    
+    data = request.get_json(silent=True) or request.form
+    target = data.get('target', 'inventory')
+    fmt = data.get('format', 'xlsx')
+    start_date = (data.get('start_date') or '').strip()
+    end_date = (data.get('end_date') or '').strip()
+    
+    if target not in ('inventory', 'history'):
+        return jsonify({'success': False, 'message': '出力対象が正しくありません'}), 400
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({'success': False, 'message': '出力形式が正しくありません'}), 400
+    
+    try:
+        start_datetime, end_datetime = parse_date_range(start_date, end_date)
+    except ValueError:
+        return jsonify({'success': False, 'message': '日付を正しく入力してください'}), 400
+    
+    try:
+        params = {
+            'target': target,
+            'format': fmt,
+            'start_date': start_date,
+            'end_date': end_date,
+            'download_name': export_download_name(target, fmt)
+        }
+        # 件数はジョブの中で数える（リクエストでは履歴全体を走査しない）
+        job = submit_job('export', params, current_user.id)
+        return jsonify({'success': True, 'job_id': job.id, 'status_url': url_for('job_status', job_id=job.id)}), 202
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'message': f'エラー: {str(e)}'}), 500
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    if not current_user.is_authenticated:
+        return jsonify({'success': False, 'message': 'ログインしてください'}), 401
+    
+    cleanup_jobs()
+    job = db.session.get(Job, job_id)
+    if not job or job.user_id != current_user.id:
+        return jsonify({'success': False, 'message': 'ジョブが見つかりません'}), 404
+    
+    return jsonify({'success': True, **job_to_dict(job)})
+
+@app.route('/jobs/<job_id>/download')
+def job_download(job_id):
+    import json
+    
+    if not current_user.is_authenticated:
+        return redirect(url_for('login_page'))
+    
+    job = db.session.get(Job, job_id)
+    if not job or job.user_id != current_user.id or job.status != 'completed' or not job.result_path:
+        return render_template('errors/404.html'), 404
+    
+    params = json.loads(job.params)
+    return send_file(
+        os.path.abspath(job.result_path),
+        mimetype=EXPORT_FORMATS[params['format']][0],
+        as_attachment=True,
+        download_name=params['download_name']
+    )
+
+# ========== 取込プレビュー ==========
+# アップロードされたブックを1回だけ走査して差分を計算し、利用者・在庫の世代・ファイルのハッシュで保存する。
+# 確定時は保存済みの差分をそのまま反映する。
+
+def compute_import_preview(file_obj):
+    """シートを1回走査し、先読みした ID→数量 の対応表と突き合わせて差分を計算する"""
+    error_rows = []
+    
+    # 同じIDが複数行ある場合は最後の行が最終的な数量になる
+    targets = {}
+    for idx, stock_id, quantity in read_import_rows(file_obj, error_rows):
+        targets[stock_id] = (idx, quantity)
+    
+    current = {}
+    stock_ids = list(targets)
+    chunk_size = app.config['IMPORT_CHUNK_SIZE']
+    for i in range(0, len(stock_ids), chunk_size):
+        rows = db.session.query(Stock.id, Stock.quantity, Stock.reserved_quantity, Stock.group_id).filter(
+            Stock.id.in_(stock_ids[i:i + chunk_size])
+        ).all()
+        current.update({
+            stock_id: (quantity, reserved_quantity, group_id)
+            for stock_id, quantity, reserved_quantity, group_id in rows
+        })
+    
+    changes = []
+    unknown_ids = []
+    group_deltas = {}
+    for stock_id, (idx, quantity) in targets.items():
+        if stock_id not in current:
+            unknown_ids.append(stock_id)
+            continue
+        old_quantity, reserved_quantity, group_id = current[stock_id]
+        if quantity < reserved_quantity:
+            error_rows.append(f'{idx}行目: ID {stock_id} は出庫予定に引き当て済みの数量（{reserved_quantity}個）より少なくできません')
+            continue
+        if quantity != old_quantity:
+            changes.append([idx, stock_id, quantity])
+            group_deltas[group_id] = group_deltas.get(group_id, 0) + quantity - old_quantity
+    
+    group_names = dict(db.session.query(ItemGroup.id, ItemGroup.name).filter(
+        ItemGroup.id.in_([group_id for group_id in group_deltas if group_id is not None])
+    ).all())
+    
+    return {
+        'changed_count': len(changes),
+        'group_deltas': [
+            {'group_id': group_id, 'group_name': group_names.get(group_id, '-'), 'delta': delta}
+            for group_id, delta in group_deltas.items()
+        ],
+        'unknown_ids': sorted(unknown_ids),
+        'error_rows': error_rows,
+        'changes': sorted(changes),
+    }
+
+def import_preview_token(content):
+    """プレビューの保存キー
+    
+    在庫・グループが更新されるたびに進む group_summary の世代を含めるため、
+    在庫が変わった後に同じファイルをアップロードすると差分を計算し直す
+    """
+    import hashlib
+    
+    file_hash = hashlib.sha256(content).hexdigest()
+    return hashlib.sha256(f'{current_user.id}:{cache_generation("group_summary")}:{file_hash}'.encode()).hexdigest()
+
+def import_preview_path(token):
+    return os.path.join(job_folder(), f'preview_{token}.json')
+
+def save_import_preview(token, preview):
+    import json
+    
+    with open(import_preview_path(token), 'w', encoding='utf-8') as f:
+        json.dump(preview, f, ensure_ascii=False)
+    cache_set(('import_preview', token), preview, app.config['IMPORT_PREVIEW_TIMEOUT'])
+
+def load_import_preview(token):
+    """保存済みのプレビューを返す（期限切れ・未保存なら None）"""
+    import json
+    
+    preview = cache_get(('import_preview', token))
+    if preview is not None:
+        return preview
+    
+    path = import_preview_path(token)
+    if not os.path.exists(path) or time.time() - os.path.getmtime(path) > app.config['IMPORT_PREVIEW_TIMEOUT']:
+        return None
+    with open(path, encoding='utf-8') as f:
+        preview = json.load(f)
+    cache_set(('import_preview', token), preview, app.config['IMPORT_PREVIEW_TIMEOUT'])
+    return preview
+
+@app.route('/inventory/import/preview', methods=['POST'])
+def inventory_import_preview():
+    if not current_user.is_authenticated:
+        return jsonify({'success': False, 'message': 'ログインしてください'}), 401
+    
+    file = request.files.get('file')
+    if not file or file.filename == '':
+        return jsonify({'success': False, 'message': 'ファイルを選択してください'}), 400
+    if not file.filename.endswith('.xlsx'):
+        return jsonify({'success': False, 'message': 'Excelファイル（.xlsx）をアップロードしてください'}), 400
+    
+    try:
+        from io import BytesIO
+        
+        content = file.read()
+        token = import_preview_token(content)
+        
+        preview = load_import_preview(token)
+        if preview is None:
+            preview = compute_import_preview(BytesIO(content))
+            preview['user_id'] = current_user.id
+            save_import_preview(token, preview)
+        
+        return jsonify({
+            'success': True,
+            'token': token,
+            'changed_count': preview['changed_count'],
+            'group_deltas': preview['group_deltas'],
+            'unknown_ids': preview['unknown_ids'],
+            'error_rows': preview['error_rows'],
+        })
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'message': f'エラー: {str(e)}'}), 500
+
+@app.route('/inventory/import/confirm', methods=['POST'])
+def inventory_import_confirm():
+    if not current_user.is_authenticated:
+        return jsonify({'success': False, 'message': 'ログインしてください'}), 401
+    
+    data = request.get_json(silent=True) or request.form
+    token = data.get('token', '')
+    preview = load_import_preview(token) if token.isalnum() else None
+    # 他の利用者がアップロードしたプレビューは確定できない
+    if preview is None or preview.get('user_id') != current_user.id:
+        return jsonify({'success': False, 'message': 'プレビューの有効期限が切れました。もう一度アップロードしてください'}), 404
+    
+    message = f'{preview["changed_count"]}件の変更を取り込みます'
+    if preview['unknown_ids']:
+        unknown = ', '.join(str(stock_id) for stock_id in preview['unknown_ids'][:10])
+        if len(preview['unknown_ids']) > 10:
+            unknown += f' 他 {len(preview["unknown_ids"]) - 10} 件'
+        message += f'（見つからないIDは取り込みません: {unknown}）'
+    
+    try:
+        job = submit_job('import', {'preview': token, 'user_id': current_user.id}, current_user.id,
+                         total=preview['changed_count'])
+        return jsonify({'success': True, 'message': message, 'job_id': job.id,
+                        'status_url': url_for('job_status', job_id=job.id)}), 202
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'message': f'エラー: {str(e)}'}), 500
+
+# ========== 端末向け差分同期 ==========
+# ハンディ端末は前回の同期位置（watermark）以降に変わった商品・グループだけを受け取る
+
+SYNC_STOCK_FIELDS = ('id', 'group_id', 'product_name', 'quantity', 'available', 'supplier')
+SYNC_GROUP_FIELDS = ('id', 'name', 'display_order')
+
+@app.route('/api/sync')
+def api_sync():
+    """前回の同期以降に変更された商品・グループを返す
+    
+    since: 前回のレスポンスの watermark（省略時は全件）
+    レスポンスは列名と行の配列に分けた JSON で、Accept-Encoding が gzip なら圧縮して返す。
+    has_more が true の間は watermark を指定して続きを取得する
+    """
+    import gzip
+    import json
+    
+    if not current_user.is_authenticated:
+        return jsonify({'success': False, 'message': 'ログインしてください'}), 401
+    
+    since = None
+    if request.args.get('since'):
+        since = decode_cursor(request.args['since'])
+        if since is None:
+            return jsonify({'success': False, 'message': 'watermark が正しくありません'}), 400
+    
+    per_page = app.config['SYNC_PAGE_SIZE']
+    upper = datetime.utcnow() - timedelta(seconds=app.config['SYNC_SAFETY_LAG'])
+    
+    stock_query = db.session.query(
+        Stock.id, Stock.group_id, Stock.product_name, Stock.quantity,
+        Stock.quantity - Stock.reserved_quantity, Stock.supplier, Stock.updated_at, Stock.deleted_at
+    ).filter(Stock.updated_at <= upper)
+    group_query = db.session.query(ItemGroup.id, ItemGroup.name, ItemGroup.display_order)
+    if since:
+        stock_query = stock_query.filter(tuple_(Stock.updated_at, Stock.id) > since)
+        group_query = group_query.filter(ItemGroup.updated_at > since[0], ItemGroup.updated_at <= upper)
+    else:
+        # 初回は削除済みを送らない
+        stock_query = stock_query.filter(Stock.deleted_at.is_(None))
+    
+    rows = stock_query.order_by(Stock.updated_at.asc(), Stock.id.asc()).limit(per_page + 1).all()
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    
+    if has_more:
+        watermark = encode_cursor(rows[-1].updated_at, rows[-1].id)
+    else:
+        # 上限時刻までの変更はすべて返したので、次回は上限時刻以降を取得する
+        watermark = encode_cursor(upper, 0)
+    
+    payload = {
+        'watermark': watermark,
+        'has_more': has_more,
+        'groups': {'fields': SYNC_GROUP_FIELDS, 'rows': [list(row) for row in group_query.order_by(ItemGroup.id)]},
+        'stocks': {'fields': SYNC_STOCK_FIELDS, 'rows': [list(row[:6]) for row in rows if row.deleted_at is None]},
+        'deleted_stocks': [row.id for row in rows if row.deleted_at is not None],
+    }
+    body = json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    
+    response = app.response_class(mimetype='application/json')
+    if 'gzip' in request.headers.get('Accept-Encoding', ''):
+        body = gzip.compress(body)
+        response.headers['Content-Encoding'] = 'gzip'
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.set_data(body)
+    return response
+
 # ========== QRコード機能 ==========
 
 @app.route('/inventory/qr')
@@ -903,33 +2960,159 @@ def qr_detail(stock_id):
     
     return render_template('qr/detail.html', stock=stock, history=history)
 
+# QRコード画像は内容（URLと描画設定）のハッシュをキーにメモリLRUとディスクへ保存する
+QR_BOX_SIZE = 10
+QR_BORDER = 2
+
+_qr_cache = OrderedDict()
+_qr_cache_lock = threading.Lock()
+_qr_executor = None
+_qr_executor_lock = threading.Lock()
+
+def render_qr_png(data):
+    """QRコードのPNGを生成する（プロセスプールから呼ばれる）"""
+    import qrcode
+    from io import BytesIO
+    
+    qr = qrcode.QRCode(version=1, box_size=QR_BOX_SIZE, border=QR_BORDER)
+    qr.add_data(data)
+    qr.make(fit=True)
+    
+    img = qr.make_image(fill_color='black', back_color='white')
+    img_byte_arr = BytesIO()
+    img.save(img_byte_arr, format='PNG')
+    return img_byte_arr.getvalue()
+
+def get_qr_executor():
+    global _qr_executor
+    with _qr_executor_lock:
+        if _qr_executor is None:
+            from concurrent.futures import ProcessPoolExecutor
+            from multiprocessing import get_context
+            # ジョブのプールと同じく、スレッドの動いているワーカーを fork しない
+            _qr_executor = ProcessPoolExecutor(max_workers=app.config['QR_WORKERS'], mp_context=get_context('spawn'))
+        return _qr_executor
+
+def qr_cache_key(data):
+    import hashlib
+    return hashlib.sha256(f'{QR_BOX_SIZE}:{QR_BORDER}:{data}'.encode('utf-8')).hexdigest()
+
+def qr_cache_folder():
+    folder = os.path.join(app.config['UPLOAD_FOLDER'], 'qr')
+    os.makedirs(folder, exist_ok=True)
+    return folder
+
+def qr_cache_path(key):
+    return os.path.join(qr_cache_folder(), f'{key}.png')
+
+def prune_qr_cache():
+    """ディスクのPNGを整理する（プロセスごとに一定間隔で1回）
+    
+    最後に使われてから QR_DISK_CACHE_TTL を過ぎたものと、QR_DISK_CACHE_MAX_FILES を
+    超えた分の古いものを削除する（削除した商品のPNGもここで消える）
+    """
+    cache_key = ('qr_cache_prune',)
+    if cache_get(cache_key) is not None:
+        return
+    cache_set(cache_key, True, app.config['QR_DISK_CACHE_PRUNE_INTERVAL'])
+    
+    entries = []
+    for entry in os.scandir(qr_cache_folder()):
+        try:
+            entries.append((entry.stat().st_mtime, entry.path))
+        except OSError:
+            pass
+    entries.sort(reverse=True)
+    expired_before = time.time() - app.config['QR_DISK_CACHE_TTL']
+    for idx, (mtime, path) in enumerate(entries):
+        if idx >= app.config['QR_DISK_CACHE_MAX_FILES'] or mtime < expired_before:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+def qr_cache_remember(key, png):
+    with _qr_cache_lock:
+        _qr_cache[key] = png
+        _qr_cache.move_to_end(key)
+        while len(_qr_cache) > app.config['QR_CACHE_SIZE']:
+            _qr_cache.popitem(last=False)
+
+def qr_cache_get(key):
+    with _qr_cache_lock:
+        png = _qr_cache.get(key)
+        if png is not None:
+            _qr_cache.move_to_end(key)
+            return png
+    
+    path = qr_cache_path(key)
+    try:
+        with open(path, 'rb') as f:
+            png = f.read()
+        # 最後に使われた日時として更新日時を進める（prune_qr_cache で使われているものを残す）
+        os.utime(path)
+    except OSError:
+        return None
+    qr_cache_remember(key, png)
+    return png
+
+def qr_cache_put(key, png):
+    qr_cache_remember(key, png)
+    path = qr_cache_path(key)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(png)
+    os.replace(tmp_path, path)
+
+def get_qr_pngs(datas):
+    """QRコードのPNGをまとめて取得する（未キャッシュ分はプロセスプールで並列生成）
+    
+    Returns:
+        dict: data → PNGバイト列
+    """
+    prune_qr_cache()
+    
+    result = {}
+    missing = []
+    for data in dict.fromkeys(datas):
+        png = qr_cache_get(qr_cache_key(data))
+        if png is None:
+            missing.append(data)
+        else:
+            result[data] = png
+    
+    if len(missing) == 1:
+        pngs = [render_qr_png(missing[0])]
+    elif missing:
+        workers = app.config['QR_WORKERS']
+        chunksize = max(1, len(missing) // (workers * 4))
+        pngs = list(get_qr_executor().map(render_qr_png, missing, chunksize=chunksize))
+    else:
+        pngs = []
+    
+    for data, png in zip(missing, pngs):
+        qr_cache_put(qr_cache_key(data), png)
+        result[data] = png
+    return result
+
+def qr_data_uri(png):
+    import base64
+    return f'data:image/png;base64,{base64.b64encode(png).decode()}'
+
 @app.route('/api/qr/generate/<int:stock_id>')
 def api_qr_generate(stock_id):
     if not current_user.is_authenticated:
         return jsonify({'success': False, 'message': 'ログインしてください'}), 401
     
     try:
-        import qrcode
-        from io import BytesIO
-        import base64
-        
         stock = Stock.query.get_or_404(stock_id)
         
         qr_url = url_for('qr_detail', stock_id=stock_id, _external=True)
-        qr = qrcode.QRCode(version=1, box_size=10, border=2)
-        qr.add_data(qr_url)
-        qr.make(fit=True)
-        
-        img = qr.make_image(fill_color='black', back_color='white')
-        img_byte_arr = BytesIO()
-        img.save(img_byte_arr, format='PNG')
-        img_byte_arr.seek(0)
-        
-        img_base64 = base64.b64encode(img_byte_arr.getvalue()).decode()
+        png = get_qr_pngs([qr_url])[qr_url]
         
         return jsonify({
             'success': True,
-            'qr_code': f'data:image/png;base64,{img_base64}',
+            'qr_code': qr_data_uri(png),
             'stock_id': stock_id,
             'group_name': stock.group.name if stock.group else '-',
             'product_name': stock.product_name
@@ -939,6 +3122,132 @@ def api_qr_generate(stock_id):
         error_msg = traceback.format_exc()
         return jsonify({'success': False, 'message': str(e), 'traceback': error_msg}), 500
 
+@app.route('/api/qr/generate', methods=['POST'])
+def api_qr_generate_batch():
+    if not current_user.is_authenticated:
+        return jsonify({'success': False, 'message': 'ログインしてください'}), 401
+    
+    data = request.get_json(silent=True) or {}
+    try:
+        stock_ids = [int(stock_id) for stock_id in data.get('ids', [])]
+    except (ValueError, TypeError):
+        return jsonify({'success': False, 'message': 'IDが正しくありません'}), 400
+    if len(stock_ids) > app.config['QR_BATCH_LIMIT']:
+        return jsonify({'success': False, 'message': f'一度に生成できるのは{app.config["QR_BATCH_LIMIT"]}件までです'}), 400
+    
+    try:
+        stocks = {
+            stock.id: stock
+            for stock in Stock.query.options(joinedload(Stock.group)).filter(Stock.id.in_(stock_ids))
+        }
+        urls = {stock_id: url_for('qr_detail', stock_id=stock_id, _external=True) for stock_id in stocks}
+        pngs = get_qr_pngs(list(urls.values()))
+        
+        # リクエストの ids と同じ順・同じ件数で返す（見つからないIDは qr_code が null）
+        codes = []
+        for stock_id in stock_ids:
+            stock = stocks.get(stock_id)
+            if stock is None:
+                codes.append({'stock_id': stock_id, 'qr_code': None, 'message': '在庫が見つかりません'})
+                continue
+            codes.append({
+                'stock_id': stock_id,
+                'qr_code': qr_data_uri(pngs[urls[stock_id]]),
+                'group_name': stock.group.name if stock.group else '-',
+                'product_name': stock.product_name
+            })
+        
+        return jsonify({'success': True, 'codes': codes})
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'エラー: {str(e)}'}), 500
+
+@app.route('/inventory/labels')
+def inventory_labels():
+    """QRラベルシート（PDF / SVG）をページごとにストリーミングで返す
+    
+    ids: 在庫IDのカンマ区切り、または group: グループID
+    cols, rows: 1ページのラベルの列数・行数
+    """
+    if not current_user.is_authenticated:
+        return redirect(url_for('login_page'))
+    
+    from utils.labels import iter_pdf_label_sheet, iter_svg_label_sheet
+    
+    fmt = request.args.get('format', 'pdf')
+    cols = min(max(request.args.get('cols', 3, type=int), 1), 10)
+    rows = min(max(request.args.get('rows', 8, type=int), 1), 20)
+    stock_ids = [int(id) for id in request.args.get('ids', '').split(',') if id.isdigit()]
+    group_id = request.args.get('group', type=int)
+    
+    if fmt not in ('pdf', 'svg'):
+        flash('出力形式が正しくありません', 'error')
+        return redirect(url_for('inventory_list'))
+    if not stock_ids and not group_id:
+        flash('商品を選択してください', 'error')
+        return redirect(url_for('inventory_list'))
+    
+    statement = db.select(Stock.id, ItemGroup.name, Stock.product_name).outerjoin(
+        ItemGroup, Stock.group_id == ItemGroup.id
+    ).where(Stock.deleted_at.is_(None)).order_by(Stock.group_id, Stock.id)
+    if stock_ids:
+        statement = statement.where(Stock.id.in_(stock_ids))
+    if group_id:
+        statement = statement.where(Stock.group_id == group_id)
+    
+    def labels():
+        for chunk in iter_export_chunks(statement, lambda row: (
+            url_for('qr_detail', stock_id=row[0], _external=True), row[1] or '-', row[2]
+        )):
+            yield from chunk
+    
+    download_name = f'labels_{datetime.now().strftime("%Y%m%d_%H%M%S")}.{fmt}'
+    if fmt == 'svg':
+        total = db.session.execute(db.select(db.func.count()).select_from(statement.order_by(None).subquery())).scalar()
+        body = iter_svg_label_sheet(labels(), total, cols, rows)
+        mimetype = 'image/svg+xml'
+    else:
+        body = iter_pdf_label_sheet(labels(), cols, rows)
+        mimetype = 'application/pdf'
+    
+    response = app.response_class(stream_with_context(body), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'inline; filename={download_name}'
+    return response
+
+# ========== 定期実行コマンド ==========
+@app.cli.command('send-mail')
+def send_mail_command():
+    """送信時刻になった送信待ちメールを送る（送信スレッドの再起動前に残ったメールの再送用）"""
+    from utils.notifications import process_mail_outbox, MAIL_BATCH_SIZE
+    while process_mail_outbox() == MAIL_BATCH_SIZE:
+        pass
+
+@app.cli.command('rollup-history')
+def rollup_history_command():
+    """未集計の履歴をすべて日次集計に反映する（導入時の集計や、HISTORY_ROLLUP_INTERVAL=0 で運用する場合の定期実行）
+    
+    crontabで定期実行:
+        * * * * * cd /path/to/app && flask rollup-history
+    """
+    print(f'{refresh_history_rollup()}件の履歴を集計しました')
+
+@app.cli.command('send-daily-summary')
+def send_daily_summary_command():
+    """日次サマリーメールを送る"""
+    from utils.notifications import send_daily_summary
+    send_daily_summary()
+
+@app.cli.command('send-weekly-report')
+def send_weekly_report_command():
+    """週次レポートメールを送る"""
+    from utils.notifications import send_weekly_report
+    send_weekly_report()
+
+@app.cli.command('check-low-stock')
+def check_low_stock_command():
+    """未通知の在庫アラートをまとめて通知する"""
+    from utils.notifications import check_and_notify_low_stock
+    print(f'{check_and_notify_low_stock()}件の在庫不足を通知しました')
+
 if __name__ == '__main__':
     print('='*50)
     print('  在庫管理システム')
@@ -25,18 +25,64 @@ class Config:
     UPLOAD_FOLDER = 'uploads'
     ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'pdf', 'xlsx', 'csv'}
     
+    # Excel出力・アップロード
+    EXPORT_CHUNK_SIZE = 1000
+    IMPORT_CHUNK_SIZE = 1000
+    IMPORT_PREVIEW_TIMEOUT = 1800  # 取込プレビューの保持秒数
+    
+    # バックグラウンドジョブ（取込・出力）
+    JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+    JOB_STALE_TIMEOUT = 1800  # 秒。進捗がこの間更新されない実行中のジョブは中断されたものとして失敗にする
+    JOB_RESULT_TTL = 86400  # 秒。出力ファイル・アップロードされたファイルの保持期間
+    JOB_CLEANUP_INTERVAL = 600  # 秒。中断されたジョブと期限切れのファイルを整理する間隔
+    
+    # QRコード
+    QR_WORKERS = int(os.environ.get('QR_WORKERS', os.cpu_count() or 2))
+    QR_CACHE_SIZE = 2000  # メモリに保持するPNGの件数
+    QR_DISK_CACHE_TTL = 30 * 24 * 3600  # 秒。最後に使われてからこの期間を過ぎたPNGはディスクから削除する
+    QR_DISK_CACHE_MAX_FILES = 50000  # ディスクに保持するPNGの件数（超えた分は使われていない順に削除する）
+    QR_DISK_CACHE_PRUNE_INTERVAL = 3600  # 秒。ディスクのPNGを整理する間隔
+    QR_BATCH_LIMIT = 1000
+    
+    # ライブ更新（SSE）
+    # 複数ワーカーで動かす場合は Redis の URL を指定する（未指定時は REDIS_URL、どちらも無ければプロセス内でのみ配信）
+    EVENT_REDIS_URL = os.environ.get('EVENT_REDIS_URL') or os.environ.get('REDIS_URL')
+    SSE_HEARTBEAT = 15  # 秒。プロキシに接続を切られないよう定期的にコメント行を送る
+    # 秒。1本の接続はこの秒数で終了し、ブラウザが続きから再接続する（gunicorn の --timeout より短くする）
+    SSE_STREAM_TIMEOUT = int(os.environ.get('SSE_STREAM_TIMEOUT', 25))
+    # ワーカープロセスごとに同時に開ける接続数。gunicorn の --threads より小さくし、通常のリクエスト用のスレッドを残す
+    # （接続中のスレッドはイベントを待って止まっているだけなので、スレッド数を多めにしてよい）
+    SSE_MAX_STREAMS = int(os.environ.get('SSE_MAX_STREAMS', 12))
+    
+    # 冪等キー（端末の再送による二重登録の防止）
+    IDEMPOTENCY_KEY_TTL = 86400  # 秒。同じキーの再送に最初の結果を返す期間
+    IDEMPOTENCY_PURGE_INTERVAL = 600  # 秒。期限切れのキーを削除する間隔
+    
+    # 端末向け差分同期
+    SYNC_PAGE_SIZE = 1000
+    SYNC_SAFETY_LAG = 2  # 秒。コミット待ちの更新を取りこぼさないよう、直近の更新は次回の同期で返す
+    
+    # 履歴の日次集計
+    # 秒。バックグラウンドのスレッドで未集計の履歴を反映する間隔（0 ならスレッドを起動せず、flask rollup-history を定期実行する）
+    HISTORY_ROLLUP_INTERVAL = int(os.environ.get('HISTORY_ROLLUP_INTERVAL', 60))
+    HISTORY_ROLLUP_BATCH_SIZE = 50000  # 1回のトランザクションで集計する履歴の件数
+    HISTORY_ROLLUP_GAP_TIMEOUT = 3600  # 秒。集計時に見えなかった履歴IDをコミット待ちとして待つ時間（過ぎたら欠番とみなす）
+    
     # ページネーション
     ITEMS_PER_PAGE = 50
     HISTORY_PER_PAGE = 100
+    WAREHOUSE_COMPLETED_PER_PAGE = 50
+    WAREHOUSE_COMPLETED_DAYS = 7  # 倉庫確認画面に表示する出庫完了の期間
     
     # キャッシュ
     CACHE_TYPE = 'simple'
     CACHE_DEFAULT_TIMEOUT = 300
+    HISTORY_COUNT_CACHE_TIMEOUT = 60
     
     # メール設定（本番用）
     MAIL_SERVER = os.environ.get('MAIL_SERVER', 'smtp.gmail.com')
     MAIL_PORT = int(os.environ.get('MAIL_PORT', 587))
-    MAIL_USE_TLS = True
+    MAIL_USE_TLS = os.environ.get('MAIL_USE_TLS', 'true').lower() != 'false'
     MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
     MAIL_DEFAULT_SENDER = os.environ.get('MAIL_DEFAULT_SENDER')
@@ -0,0 +1,111 @@
+import os
+import socketserver
+import tempfile
+import threading
+
+import pytest
+
+# app.py はインポート時にDB接続先を決めるため、先にテスト用のDBを指定する
+_db_fd, _db_path = tempfile.mkstemp(suffix='.db')
+os.environ['DATABASE_URL'] = f'sqlite:///{_db_path}'
+
+from app import app as flask_app, db, init_db, User, ItemGroup, Stock  # noqa: E402
+
+
+@pytest.fixture
+def app(monkeypatch):
+    from utils import notifications
+    # メールの送信スレッドは起動しない（送信は process_mail_outbox を直接呼んで確かめる）
+    monkeypatch.setattr(notifications, 'start_mail_sender', lambda app: None)
+    flask_app.config['TESTING'] = True
+    with flask_app.app_context():
+        db.drop_all()
+        # 検索インデックス（FTS5 の仮想テーブル）はモデルに含まれないため、ここで作り直す
+        db.session.execute(db.text('DROP TABLE IF EXISTS stock_search'))
+        db.session.commit()
+        init_db()
+        yield flask_app
+        db.session.remove()
+
+
+def login(client):
+    client.post('/auth/login', data={'email': 'admin@example.com', 'password': 'Admin@12345'})
+    return client
+
+
+@pytest.fixture
+def client(app):
+    return login(app.test_client())
+
+
+@pytest.fixture
+def stock(app):
+    group = ItemGroup(name='テストグループ')
+    db.session.add(group)
+    db.session.flush()
+    stock = Stock(product_name='テスト商品', quantity=50, group_id=group.id, supplier='テスト仕入先')
+    db.session.add(stock)
+    db.session.commit()
+    return stock
+
+
+class DebuggingSMTPHandler(socketserver.StreamRequestHandler):
+    """受け取ったメールを記録するだけのSMTPサーバー（refused の宛先は受け付けない）"""
+
+    def reply(self, line):
+        self.wfile.write(f'{line}\r\n'.encode())
+
+    def handle(self):
+        self.reply('220 localhost テスト用SMTPサーバー')
+        recipients = []
+        while True:
+            line = self.rfile.readline().decode().rstrip('\r\n')
+            command = line[:4].upper()
+            if not line or command == 'QUIT':
+                self.reply('221 Bye')
+                return
+            if command in ('EHLO', 'HELO'):
+                self.reply('250 localhost')
+            elif command == 'RCPT':
+                address = line.split(':', 1)[1].strip().strip('<>')
+                if address in self.server.refused:
+                    self.reply('550 宛先がありません')
+                else:
+                    recipients.append(address)
+                    self.reply('250 OK')
+            elif command == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                data = []
+                while (line := self.rfile.readline()) not in (b'.\r\n', b''):
+                    data.append(line)
+                self.server.messages.append((recipients, b''.join(data)))
+                recipients = []
+                self.reply('250 OK')
+            elif command == 'RSET':
+                recipients = []
+                self.reply('250 OK')
+            else:
+                self.reply('250 OK')
+
+
+@pytest.fixture
+def smtp_server(app, monkeypatch):
+    """ローカルのデバッグ用SMTPサーバーを起動し、メールの送信先にする"""
+    server = socketserver.ThreadingTCPServer(('localhost', 0), DebuggingSMTPHandler)
+    server.daemon_threads = True
+    server.messages = []
+    server.refused = set()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setitem(app.config, 'MAIL_SERVER', 'localhost')
+    monkeypatch.setitem(app.config, 'MAIL_PORT', server.server_address[1])
+    monkeypatch.setitem(app.config, 'MAIL_USE_TLS', False)
+    monkeypatch.setitem(app.config, 'MAIL_USERNAME', None)
+    monkeypatch.setitem(app.config, 'MAIL_DEFAULT_SENDER', 'inventory@example.com')
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def pytest_sessionfinish(session, exitstatus):
+    os.close(_db_fd)
+    os.unlink(_db_path)
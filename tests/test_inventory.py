@@ -0,0 +1,839 @@
+import os
+import threading
+from datetime import date, datetime, timedelta
+
+import pytest
+
+from app import (
+    db, ItemGroup, Job, MailOutbox, Notification, Stock, StockAlert, StockHistory, OutboundOrder, HistoryDaily, User, WAREHOUSE_CHANNEL,
+    adjust_stock_quantity, apply_stock_search, cache_clear, cache_generation, cleanup_jobs, encode_cursor, get_event_broker, get_group_summary, get_stock_alert_executor, history_totals,
+    refresh_history_rollup
+)
+from conftest import login
+
+
+def test_outbound_reserves_stock(client, stock):
+    client.post('/outbound/new', data={'group_id': stock.group_id, 'stock_id': stock.id, 'quantity': 20, 'destination': '出荷先A'})
+
+    db.session.expire_all()
+    updated = db.session.get(Stock, stock.id)
+    assert updated.quantity == 50
+    assert updated.reserved_quantity == 20
+    assert updated.available_quantity == 30
+    assert OutboundOrder.query.count() == 1
+
+
+def test_warehouse_complete_consumes_reservation(client, stock):
+    client.post('/outbound/new', data={'group_id': stock.group_id, 'stock_id': stock.id, 'quantity': 20, 'destination': '出荷先A'})
+    order_id = OutboundOrder.query.one().id
+
+    client.post(f'/warehouse/{order_id}/confirm')
+    assert client.post(f'/warehouse/{order_id}/complete').json['success']
+    assert not client.post(f'/warehouse/{order_id}/complete').json['success']
+
+    db.session.expire_all()
+    updated = db.session.get(Stock, stock.id)
+    assert (updated.quantity, updated.reserved_quantity) == (30, 0)
+    assert StockHistory.query.filter_by(reference_id=order_id).one().quantity_change == -20
+
+    assert client.post(f'/warehouse/{order_id}/revert').json['success']
+
+    db.session.expire_all()
+    updated = db.session.get(Stock, stock.id)
+    assert (updated.quantity, updated.reserved_quantity) == (50, 20)
+
+
+def test_outbound_rejects_shortage(client, stock):
+    client.post('/outbound/new', data={'group_id': stock.group_id, 'stock_id': stock.id, 'quantity': 51, 'destination': '出荷先A'})
+
+    db.session.expire_all()
+    assert db.session.get(Stock, stock.id).quantity == 50
+    assert OutboundOrder.query.count() == 0
+    assert StockHistory.query.count() == 0
+
+
+def test_outbound_cancel_restores_stock_once(client, stock):
+    client.post('/outbound/new', data={'group_id': stock.group_id, 'stock_id': stock.id, 'quantity': 10, 'destination': '出荷先A'})
+    order_id = OutboundOrder.query.one().id
+
+    client.post(f'/outbound/{order_id}/cancel')
+    client.post(f'/outbound/{order_id}/cancel')
+
+    db.session.expire_all()
+    updated = db.session.get(Stock, stock.id)
+    assert (updated.quantity, updated.reserved_quantity) == (50, 0)
+
+
+def test_concurrent_outbound_never_oversells(app, stock):
+    """同じ商品に多数のスレッドから同時に出庫しても在庫を超えて引き当てない"""
+    threads_count = 20
+    orders_per_thread = 5
+    barrier = threading.Barrier(threads_count)
+    errors = []
+    form = {'group_id': stock.group_id, 'stock_id': stock.id, 'quantity': 1, 'destination': '出荷先'}
+
+    def worker():
+        client = login(app.test_client())
+        barrier.wait()
+        for _ in range(orders_per_thread):
+            response = client.post('/outbound/new', data=form)
+            if response.status_code != 302:
+                errors.append(response.status_code)
+
+    threads = [threading.Thread(target=worker) for _ in range(threads_count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    db.session.expire_all()
+    assert not errors
+    updated = db.session.get(Stock, stock.id)
+    assert (updated.quantity, updated.reserved_quantity) == (50, 50)
+    assert OutboundOrder.query.count() == 50
+
+
+def test_concurrent_adjust_stock_quantity(app, stock):
+    results = []
+    lock = threading.Lock()
+    stock_id = stock.id
+
+    def worker():
+        with app.app_context():
+            for _ in range(10):
+                ok = adjust_stock_quantity(stock_id, -3)
+                db.session.commit()
+                with lock:
+                    results.append(ok)
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    db.session.expire_all()
+    assert results.count(True) == 16
+    assert db.session.get(Stock, stock.id).quantity == 2
+
+
+def test_outbound_batch_is_all_or_nothing(client, stock):
+    other = Stock(product_name='別商品', quantity=5, group_id=stock.group_id)
+    db.session.add(other)
+    db.session.commit()
+
+    response = client.post('/outbound/api/batch', json={
+        'destination': '出荷先B',
+        'lines': [{'stock_id': stock.id, 'quantity': 10}, {'stock_id': other.id, 'quantity': 6}]
+    })
+    assert response.status_code == 409
+    assert response.json['shortages'] == [{'stock_id': other.id, 'required': 6, 'available': 5}]
+
+    response = client.post('/outbound/api/batch', json={
+        'destination': '出荷先B',
+        'lines': [{'stock_id': stock.id, 'quantity': 10}, {'stock_id': other.id, 'quantity': 5}, {'stock_id': stock.id, 'quantity': 1}]
+    })
+    assert response.json['success']
+    assert len(response.json['order_ids']) == 3
+
+    db.session.expire_all()
+    assert db.session.get(Stock, stock.id).available_quantity == 39
+    assert db.session.get(Stock, other.id).available_quantity == 0
+    assert OutboundOrder.query.filter_by(shipment_id=response.json['shipment_id']).count() == 3
+
+
+def test_warehouse_bulk_transitions(client, stock):
+    response = client.post('/outbound/api/batch', json={
+        'destination': '出荷先C',
+        'lines': [{'stock_id': stock.id, 'quantity': 10}, {'stock_id': stock.id, 'quantity': 5}]
+    })
+    first, second = response.json['order_ids']
+    client.post(f'/warehouse/{first}/confirm')
+
+    response = client.post('/warehouse/api/bulk', json={'order_ids': [first, second, 9999], 'status': 'completed'})
+    assert [result['success'] for result in response.json['results']] == [True, False, False]
+
+    response = client.post('/warehouse/api/bulk', json={'order_ids': [second], 'status': 'warehouse_confirmed'})
+    assert response.json['results'][0]['success']
+
+    db.session.expire_all()
+    updated = db.session.get(Stock, stock.id)
+    assert (updated.quantity, updated.reserved_quantity) == (40, 5)
+    assert db.session.get(OutboundOrder, first).status == 'completed'
+    assert db.session.get(OutboundOrder, second).status == 'warehouse_confirmed'
+    assert StockHistory.query.filter_by(reference_id=first).one().quantity_change == -10
+
+    # 完了の取り消しと確認を1回の呼び出しで行う（遷移元の状態ごとにUPDATE）
+    client.post('/warehouse/api/bulk', json={'order_ids': [second], 'status': 'pending'})
+    response = client.post('/warehouse/api/bulk', json={'order_ids': [first, second], 'status': 'warehouse_confirmed'})
+    assert all(result['success'] for result in response.json['results'])
+
+    db.session.expire_all()
+    updated = db.session.get(Stock, stock.id)
+    assert (updated.quantity, updated.reserved_quantity) == (50, 15)
+
+
+def test_outbound_changes_are_published(client, stock):
+    with get_event_broker().subscribe(WAREHOUSE_CHANNEL) as subscription:
+        client.post('/outbound/new', data={'group_id': stock.group_id, 'stock_id': stock.id, 'quantity': 3, 'destination': '出荷先D'})
+        event = subscription.get(timeout=1)
+        assert event['action'] == 'updated'
+        order = event['orders'][0]
+        assert (order['status'], order['product_name'], order['group_name']) == ('pending', 'テスト商品', 'テストグループ')
+
+        client.post(f"/warehouse/{order['id']}/confirm")
+        assert subscription.get(timeout=1)['orders'][0]['status'] == 'warehouse_confirmed'
+
+        client.post(f"/warehouse/{order['id']}/revert")
+        client.post(f"/outbound/{order['id']}/cancel")
+        subscription.get(timeout=1)
+        assert subscription.get(timeout=1) == {'action': 'removed', 'orders': [{'id': order['id']}]}
+
+
+def test_retried_outbound_is_applied_once(client, stock):
+    form = {'group_id': stock.group_id, 'stock_id': stock.id, 'quantity': 10, 'destination': '出荷先E', 'idempotency_key': 'scanner-1'}
+    first = client.post('/outbound/new', data=form)
+    retry = client.post('/outbound/new', data=form)
+    assert retry.status_code == 302 and retry.location == first.location
+    assert retry.headers['Idempotent-Replayed'] == 'true'
+
+    lines = {'destination': '出荷先F', 'lines': [{'stock_id': stock.id, 'quantity': 5}]}
+    first = client.post('/outbound/api/batch', json=lines, headers={'Idempotency-Key': 'batch-1'})
+    retry = client.post('/outbound/api/batch', json=lines, headers={'Idempotency-Key': 'batch-1'})
+    assert retry.json == first.json
+
+    db.session.expire_all()
+    assert db.session.get(Stock, stock.id).reserved_quantity == 15
+    assert OutboundOrder.query.count() == 2
+
+
+def test_sync_returns_changes_since_watermark(client, stock, monkeypatch):
+    import gzip
+    import json
+
+    monkeypatch.setitem(client.application.config, 'SYNC_SAFETY_LAG', 0)
+    other = Stock(product_name='削除する商品', quantity=1, group_id=stock.group_id)
+    db.session.add(other)
+    db.session.commit()
+    other_id = other.id
+
+    response = client.get('/api/sync', headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    payload = json.loads(gzip.decompress(response.data))
+    assert {row[0] for row in payload['stocks']['rows']} == {stock.id, other_id}
+    assert len(payload['groups']['rows']) == 1
+
+    client.post('/inbound/new', data={'group_id': stock.group_id, 'product_name': 'テスト商品', 'quantity': 5, 'supplier': 'テスト仕入先'})
+    client.post(f'/inventory/{other_id}/delete')
+
+    payload = client.get('/api/sync', query_string={'since': payload['watermark']}).json
+    stocks = [dict(zip(payload['stocks']['fields'], row)) for row in payload['stocks']['rows']]
+    assert [(row['id'], row['quantity']) for row in stocks] == [(stock.id, 55)]
+    assert payload['deleted_stocks'] == [other_id]
+    assert payload['groups']['rows'] == []
+    assert not payload['has_more']
+
+
+def test_threshold_crossings_raise_alerts(client, stock):
+    stock.min_stock = 10
+    db.session.commit()
+
+    client.post(f'/inventory/{stock.id}/edit', data={'product_name': 'テスト商品', 'quantity': 12, 'group_id': stock.group_id, 'min_stock': 10})
+    client.post('/outbound/new', data={'group_id': stock.group_id, 'stock_id': stock.id, 'quantity': 12, 'destination': '出荷先G'})
+    order_id = OutboundOrder.query.one().id
+    client.post(f'/warehouse/{order_id}/confirm')
+    client.post(f'/warehouse/{order_id}/complete')
+    get_stock_alert_executor().submit(lambda: None).result()
+
+    assert [alert.alert_type for alert in StockAlert.query.order_by(StockAlert.id)] == ['zero']
+
+    client.post('/inbound/new', data={'group_id': stock.group_id, 'product_name': 'テスト商品', 'quantity': 11, 'supplier': 'テスト仕入先'})
+    client.post(f'/inventory/{stock.id}/edit', data={'product_name': 'テスト商品', 'quantity': 9, 'group_id': stock.group_id, 'min_stock': 10})
+    get_stock_alert_executor().submit(lambda: None).result()
+
+    alerts = StockAlert.query.order_by(StockAlert.id).all()
+    assert [(alert.alert_type, alert.quantity, alert.threshold) for alert in alerts] == [('zero', 0, 0), ('low', 9, 10)]
+
+
+def test_history_rollup_is_incremental(client, stock):
+    client.post('/inbound/new', data={'group_id': stock.group_id, 'product_name': 'テスト商品', 'quantity': 5, 'supplier': 'テスト仕入先'})
+    client.post('/outbound/new', data={'group_id': stock.group_id, 'stock_id': stock.id, 'quantity': 3, 'destination': '出荷先H'})
+    order_id = OutboundOrder.query.one().id
+    client.post(f'/warehouse/{order_id}/confirm')
+    client.post(f'/warehouse/{order_id}/complete')
+
+    refresh_history_rollup()
+    refresh_history_rollup()
+    assert history_totals(date.today() - timedelta(days=1)) == {'inbound': (1, 5), 'outbound': (1, -3)}
+
+    client.post('/inbound/new', data={'group_id': stock.group_id, 'product_name': 'テスト商品', 'quantity': 2, 'supplier': 'テスト仕入先'})
+    refresh_history_rollup()
+    totals = history_totals(date.today() - timedelta(days=1), by_group=True)
+    assert totals[(stock.group_id, 'inbound')] == (2, 7)
+    assert HistoryDaily.query.count() == 2
+
+
+def test_dashboard_only_reads_history_rollup(client, stock, monkeypatch):
+    import app as app_module
+    started = []
+    monkeypatch.setattr(app_module, 'start_history_rollup', lambda: started.append(True))
+    client.post('/inbound/new', data={'group_id': stock.group_id, 'product_name': 'テスト商品', 'quantity': 5, 'supplier': 'テスト仕入先'})
+
+    # 画面の表示では集計せず、バックグラウンドの集計を起動するだけ
+    assert client.get('/dashboard').status_code == 200
+    assert started and HistoryDaily.query.count() == 0
+
+    # バックグラウンドの集計（1回分）の後は、日次集計を表示する
+    class Stop(Exception):
+        pass
+
+    def stop(seconds):
+        raise Stop
+
+    with monkeypatch.context() as patch:
+        patch.setattr(app_module.time, 'sleep', stop)
+        with pytest.raises(Stop):
+            app_module.run_history_rollup()
+    assert HistoryDaily.query.count() == 1
+    assert client.get('/dashboard').status_code == 200
+
+
+def test_history_rollup_counts_rows_committed_late(client, stock):
+    for quantity in (1, 2, 3):
+        client.post('/inbound/new', data={'group_id': stock.group_id, 'product_name': 'テスト商品', 'quantity': quantity, 'supplier': 'テスト仕入先'})
+    # 2件目の登録がまだコミットされていない状態を再現する
+    late = StockHistory.query.order_by(StockHistory.id).all()[1]
+    values = {column.name: getattr(late, column.name) for column in StockHistory.__table__.columns}
+    db.session.execute(db.delete(StockHistory).where(StockHistory.id == late.id))
+    db.session.commit()
+
+    assert refresh_history_rollup(limit=1) == 1
+    refresh_history_rollup()
+    assert history_totals(date.today() - timedelta(days=1)) == {'inbound': (2, 4)}
+
+    db.session.execute(db.insert(StockHistory), [values])
+    db.session.commit()
+    refresh_history_rollup()
+    refresh_history_rollup()
+    assert history_totals(date.today() - timedelta(days=1)) == {'inbound': (3, 6)}
+
+
+def test_group_summary_cache_follows_other_workers(app, stock, monkeypatch):
+    import app as app_module
+
+    assert get_group_summary()[0]['total_quantity'] == 50
+
+    # 別のワーカーでの更新を再現する（このプロセスのキャッシュは破棄しない）
+    monkeypatch.setattr(app_module, 'cache_clear', lambda namespace: None)
+    adjust_stock_quantity(stock.id, 20)
+    db.session.commit()
+
+    assert get_group_summary()[0]['total_quantity'] == 70
+
+
+def test_cleanup_fails_interrupted_jobs_and_expires_results(app, tmp_path, monkeypatch):
+    monkeypatch.setitem(app.config, 'UPLOAD_FOLDER', str(tmp_path))
+    cache_clear('job_cleanup')
+    old = datetime.utcnow() - timedelta(seconds=app.config['JOB_RESULT_TTL'] + 60)
+    result_path = tmp_path / 'jobs' / 'old.xlsx'
+    result_path.parent.mkdir()
+    result_path.write_bytes(b'xlsx')
+    os.utime(result_path, (old.timestamp(), old.timestamp()))
+    db.session.add_all([
+        Job(id='interrupted', job_type='import', status='running', created_at=old, heartbeat_at=old),
+        Job(id='alive', job_type='import', status='running', heartbeat_at=datetime.utcnow()),
+        Job(id='waiting', job_type='import', status='queued', created_at=old),
+        Job(id='finished', job_type='export', status='completed', result_path=str(result_path), finished_at=old),
+    ])
+    db.session.commit()
+
+    cleanup_jobs()
+
+    assert db.session.get(Job, 'interrupted').status == 'failed'
+    assert db.session.get(Job, 'alive').status == 'running'
+    assert db.session.get(Job, 'waiting').status == 'queued'
+    assert db.session.get(Job, 'finished').result_path is None
+    assert not result_path.exists()
+
+
+def test_import_preview_follows_stock_changes(client, stock, monkeypatch):
+    import app as app_module
+    from io import BytesIO
+    from openpyxl import Workbook
+
+    workbook = Workbook()
+    workbook.active.append(['ID', 'グループ', '商品名', '仕入先', '数量'])
+    workbook.active.append([stock.id, '', '', '', 60])
+    workbook.active.append([99999, '', '', '', 1])
+    content = BytesIO()
+    workbook.save(content)
+
+    def preview():
+        data = {'file': (BytesIO(content.getvalue()), 'stock.xlsx')}
+        return client.post('/inventory/import/preview', data=data, content_type='multipart/form-data').get_json()
+
+    first = preview()
+    assert first['changed_count'] == 1 and first['unknown_ids'] == [99999]
+
+    adjust_stock_quantity(stock.id, 10)
+    db.session.commit()
+    second = preview()
+    assert second['changed_count'] == 0 and second['token'] != first['token']
+
+    monkeypatch.setattr(app_module, 'submit_job', lambda *args, **kwargs: Job(id='queued'))
+    response = client.post('/inventory/import/confirm', json={'token': second['token']}).get_json()
+    assert '99999' in response['message']
+
+
+def test_quantity_cannot_drop_below_reserved(client, stock):
+    client.post('/outbound/new', data={'group_id': stock.group_id, 'stock_id': stock.id, 'quantity': 20, 'destination': '出荷先I'})
+
+    client.post(f'/inventory/{stock.id}/edit', data={'product_name': 'テスト商品', 'quantity': 10, 'group_id': stock.group_id})
+    db.session.refresh(stock)
+    assert (stock.quantity, stock.available_quantity) == (50, 30)
+
+    order_id = OutboundOrder.query.one().id
+    client.post(f'/warehouse/{order_id}/confirm')
+    client.post(f'/warehouse/{order_id}/complete')
+    client.post(f'/warehouse/{order_id}/revert')
+    refresh_history_rollup()
+    assert history_totals(date.today() - timedelta(days=1)) == {'outbound': (1, -20), 'adjustment': (1, 20)}
+
+
+def test_warehouse_bulk_completes_orders_that_fit(client, stock):
+    response = client.post('/outbound/api/batch', json={
+        'destination': '出荷先J',
+        'lines': [{'stock_id': stock.id, 'quantity': 10}, {'stock_id': stock.id, 'quantity': 5}]
+    })
+    first, second = response.json['order_ids']
+    client.post('/warehouse/api/bulk', json={'order_ids': [first, second], 'status': 'warehouse_confirmed'})
+    # 引当より在庫が少ない既存データ（両方は出庫できない）
+    db.session.execute(db.update(Stock).where(Stock.id == stock.id).values(quantity=12))
+    db.session.commit()
+
+    response = client.post('/warehouse/api/bulk', json={'order_ids': [first, second], 'status': 'completed'})
+    assert [result['success'] for result in response.json['results']] == [True, False]
+
+    db.session.expire_all()
+    updated = db.session.get(Stock, stock.id)
+    assert (updated.quantity, updated.reserved_quantity) == (2, 5)
+    assert db.session.get(OutboundOrder, second).status == 'warehouse_confirmed'
+
+
+def test_event_stream_resumes_after_reconnect(client, stock, monkeypatch):
+    monkeypatch.setitem(client.application.config, 'SSE_STREAM_TIMEOUT', 0.2)
+
+    def read_stream(**headers):
+        response = client.get('/warehouse/events', headers=headers)
+        body = response.get_data(as_text=True)
+        response.close()
+        return body
+
+    first = read_stream()
+    last_event_id = first.split('id: ', 1)[1].split('\n', 1)[0]
+
+    # 接続が切れている間の登録も、再接続時に届く
+    client.post('/outbound/new', data={'group_id': stock.group_id, 'stock_id': stock.id, 'quantity': 4, 'destination': '出荷先K'})
+    second = read_stream(**{'Last-Event-ID': last_event_id})
+    assert '出荷先K' in second and 'event: reload' not in second
+
+
+def test_event_stream_releases_slot_when_subscribe_fails(client, monkeypatch):
+    import app as app_module
+    monkeypatch.setitem(client.application.config, 'SSE_STREAM_TIMEOUT', 0.2)
+    monkeypatch.setattr(app_module, '_event_stream_slots', threading.BoundedSemaphore(1))
+
+    class BrokenBroker:
+        def subscribe(self, channel, last_id=None):
+            raise ConnectionError('接続できません')
+
+    with monkeypatch.context() as patch:
+        patch.setattr(app_module, 'get_event_broker', lambda: BrokenBroker())
+        assert client.get('/warehouse/events').status_code == 503
+
+    # 失敗した接続の枠は解放され、次の接続を受け付ける
+    response = client.get('/warehouse/events')
+    assert response.status_code == 200
+    assert 'event: ready' in response.get_data(as_text=True)
+    response.close()
+
+
+def test_notify_users_coalesces_repeated_notifications(app):
+    from utils.notifications import notify_users
+    user = User(email='staff@example.com', username='スタッフ')
+    user.set_password('Staff@12345')
+    db.session.add(user)
+    db.session.commit()
+    admin = User.query.filter_by(email='admin@example.com').one()
+
+    assert notify_users([admin.id, user.id], '在庫不足アラート', '1件', link='/inventory') == 2
+    # 同じ通知は短時間のうちに繰り返さない（まだ受け取っていないユーザーにだけ作成する）
+    assert notify_users([admin.id, user.id], '在庫不足アラート', '2件', link='/inventory') == 0
+    assert notify_users([admin.id], '在庫ゼロアラート', '1件', link='/inventory') == 1
+    assert Notification.query.filter_by(user_id=admin.id).count() == 2
+
+
+def test_mail_outbox_sends_and_retries(app, smtp_server, monkeypatch):
+    from utils import notifications
+    smtp_server.refused.add('down@example.com')
+
+    notifications.send_emails([(['admin@example.com'], '日次サマリー', '本文'), (['down@example.com'], '週次レポート', '本文')])
+    assert notifications._mail_wakeup.is_set()
+
+    assert notifications.process_mail_outbox() == 2
+    assert [recipients for recipients, data in smtp_server.messages] == [['admin@example.com']]
+    assert MailOutbox.query.filter_by(subject='日次サマリー').one().status == 'sent'
+    retry = MailOutbox.query.filter_by(subject='週次レポート').one()
+    assert (retry.status, retry.attempts) == ('pending', 1)
+    assert retry.next_attempt_at > datetime.utcnow()
+    # 再送時刻までは送らない
+    assert notifications.process_mail_outbox() == 0
+
+
+def test_mail_outbox_claims_rows_before_sending(app, smtp_server, monkeypatch):
+    from utils import notifications
+    notifications.send_emails([(['admin@example.com'], '日次サマリー', '本文'), (['staff@example.com'], '週次レポート', '本文')])
+
+    # 送信中は行を送信中にしてコミット済み（他のプロセスは同じメールを取らない）
+    statuses = []
+    open_mail_connection = notifications.open_mail_connection
+
+    def open_after_claim():
+        with db.engine.connect() as connection:
+            statuses.extend(connection.scalars(db.select(MailOutbox.status).order_by(MailOutbox.id)))
+        return open_mail_connection()
+
+    monkeypatch.setattr(notifications, 'open_mail_connection', open_after_claim)
+    assert notifications.process_mail_outbox(batch_size=1) == 1
+    assert statuses == ['sending', 'pending']
+
+    # 送信中にしたメールは、他のプロセスからは取れない
+    assert [outbox.subject for outbox in notifications.claim_mail_outbox(10, datetime.utcnow())] == ['週次レポート']
+    assert notifications.claim_mail_outbox(10, datetime.utcnow()) == []
+    assert notifications.process_mail_outbox() == 0
+
+    # 送信中のまま残ったメールは、期限を過ぎたら送り直す
+    db.session.execute(db.update(MailOutbox).where(MailOutbox.subject == '週次レポート').values(next_attempt_at=datetime.utcnow() - timedelta(seconds=1)))
+    db.session.commit()
+    assert notifications.process_mail_outbox() == 1
+    assert len(smtp_server.messages) == 2
+    assert {outbox.status for outbox in MailOutbox.query} == {'sent'}
+
+
+def test_stock_alert_queues_notification_and_mail(client, stock, monkeypatch):
+    from utils import notifications
+    stock.min_stock = 10
+    db.session.commit()
+    client.post(f'/inventory/{stock.id}/edit', data={'product_name': 'テスト商品', 'quantity': 9, 'group_id': stock.group_id, 'min_stock': 10})
+    get_stock_alert_executor().submit(lambda: None).result()
+
+    # アラートを記録したときに、通知と送信待ちメールも登録する
+    assert StockAlert.query.one().notified_at is not None
+    assert Notification.query.count() == 1
+    assert MailOutbox.query.one().subject == '【在庫管理】在庫不足アラート - 1件'
+    assert notifications.check_and_notify_low_stock() == 0
+
+
+def test_raising_min_stock_above_quantity_alerts(client, stock, monkeypatch):
+    form = {'product_name': 'テスト商品', 'quantity': 50, 'group_id': stock.group_id}
+    client.post(f'/inventory/{stock.id}/edit', data=dict(form, min_stock=60))
+    # 在庫数より小さい値への変更、下回ったままの変更では通知しない
+    client.post(f'/inventory/{stock.id}/edit', data=dict(form, min_stock=40))
+    client.post(f'/inventory/{stock.id}/edit', data=dict(form, min_stock=55))
+    client.post(f'/inventory/{stock.id}/edit', data=dict(form, min_stock=70))
+    get_stock_alert_executor().submit(lambda: None).result()
+
+    alerts = StockAlert.query.order_by(StockAlert.id).all()
+    assert [(alert.alert_type, alert.quantity, alert.threshold) for alert in alerts] == [('low', 50, 60), ('low', 50, 55)]
+    assert Notification.query.count() == 2
+
+
+def test_low_stock_digest_marks_alerts_with_the_notification(client, stock, monkeypatch):
+    from utils import notifications
+    stock.min_stock = 10
+    db.session.commit()
+
+    # 通知の登録に失敗した場合はアラートを未通知のまま登録し、定期実行で通知する
+    def fail(*args, **kwargs):
+        raise OSError('登録できません')
+    with monkeypatch.context() as patch:
+        patch.setattr(notifications, 'send_low_stock_digest_email', fail)
+        client.post(f'/inventory/{stock.id}/edit', data={'product_name': 'テスト商品', 'quantity': 9, 'group_id': stock.group_id, 'min_stock': 10})
+        get_stock_alert_executor().submit(lambda: None).result()
+        assert StockAlert.query.filter(StockAlert.notified_at.is_(None)).count() == 1
+
+        # 定期実行での登録にも失敗した場合は、未通知のまま次回に残す
+        with pytest.raises(OSError):
+            notifications.check_and_notify_low_stock()
+        db.session.rollback()
+    assert StockAlert.query.filter(StockAlert.notified_at.is_(None)).count() == 1
+    assert Notification.query.count() == 0
+
+    assert notifications.check_and_notify_low_stock() == 1
+    assert Notification.query.count() == 1
+    assert MailOutbox.query.one().subject == '【在庫管理】在庫不足アラート - 1件'
+    assert notifications.check_and_notify_low_stock() == 0
+
+
+def test_low_stock_digests_are_not_coalesced(client, stock, monkeypatch):
+    other = Stock(product_name='別商品', quantity=50, group_id=stock.group_id, min_stock=10)
+    stock.min_stock = 10
+    db.session.add(other)
+    db.session.commit()
+
+    # 続けて記録したアラートも、それぞれ通知する（新しいアラートを通知済みにして消さない）
+    for target in (stock, other):
+        client.post(f'/inventory/{target.id}/edit', data={'product_name': target.product_name, 'quantity': 9, 'group_id': stock.group_id, 'min_stock': 10})
+        get_stock_alert_executor().submit(lambda: None).result()
+
+    messages = [notification.message for notification in Notification.query.order_by(Notification.id)]
+    assert len(messages) == 2 and 'テスト商品' in messages[0] and '別商品' in messages[1]
+    assert StockAlert.query.filter(StockAlert.notified_at.is_(None)).count() == 0
+
+
+def test_history_pages_by_keyset_with_cached_count(client, stock, monkeypatch):
+    monkeypatch.setitem(client.application.config, 'HISTORY_PER_PAGE', 2)
+    cache_clear('history_count')
+    now = datetime.utcnow()
+    # 同じ日時の履歴は ID で順序を決める
+    for number, created_at in enumerate([now - timedelta(minutes=3), now - timedelta(minutes=2),
+                                         now - timedelta(minutes=2), now - timedelta(minutes=1), now], 1):
+        db.session.add(StockHistory(stock_id=stock.id, quantity_change=number, transaction_type='inbound',
+                                    notes=f'履歴{number}番', created_at=created_at))
+    db.session.commit()
+    rows = StockHistory.query.order_by(StockHistory.id).all()
+
+    def shown(**args):
+        body = client.get('/history', query_string=args).get_data(as_text=True)
+        return [number for number in range(1, 6) if f'履歴{number}番' in body], body
+
+    numbers, body = shown()
+    assert numbers == [4, 5] and '約 <strong>5</strong> 件' in body and 'after=' in body
+    assert shown(after=encode_cursor(rows[3].created_at, rows[3].id))[0] == [2, 3]
+    assert shown(after=encode_cursor(rows[1].created_at, rows[1].id))[0] == [1]
+    assert shown(before=encode_cursor(rows[2].created_at, rows[2].id))[0] == [4, 5]
+
+    # 件数はキャッシュから返す（追加直後は古い件数のまま）
+    db.session.add(StockHistory(stock_id=stock.id, quantity_change=6, transaction_type='inbound', notes='履歴6番'))
+    db.session.commit()
+    assert '約 <strong>5</strong> 件' in shown()[1]
+    cache_clear('history_count')
+    assert '約 <strong>6</strong> 件' in shown()[1]
+
+
+def test_search_index_follows_edits_and_inbound(client, stock):
+    def search(term, column='product_name'):
+        query, _ = apply_stock_search(Stock.query, column, term)
+        return sorted(found.product_name for found in query)
+
+    assert search('テスト商') == ['テスト商品']
+    client.post(f'/inventory/{stock.id}/edit', data={'product_name': 'ボールペン黒', 'quantity': 50, 'group_id': stock.group_id})
+    client.post('/inbound/new', data={'group_id': stock.group_id, 'product_name': 'ボールペン赤', 'quantity': 5, 'supplier': '文具商事'})
+
+    assert search('テスト商') == []
+    assert search('ボールペン') == ['ボールペン赤', 'ボールペン黒']
+    assert search('文具商', 'supplier') == ['ボールペン赤']
+    # 索引できない短い語も部分一致で検索できる
+    assert search('赤') == ['ボールペン赤']
+
+    client.get('/inventory')  # 入庫の完了メッセージを表示済みにする
+    body = client.get('/inventory', query_string={'search': 'ペン黒'}).get_data(as_text=True)
+    assert 'ボールペン黒' in body and 'ボールペン赤' not in body
+
+
+def test_group_summary_generation_skips_reservations(app, stock):
+    generation = cache_generation('group_summary')
+    # 引当だけの変更は集計に影響しないため、世代を進めない
+    adjust_stock_quantity(stock.id, reserved_delta=5)
+    db.session.commit()
+    stock.supplier = '別の仕入先'
+    db.session.commit()
+    assert cache_generation('group_summary') == generation
+
+    adjust_stock_quantity(stock.id, 3)
+    db.session.commit()
+    assert cache_generation('group_summary') == generation + 1
+    stock.group.name = '名前変更'
+    db.session.commit()
+    assert cache_generation('group_summary') == generation + 2
+
+
+def test_reorder_updates_the_given_range(client):
+    groups = [ItemGroup(name=f'グループ{number}', display_order=number) for number in range(4)]
+    db.session.add_all(groups)
+    db.session.commit()
+    ids = [group.id for group in groups]
+
+    # 2番目以降だけを並べ替える
+    response = client.post('/item_master/api/reorder', json={'orders': [ids[3], ids[1]], 'start': 1})
+    assert response.json['success']
+    db.session.expire_all()
+    assert [db.session.get(ItemGroup, group_id).display_order for group_id in ids] == [0, 2, 2, 1]
+
+    generation = cache_generation('group_summary')
+    assert client.post('/item_master/api/reorder', json={'orders': []}).status_code == 400
+    assert client.post('/item_master/api/reorder', data='並べ替え', content_type='text/plain').status_code == 400
+    assert client.post('/item_master/api/reorder', json={'orders': ['x']}).status_code == 400
+    assert cache_generation('group_summary') == generation
+
+
+def test_inventory_export_xlsx_rows(client, stock, monkeypatch):
+    from io import BytesIO
+    from openpyxl import load_workbook
+
+    monkeypatch.setitem(client.application.config, 'EXPORT_CHUNK_SIZE', 1)
+    db.session.add_all([
+        Stock(product_name='追加商品', quantity=7, group_id=stock.group_id),
+        Stock(product_name='削除済み商品', quantity=3, group_id=stock.group_id, deleted_at=datetime.utcnow()),
+    ])
+    db.session.commit()
+
+    response = client.get('/inventory/export')
+    assert response.headers['Content-Disposition'].endswith('.xlsx')
+    sheet = load_workbook(BytesIO(response.data)).active
+    assert [list(row) for row in sheet.iter_rows(values_only=True)] == [
+        ['ID', 'グループ', '商品名（枝番）', '仕入先', '数量'],
+        [stock.id, 'テストグループ', 'テスト商品', 'テスト仕入先', 50],
+        [stock.id + 1, 'テストグループ', '追加商品', '-', 7],
+    ]
+
+
+def test_csv_and_parquet_exports(client, stock):
+    import csv
+    from io import BytesIO, StringIO
+    import pyarrow.parquet as pq
+
+    response = client.get('/inventory/export', query_string={'format': 'csv'})
+    assert response.mimetype == 'text/csv'
+    assert list(csv.reader(StringIO(response.get_data(as_text=True)))) == [
+        ['ID', 'グループ', '商品名（枝番）', '仕入先', '数量'],
+        [str(stock.id), 'テストグループ', 'テスト商品', 'テスト仕入先', '50'],
+    ]
+
+    client.post('/inbound/new', data={'group_id': stock.group_id, 'product_name': 'テスト商品', 'quantity': 5, 'supplier': 'テスト仕入先'})
+    response = client.get('/history/export', query_string={'format': 'parquet'})
+    table = pq.read_table(BytesIO(response.data))
+    assert table.column_names == ['ID', '日時', 'グループ', '商品名（枝番）', '種別', '数量', 'ユーザー', '備考']
+    row = table.to_pylist()[0]
+    assert (row['商品名（枝番）'], row['種別'], row['数量'], row['ユーザー']) == ('テスト商品', 'inbound', 5, 'admin')
+    assert isinstance(row['日時'], datetime)
+
+    assert client.get('/inventory/export', query_string={'format': 'pdf'}).status_code == 302
+
+
+def test_import_preview_and_confirm_apply_in_chunks(client, stock, monkeypatch):
+    import app as app_module
+    from io import BytesIO
+    from openpyxl import Workbook
+
+    class InlineExecutor:
+        def submit(self, fn, *args):
+            fn(*args)
+
+    monkeypatch.setitem(client.application.config, 'IMPORT_CHUNK_SIZE', 1)
+    monkeypatch.setattr(app_module, 'get_job_executor', lambda: InlineExecutor())
+    other = Stock(product_name='別商品', quantity=8, group_id=stock.group_id)
+    db.session.add(other)
+    db.session.commit()
+
+    workbook = Workbook()
+    workbook.active.append(['ID', 'グループ', '商品名', '仕入先', '数量'])
+    for row in ([stock.id, '', '', '', 60], [other.id, '', '', '', 0], ['abc', '', '', '', 1], [other.id + 1, '', '', '', 8]):
+        workbook.active.append(row)
+    content = BytesIO()
+    workbook.save(content)
+
+    data = {'file': (BytesIO(content.getvalue()), 'stock.xlsx')}
+    preview = client.post('/inventory/import/preview', data=data, content_type='multipart/form-data').get_json()
+    assert preview['changed_count'] == 2 and preview['group_deltas'][0]['delta'] == 2
+    assert len(preview['error_rows']) == 1
+
+    response = client.post('/inventory/import/confirm', json={'token': preview['token']})
+    assert response.status_code == 202
+    job = client.get(response.json['status_url']).get_json()
+    assert (job['status'], job['progress'], job['total']) == ('completed', 2, 2)
+
+    db.session.expire_all()
+    assert (db.session.get(Stock, stock.id).quantity, db.session.get(Stock, other.id).quantity) == (60, 0)
+    assert sorted(history.quantity_change for history in StockHistory.query.filter_by(transaction_type='adjustment')) == [-8, 10]
+
+
+def test_export_job_counts_rows_in_the_worker(client, stock, tmp_path, monkeypatch):
+    import app as app_module
+
+    class DeferredExecutor:
+        submitted = []
+
+        def submit(self, fn, *args):
+            self.submitted.append((fn, args))
+
+    monkeypatch.setitem(client.application.config, 'UPLOAD_FOLDER', str(tmp_path))
+    monkeypatch.setattr(app_module, 'get_job_executor', lambda: DeferredExecutor())
+    client.post('/inbound/new', data={'group_id': stock.group_id, 'product_name': 'テスト商品', 'quantity': 5, 'supplier': 'テスト仕入先'})
+
+    response = client.post('/jobs/export', json={'target': 'history', 'format': 'csv'})
+    status_url = response.json['status_url']
+    assert client.get(status_url).json['total'] is None
+
+    for fn, args in DeferredExecutor.submitted:
+        fn(*args)
+    job = client.get(status_url).json
+    assert (job['status'], job['progress'], job['total']) == ('completed', 1, 1)
+
+    # 削除されたジョブは実行しない
+    app_module.run_job('missing')
+
+
+def test_qr_batch_keeps_request_order_and_prunes_disk_cache(client, stock, tmp_path, monkeypatch):
+    monkeypatch.setitem(client.application.config, 'UPLOAD_FOLDER', str(tmp_path))
+    monkeypatch.setitem(client.application.config, 'QR_DISK_CACHE_MAX_FILES', 2)
+    cache_clear('qr_cache_prune')
+    folder = tmp_path / 'qr'
+    folder.mkdir()
+    old = datetime.utcnow() - timedelta(seconds=client.application.config['QR_DISK_CACHE_TTL'] + 60)
+    for name in ('expired', 'recent1', 'recent2', 'recent3'):
+        (folder / f'{name}.png').write_bytes(b'png')
+    os.utime(folder / 'expired.png', (old.timestamp(), old.timestamp()))
+    os.utime(folder / 'recent1.png', (old.timestamp() + 120, old.timestamp() + 120))
+
+    other = Stock(product_name='別商品', quantity=1, group_id=stock.group_id)
+    db.session.add(other)
+    db.session.commit()
+    response = client.post('/api/qr/generate', json={'ids': [other.id, 99999, stock.id]})
+    codes = response.json['codes']
+    assert [code['stock_id'] for code in codes] == [other.id, 99999, stock.id]
+    assert codes[1]['qr_code'] is None
+    assert codes[0]['qr_code'].startswith('data:image/png;base64,') and codes[2]['product_name'] == 'テスト商品'
+
+    # 期限切れと、件数の上限を超えた古いものは生成前に削除される
+    remaining = {path.stem for path in folder.iterdir()}
+    assert 'expired' not in remaining and 'recent1' not in remaining
+    assert {'recent2', 'recent3'} <= remaining and len(remaining) == 4
+
+
+def test_label_sheets_paginate_pdf_and_svg(client, stock):
+    import re
+    import xml.etree.ElementTree as ET
+
+    db.session.add_all([
+        Stock(product_name='別商品', quantity=1, group_id=stock.group_id),
+        Stock(product_name='三つ目', quantity=1, group_id=stock.group_id),
+        Stock(product_name='削除済み商品', quantity=1, group_id=stock.group_id, deleted_at=datetime.utcnow()),
+    ])
+    db.session.commit()
+    args = {'group': stock.group_id, 'cols': 1, 'rows': 2}
+
+    pdf = client.get('/inventory/labels', query_string=args).data
+    assert pdf.startswith(b'%PDF-1.4') and b'/Count 2' in pdf
+    # 相互参照表のオフセットが各オブジェクトの先頭を指す
+    startxref = int(re.search(rb'startxref\n(\d+)', pdf).group(1))
+    assert pdf[startxref:].startswith(b'xref')
+    offsets = re.findall(rb'(\d{10}) 00000 n', pdf[startxref:])
+    for obj_id, offset in enumerate(offsets, 1):
+        assert pdf[int(offset):].startswith(f'{obj_id} 0 obj'.encode())
+
+    svg = ET.fromstring(client.get('/inventory/labels', query_string=dict(args, format='svg')).data)
+    namespace = {'svg': 'http://www.w3.org/2000/svg'}
+    assert len(svg.findall('svg:g', namespace)) == 2
+    texts = [text.text for text in svg.iter('{http://www.w3.org/2000/svg}text')]
+    assert texts == ['テストグループ', 'テスト商品', 'テストグループ', '別商品', 'テストグループ', '三つ目']
@@ -0,0 +1,259 @@
+"""
+在庫管理システム - QRラベルシート
+utils/labels.py
+
+QRコード・グループ名・商品名を並べたラベルシートを PDF / SVG で生成する。
+どちらもページ単位で出力するため、ラベル数が多くてもメモリに全体を保持しない。
+"""
+import zlib
+from xml.sax.saxutils import escape
+
+import qrcode
+
+
+# A4（ポイント単位）
+PAGE_WIDTH = 595.28
+PAGE_HEIGHT = 841.89
+PAGE_MARGIN = 28.35  # 10mm
+
+GROUP_FONT_SIZE = 7
+NAME_FONT_SIZE = 9
+CELL_PADDING = 4
+
+# PDF はファイルを小さく保つため、フォントを埋め込まずに標準の日本語フォントを指定する
+PDF_FONT_NAME = 'HeiseiKakuGo-W5'
+
+
+def qr_matrix(data):
+    """QRコードのモジュール配列（余白なし）"""
+    qr = qrcode.QRCode(border=0)
+    qr.add_data(data)
+    qr.make(fit=True)
+    return qr.get_matrix()
+
+
+def iter_dark_runs(matrix):
+    """黒モジュールの横方向の連続を (行, 開始列, 長さ) で返す"""
+    for y, row in enumerate(matrix):
+        x = 0
+        size = len(row)
+        while x < size:
+            if row[x]:
+                start = x
+                while x < size and row[x]:
+                    x += 1
+                yield y, start, x - start
+            else:
+                x += 1
+
+
+def text_width(text, font_size):
+    """おおよその文字列幅（全角は1em、半角は0.5em）"""
+    return sum(font_size if ord(ch) > 0xff else font_size / 2 for ch in text)
+
+
+def fit_text(text, font_size, max_width):
+    """幅に収まるように末尾を省略する"""
+    text = text or '-'
+    if text_width(text, font_size) <= max_width:
+        return text
+    while text and text_width(text + '…', font_size) > max_width:
+        text = text[:-1]
+    return text + '…'
+
+
+class LabelLayout:
+    """ページ内のラベル配置（cols × rows のグリッド）"""
+
+    def __init__(self, cols=3, rows=8):
+        self.cols = cols
+        self.rows = rows
+        self.per_page = cols * rows
+        self.cell_width = (PAGE_WIDTH - PAGE_MARGIN * 2) / cols
+        self.cell_height = (PAGE_HEIGHT - PAGE_MARGIN * 2) / rows
+        text_height = GROUP_FONT_SIZE + NAME_FONT_SIZE + CELL_PADDING * 3
+        # 隣のラベルとの間に読み取り用の余白（クワイエットゾーン）を残す
+        self.qr_size = max(min(self.cell_width * 0.8, self.cell_height - text_height), 10)
+
+    def cell_origin(self, index):
+        """ページ内 index 番目のセルの左上座標（上端基準）"""
+        col = index % self.cols
+        row = index // self.cols
+        return PAGE_MARGIN + col * self.cell_width, PAGE_MARGIN + row * self.cell_height
+
+    def iter_pages(self, labels):
+        """ラベルをページ単位にまとめる"""
+        page = []
+        for label in labels:
+            page.append(label)
+            if len(page) == self.per_page:
+                yield page
+                page = []
+        if page:
+            yield page
+
+
+# ========================================
+# PDF
+# ========================================
+
+def pdf_text(text, font_size, x, y):
+    hex_text = ''.join(
+        ch.encode('utf-16-be').hex() for ch in text if ord(ch) <= 0xffff
+    )
+    return f'BT /F1 {font_size} Tf {x:.2f} {y:.2f} Td <{hex_text}> Tj ET\n'
+
+
+def pdf_page_content(layout, page):
+    parts = []
+    for index, (data, group_name, product_name) in enumerate(page):
+        left, top = layout.cell_origin(index)
+        center = left + layout.cell_width / 2
+
+        matrix = qr_matrix(data)
+        module = layout.qr_size / len(matrix)
+        qr_left = center - layout.qr_size / 2
+        qr_top = PAGE_HEIGHT - top - CELL_PADDING
+
+        parts.append('0 g\n')
+        for y, x, length in iter_dark_runs(matrix):
+            parts.append(
+                f'{qr_left + x * module:.2f} {qr_top - (y + 1) * module:.2f} {length * module:.2f} {module:.2f} re\n'
+            )
+        parts.append('f\n')
+
+        max_width = layout.cell_width - CELL_PADDING * 2
+        group_text = fit_text(group_name, GROUP_FONT_SIZE, max_width)
+        name_text = fit_text(product_name, NAME_FONT_SIZE, max_width)
+        group_y = qr_top - layout.qr_size - CELL_PADDING - GROUP_FONT_SIZE
+        name_y = group_y - CELL_PADDING - NAME_FONT_SIZE
+        parts.append(pdf_text(group_text, GROUP_FONT_SIZE, center - text_width(group_text, GROUP_FONT_SIZE) / 2, group_y))
+        parts.append(pdf_text(name_text, NAME_FONT_SIZE, center - text_width(name_text, NAME_FONT_SIZE) / 2, name_y))
+    return zlib.compress(''.join(parts).encode('ascii'))
+
+
+def iter_pdf_label_sheet(labels, cols=3, rows=8):
+    """ラベルシートの PDF をページごとに bytes で返す
+
+    Args:
+        labels: (QRコードの内容, グループ名, 商品名) のイテラブル
+    """
+    layout = LabelLayout(cols, rows)
+
+    # 1: Catalog, 2: Pages, 3-5: フォント。Pages とフォントはページを書き終えてから出力する
+    offsets = {}
+    position = 0
+    next_id = 6
+    kids = []
+
+    def emit(obj_id, body):
+        nonlocal position
+        offsets[obj_id] = position
+        chunk = f'{obj_id} 0 obj\n'.encode('ascii') + body + b'\nendobj\n'
+        position += len(chunk)
+        return chunk
+
+    header = b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n'
+    position += len(header)
+    yield header
+
+    for page in layout.iter_pages(labels):
+        content = pdf_page_content(layout, page)
+        content_id, page_id = next_id, next_id + 1
+        next_id += 2
+        yield emit(content_id, f'<< /Length {len(content)} /Filter /FlateDecode >>\nstream\n'.encode('ascii') + content + b'\nendstream')
+        yield emit(page_id, (
+            f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {PAGE_WIDTH} {PAGE_HEIGHT}] '
+            f'/Resources << /Font << /F1 3 0 R >> >> /Contents {content_id} 0 R >>'
+        ).encode('ascii'))
+        kids.append(page_id)
+
+    if not kids:
+        # 空のPDFは開けないビューアがあるため白紙を1ページ出力する
+        page_id = next_id
+        next_id += 1
+        yield emit(page_id, f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {PAGE_WIDTH} {PAGE_HEIGHT}] >>'.encode('ascii'))
+        kids.append(page_id)
+
+    yield emit(1, b'<< /Type /Catalog /Pages 2 0 R >>')
+    kid_refs = ' '.join(f'{kid} 0 R' for kid in kids)
+    yield emit(2, f'<< /Type /Pages /Kids [{kid_refs}] /Count {len(kids)} >>'.encode('ascii'))
+    yield emit(3, (
+        f'<< /Type /Font /Subtype /Type0 /BaseFont /{PDF_FONT_NAME} '
+        f'/Encoding /UniJIS-UCS2-H /DescendantFonts [4 0 R] >>'
+    ).encode('ascii'))
+    yield emit(4, (
+        f'<< /Type /Font /Subtype /CIDFontType0 /BaseFont /{PDF_FONT_NAME} '
+        f'/CIDSystemInfo << /Registry (Adobe) /Ordering (Japan1) /Supplement 2 >> '
+        f'/FontDescriptor 5 0 R /DW 1000 /W [1 95 500 231 632 500] >>'
+    ).encode('ascii'))
+    yield emit(5, (
+        f'<< /Type /FontDescriptor /FontName /{PDF_FONT_NAME} /Flags 4 '
+        f'/FontBBox [-92 -250 1010 922] /ItalicAngle 0 /Ascent 752 /Descent -221 '
+        f'/CapHeight 737 /StemV 58 >>'
+    ).encode('ascii'))
+
+    xref = [f'xref\n0 {next_id}\n', '0000000000 65535 f \n']
+    for obj_id in range(1, next_id):
+        xref.append(f'{offsets[obj_id]:010d} 00000 n \n')
+    xref.append(f'trailer\n<< /Size {next_id} /Root 1 0 R >>\nstartxref\n{position}\n%%EOF\n')
+    yield ''.join(xref).encode('ascii')
+
+
+# ========================================
+# SVG
+# ========================================
+
+def svg_page(layout, page, page_index):
+    offset = page_index * PAGE_HEIGHT
+    parts = [f'<g transform="translate(0 {offset:.2f})">\n']
+    for index, (data, group_name, product_name) in enumerate(page):
+        left, top = layout.cell_origin(index)
+        center = left + layout.cell_width / 2
+
+        matrix = qr_matrix(data)
+        module = layout.qr_size / len(matrix)
+        qr_left = center - layout.qr_size / 2
+        qr_top = top + CELL_PADDING
+
+        path = ''.join(f'M{x} {y}h{length}v1h-{length}z' for y, x, length in iter_dark_runs(matrix))
+        parts.append(
+            f'<path transform="translate({qr_left:.2f} {qr_top:.2f}) scale({module:.4f})" d="{path}"/>\n'
+        )
+
+        max_width = layout.cell_width - CELL_PADDING * 2
+        group_y = qr_top + layout.qr_size + CELL_PADDING + GROUP_FONT_SIZE
+        name_y = group_y + CELL_PADDING + NAME_FONT_SIZE
+        parts.append(
+            f'<text x="{center:.2f}" y="{group_y:.2f}" font-size="{GROUP_FONT_SIZE}">'
+            f'{escape(fit_text(group_name, GROUP_FONT_SIZE, max_width))}</text>\n'
+        )
+        parts.append(
+            f'<text x="{center:.2f}" y="{name_y:.2f}" font-size="{NAME_FONT_SIZE}" font-weight="bold">'
+            f'{escape(fit_text(product_name, NAME_FONT_SIZE, max_width))}</text>\n'
+        )
+    parts.append('</g>\n')
+    return ''.join(parts)
+
+
+def iter_svg_label_sheet(labels, total, cols=3, rows=8):
+    """ラベルシートを1枚の SVG（A4 を縦に連結）としてページごとに文字列で返す
+
+    Args:
+        labels: (QRコードの内容, グループ名, 商品名) のイテラブル
+        total: ラベル数（SVG 全体の高さを先に決めるために使う）
+    """
+    layout = LabelLayout(cols, rows)
+    pages = max(-(-total // layout.per_page), 1)
+    height = PAGE_HEIGHT * pages
+
+    yield (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{PAGE_WIDTH}pt" height="{height:.2f}pt" '
+        f'viewBox="0 0 {PAGE_WIDTH} {height:.2f}" text-anchor="middle" '
+        'font-family="\'Hiragino Kaku Gothic ProN\', Meiryo, sans-serif">\n'
+        f'<rect width="{PAGE_WIDTH}" height="{height:.2f}" fill="white"/>\n'
+    )
+    for page_index, page in enumerate(layout.iter_pages(labels)):
+        yield svg_page(layout, page, page_index)
+    yield '</svg>\n'
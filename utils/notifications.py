@@ -2,12 +2,37 @@
 在庫管理システム - 通知システム
 utils/notifications.py
 """
-from datetime import datetime
-from flask_mail import Message
-from flask import url_for
+import smtplib
+import threading
+from datetime import datetime, timedelta
+from email.message import EmailMessage
+from flask import current_app, has_request_context, url_for
 
-from models import db, Notification, User, UserRole, Stock
-from app import mail
+from app import db, MailOutbox, Notification, User, Stock, StockAlert, cache_get, cache_set
+
+
+# 同じ (ユーザー, タイトル, リンク) の通知はこの期間内に1件にまとめる
+NOTIFICATION_COALESCE_WINDOW = timedelta(minutes=10)
+
+# 通知先ユーザーをキャッシュする秒数
+RECIPIENT_CACHE_TIMEOUT = 60
+
+# メール送信（送信待ちテーブルからまとめて送る）
+MAIL_BATCH_SIZE = 50          # 1回のSMTP接続で送る最大件数
+MAIL_MAX_ATTEMPTS = 5         # これを超えて失敗したメールは failed にする
+MAIL_RETRY_BASE_SECONDS = 60  # 再送間隔（1分, 2分, 4分, ... と倍にする）
+MAIL_POLL_INTERVAL = 30       # 送信待ちを確認する間隔（秒）
+# 送信中のまま残ったメール（送信中にプロセスが止まった場合）を再送するまでの秒数
+# （1回の接続でまとめて送る時間より長くする）
+MAIL_SEND_LEASE_SECONDS = 1800
+
+
+def app_link(endpoint, **values):
+    """通知に付けるリンク（定期実行などリクエストの外でも生成できる）"""
+    if has_request_context():
+        return url_for(endpoint, **values)
+    with current_app.test_request_context():
+        return url_for(endpoint, **values)
 
 
 def create_notification(user_id, title, message, type='info', link=None):
@@ -35,48 +60,73 @@ def create_notification(user_id, title, message, type='info', link=None):
     return notification
 
 
-def notify_users(user_ids, title, message, type='info', link=None):
-    """複数ユーザーに通知
+def get_recipient_user_ids():
+    """通知先ユーザーのIDリスト（短時間キャッシュ）
     
-    Args:
-        user_ids: ユーザーIDのリスト
-        title: 通知タイトル
-        message: 通知メッセージ
-        type: 通知タイプ
-        link: リンクURL
+    ユーザーに権限の区別がないため、登録されているユーザー全員に通知する
+    
+    Returns:
+        list: ユーザーIDのリスト
     """
-    for user_id in user_ids:
-        create_notification(user_id, title, message, type, link)
+    cache_key = ('notification_recipients',)
+    user_ids = cache_get(cache_key)
+    if user_ids is None:
+        user_ids = [user_id for user_id, in db.session.query(User.id).order_by(User.id)]
+        cache_set(cache_key, user_ids, RECIPIENT_CACHE_TIMEOUT)
+    return user_ids
+
 
+def get_recipient_emails():
+    """通知メールの宛先（通知先ユーザーのメールアドレス）"""
+    return [email for email, in db.session.query(User.email).order_by(User.id)]
 
-def notify_role(role, title, message, type='info', link=None):
-    """特定ロールのユーザー全員に通知
+
+def notify_users(user_ids, title, message, type='info', link=None, commit=True, coalesce=True):
+    """複数ユーザーに通知（1回の一括INSERTと1回のコミット）
+    
+    NOTIFICATION_COALESCE_WINDOW 内に同じタイトル・リンクの通知を受け取っている
+    ユーザーには作成しない（coalesce=False の場合は常に作成する）。
     
     Args:
-        role: UserRole
+        user_ids: ユーザーIDのリスト
         title: 通知タイトル
         message: 通知メッセージ
         type: 通知タイプ
         link: リンクURL
+        commit: False の場合はコミットせず、呼び出し側のトランザクションに含める
+        coalesce: False の場合は同じ通知を最近受け取っていても作成する（内容が毎回異なる通知用）
+    
+    Returns:
+        int: 作成した通知の件数
     """
-    users = User.query.filter_by(role=role, active=True).all()
-    for user in users:
-        create_notification(user.id, title, message, type, link)
-
-
-def notify_admins(title, message, type='info', link=None):
-    """管理者全員に通知"""
-    notify_role(UserRole.ADMIN, title, message, type, link)
-
-
-def notify_managers(title, message, type='info', link=None):
-    """マネージャー全員に通知"""
-    users = User.query.filter(
-        User.role.in_([UserRole.ADMIN, UserRole.MANAGER]),
-        User.active == True
-    ).all()
-    for user in users:
-        create_notification(user.id, title, message, type, link)
+    user_ids = set(user_ids)
+    if not user_ids:
+        return 0
+    
+    now = datetime.utcnow()
+    if coalesce:
+        recent = db.session.query(Notification.user_id).filter(
+            Notification.user_id.in_(user_ids),
+            Notification.title == title,
+            Notification.link.is_(None) if link is None else Notification.link == link,
+            Notification.created_at >= now - NOTIFICATION_COALESCE_WINDOW
+        )
+        user_ids -= {user_id for user_id, in recent}
+        if not user_ids:
+            return 0
+    
+    db.session.execute(db.insert(Notification), [
+        {'user_id': user_id, 'title': title, 'message': message, 'type': type, 'link': link, 'created_at': now}
+        for user_id in sorted(user_ids)
+    ])
+    if commit:
+        db.session.commit()
+    return len(user_ids)
+
+
+def notify_staff(title, message, type='info', link=None):
+    """通知先ユーザー全員に通知"""
+    return notify_users(get_recipient_user_ids(), title, message, type, link)
 
 
 # ========================================
@@ -91,33 +141,14 @@ def notify_low_stock(stock: Stock):
     """
     title = '在庫不足アラート'
     message = f'{stock.product_name}の在庫が最小在庫数を下回りました（現在庫: {stock.quantity}）'
-    link = url_for('inventory.index', _external=False)
+    link = app_link('inventory_edit', stock_id=stock.id)
     
-    # 管理者とマネージャーに通知
-    notify_managers(title, message, type='warning', link=link)
+    notify_staff(title, message, type='warning', link=link)
     
     # メール通知（オプション）
     send_low_stock_email(stock)
 
 
-def notify_expiring_soon(stock: Stock):
-    """期限切れ間近通知
-    
-    Args:
-        stock: 在庫オブジェクト
-    """
-    if not stock.expiry_date:
-        return
-    
-    days_until_expiry = (stock.expiry_date - datetime.utcnow()).days
-    
-    title = '期限切れ間近アラート'
-    message = f'{stock.product_name}の有効期限が{days_until_expiry}日後に切れます'
-    link = url_for('inventory.index', _external=False)
-    
-    notify_managers(title, message, type='warning', link=link)
-
-
 def notify_stock_zero(stock: Stock):
     """在庫ゼロ通知
     
@@ -126,41 +157,22 @@ def notify_stock_zero(stock: Stock):
     """
     title = '在庫ゼロアラート'
     message = f'{stock.product_name}の在庫がゼロになりました'
-    link = url_for('inventory.index', _external=False)
+    link = app_link('inventory_edit', stock_id=stock.id)
     
-    notify_managers(title, message, type='error', link=link)
-
-
-def notify_inbound_confirmed(order):
-    """入庫確定通知
-    
-    Args:
-        order: InboundOrder
-    """
-    title = '入庫確定'
-    message = f'入庫指示 {order.order_number} が確定されました（{order.stock.product_name}: {order.quantity}個）'
-    link = url_for('inbound.index', _external=False)
-    
-    # 倉庫担当者に通知
-    warehouse_users = User.query.filter_by(role=UserRole.WAREHOUSE, active=True).all()
-    for user in warehouse_users:
-        create_notification(user.id, title, message, type='success', link=link)
+    notify_staff(title, message, type='error', link=link)
 
 
 def notify_outbound_confirmed(order):
-    """出庫確定通知
+    """出庫確認通知
     
     Args:
         order: OutboundOrder
     """
-    title = '出庫確定'
-    message = f'出庫指示 {order.order_number} が確定されました（{order.stock.product_name}: {order.quantity}個）'
-    link = url_for('outbound.index', _external=False)
+    title = '出庫確認'
+    message = f'出庫予定 #{order.id} が倉庫で確認されました（{order.stock.product_name}: {order.quantity}個）'
+    link = app_link('warehouse_index')
     
-    # 倉庫担当者に通知
-    warehouse_users = User.query.filter_by(role=UserRole.WAREHOUSE, active=True).all()
-    for user in warehouse_users:
-        create_notification(user.id, title, message, type='success', link=link)
+    notify_staff(title, message, type='success', link=link)
 
 
 # ========================================
@@ -168,20 +180,182 @@ def notify_outbound_confirmed(order):
 # ========================================
 
 def send_email(recipients, subject, body):
-    """メール送信
+    """メール送信（送信待ちに登録するだけで、SMTPには接続しない）
     
     Args:
         recipients: 受信者リスト
         subject: 件名
         body: 本文
     """
+    send_emails([(recipients, subject, body)])
+
+
+def send_emails(messages, commit=True):
+    """複数のメールをまとめて送信待ちに登録する（1回のコミット）
+    
+    Args:
+        messages: (受信者リスト, 件名, 本文) のリスト
+        commit: False の場合はコミットせず、呼び出し側がコミット後に wake_mail_sender を呼ぶ
+    """
+    rows = [
+        MailOutbox(recipients=','.join(recipients), subject=subject, body=body)
+        for recipients, subject, body in messages
+        if recipients
+    ]
+    if not rows:
+        return
+    
+    db.session.add_all(rows)
+    if commit:
+        db.session.commit()
+        wake_mail_sender()
+
+
+def wake_mail_sender():
+    """送信スレッドを起こす（送信待ちメールをコミットした後に呼ぶ）"""
+    start_mail_sender(current_app._get_current_object())
+    _mail_wakeup.set()
+
+
+def schedule_mail_retry(outbox, error, now):
+    """送信に失敗したメールの再送時刻を指数的に延ばす"""
+    outbox.attempts += 1
+    outbox.last_error = str(error)[:1000]
+    if outbox.attempts >= MAIL_MAX_ATTEMPTS:
+        outbox.status = 'failed'
+    else:
+        outbox.status = 'pending'
+        outbox.next_attempt_at = now + timedelta(seconds=MAIL_RETRY_BASE_SECONDS * 2 ** (outbox.attempts - 1))
+
+
+def open_mail_connection():
+    """SMTPサーバーに接続する（with文で使い、抜けるときに切断する）"""
+    config = current_app.config
+    connection = smtplib.SMTP(config['MAIL_SERVER'], config['MAIL_PORT'], timeout=30)
     try:
-        msg = Message(subject, recipients=recipients)
-        msg.body = body
-        mail.send(msg)
+        if config['MAIL_USE_TLS']:
+            connection.starttls()
+        if config['MAIL_USERNAME']:
+            connection.login(config['MAIL_USERNAME'], config['MAIL_PASSWORD'])
+    except Exception:
+        connection.close()
+        raise
+    return connection
+
+
+def build_mail_message(outbox):
+    """送信待ちの行からメールを組み立てる"""
+    message = EmailMessage()
+    message['Subject'] = outbox.subject
+    message['From'] = current_app.config['MAIL_DEFAULT_SENDER'] or current_app.config['MAIL_USERNAME']
+    message['To'] = ', '.join(outbox.recipients.split(','))
+    message.set_content(outbox.body)
+    return message
+
+
+def claim_mail_outbox(batch_size, now):
+    """送信時刻になったメールを送信中にしてコミットする
+    
+    SMTPで送信している間は行をロックしない。送信中のまま MAIL_SEND_LEASE_SECONDS を
+    過ぎたメール（送信中にプロセスが止まった場合）は、もう一度送信の対象にする。
+    
+    Returns:
+        list: このプロセスが送信中にした MailOutbox
+    """
+    due = db.and_(
+        MailOutbox.status.in_(('pending', 'sending')),
+        MailOutbox.next_attempt_at <= now
+    )
+    ids = db.session.scalars(
+        db.select(MailOutbox.id).where(due).order_by(MailOutbox.next_attempt_at, MailOutbox.id).limit(batch_size)
+    ).all()
+    if not ids:
+        db.session.commit()
+        return []
+    
+    # 他のプロセスが先に送信中にした行は条件に合わなくなるため、二重に送らない
+    claimed = db.session.scalars(
+        db.update(MailOutbox).where(MailOutbox.id.in_(ids), due).values(
+            status='sending', next_attempt_at=now + timedelta(seconds=MAIL_SEND_LEASE_SECONDS)
+        ).returning(MailOutbox.id).execution_options(synchronize_session=False)
+    ).all()
+    db.session.commit()
+    if not claimed:
+        return []
+    return MailOutbox.query.filter(MailOutbox.id.in_(claimed)).order_by(MailOutbox.id).all()
+
+
+def process_mail_outbox(batch_size=MAIL_BATCH_SIZE):
+    """送信時刻になったメールを1つのSMTP接続でまとめて送信する
+    
+    送信するメールを先に送信中にしてコミットし、SMTPでの送信後に結果をコミットする。
+    
+    ローカルで確認する場合はデバッグ用SMTPサーバーを起動し、
+    MAIL_SERVER=localhost MAIL_PORT=1025 MAIL_USE_TLS=false を指定する:
+        python -m aiosmtpd -n -l localhost:1025
+    
+    Returns:
+        int: 処理したメールの件数（送信・再送予定・失敗を含む）
+    """
+    now = datetime.utcnow()
+    messages = claim_mail_outbox(batch_size, now)
+    if not messages:
+        return 0
+    
+    handled = set()
+    try:
+        with open_mail_connection() as connection:
+            for outbox in messages:
+                handled.add(outbox.id)
+                try:
+                    connection.send_message(build_mail_message(outbox))
+                except Exception as e:
+                    current_app.logger.warning(f'メール送信エラー（{outbox.id}）: {e}')
+                    schedule_mail_retry(outbox, e, now)
+                else:
+                    outbox.status = 'sent'
+                    outbox.sent_at = datetime.utcnow()
     except Exception as e:
-        # ログに記録
-        print(f"メール送信エラー: {e}")
+        # SMTPサーバーに接続できない場合は、未処理のメールをすべて再送予定にする
+        current_app.logger.warning(f'SMTP接続エラー: {e}')
+        for outbox in messages:
+            if outbox.id not in handled:
+                schedule_mail_retry(outbox, e, now)
+    
+    db.session.commit()
+    return len(messages)
+
+
+_mail_sender = None
+_mail_sender_lock = threading.Lock()
+_mail_wakeup = threading.Event()
+
+
+def start_mail_sender(app):
+    """送信待ちメールを送るバックグラウンドスレッドを起動する（プロセスごとに1本）"""
+    global _mail_sender
+    with _mail_sender_lock:
+        if _mail_sender is None or not _mail_sender.is_alive():
+            _mail_sender = threading.Thread(target=run_mail_sender, args=(app,), daemon=True)
+            _mail_sender.start()
+
+
+def run_mail_sender(app):
+    while True:
+        # 送信待ちを確認する前に合図を消す（確認中に登録されたメールの合図は残るので、すぐに次の確認が始まる）
+        _mail_wakeup.clear()
+        with app.app_context():
+            try:
+                # 1回で送りきれない場合は続けて送る
+                while process_mail_outbox() == MAIL_BATCH_SIZE:
+                    pass
+            except Exception as e:
+                db.session.rollback()
+                app.logger.warning(f'メール送信エラー: {e}')
+            finally:
+                db.session.remove()
+        
+        _mail_wakeup.wait(MAIL_POLL_INTERVAL)
 
 
 def send_low_stock_email(stock: Stock):
@@ -190,14 +364,7 @@ def send_low_stock_email(stock: Stock):
     Args:
         stock: 在庫オブジェクト
     """
-    # 管理者とマネージャーのメールアドレス取得
-    users = User.query.filter(
-        User.role.in_([UserRole.ADMIN, UserRole.MANAGER]),
-        User.active == True,
-        User.email_verified == True
-    ).all()
-    
-    recipients = [user.email for user in users]
+    recipients = get_recipient_emails()
     
     if not recipients:
         return
@@ -209,7 +376,7 @@ def send_low_stock_email(stock: Stock):
 以下の商品の在庫が最小在庫数を下回りました。
 
 商品名: {stock.product_name}
-商品コード: {stock.product_code or '-'}
+グループ: {stock.group.name if stock.group else '-'}
 現在在庫: {stock.quantity}
 最小在庫: {stock.min_stock}
 不足数: {stock.min_stock - stock.quantity}
@@ -221,23 +388,49 @@ def send_low_stock_email(stock: Stock):
     send_email(recipients, subject, body)
 
 
+def send_low_stock_digest_email(stocks, commit=True):
+    """在庫不足の商品をまとめたメールを、宛先ごとに1通ずつ送信
+    
+    Args:
+        stocks: 在庫オブジェクトのリスト
+        commit: False の場合はコミットせず、呼び出し側のトランザクションに含める
+    """
+    recipients = get_recipient_emails()
+    
+    if not recipients:
+        return
+    
+    lines = '\n'.join(
+        f'{stock.product_name}（{stock.group.name if stock.group else "-"}）: '
+        f'現在在庫 {stock.quantity} / 最小在庫 {stock.min_stock or 0} / 不足数 {(stock.min_stock or 0) - stock.quantity}'
+        for stock in stocks
+    )
+    subject = f'【在庫管理】在庫不足アラート - {len(stocks)}件'
+    body = f'''
+在庫不足アラート
+
+前回の確認以降に、以下の{len(stocks)}件の商品の在庫が最小在庫数を下回りました。
+
+{lines}
+
+至急、発注をご検討ください。
+
+在庫管理システム
+'''
+    send_emails([([email], subject, body) for email in recipients], commit=commit)
+
+
 def send_daily_summary():
     """日次サマリーメール送信（定期実行用）"""
-    from models import StockHistory, HistoryAction
-    from sqlalchemy import func
+    from app import refresh_history_rollup, history_totals
     
     today = datetime.utcnow().date()
     
-    # 今日の入出庫統計
-    today_in = StockHistory.query.filter(
-        StockHistory.action == HistoryAction.IN,
-        func.date(StockHistory.created_at) == today
-    ).count()
-    
-    today_out = StockHistory.query.filter(
-        StockHistory.action == HistoryAction.OUT,
-        func.date(StockHistory.created_at) == today
-    ).count()
+    # 今日の入出庫統計（日次集計から読む）
+    refresh_history_rollup()
+    totals = history_totals(today)
+    today_in = totals.get('inbound', (0, 0))[0]
+    today_out = totals.get('outbound', (0, 0))[0]
     
     # 在庫不足アイテム
     low_stock_items = Stock.query.filter(
@@ -245,9 +438,7 @@ def send_daily_summary():
         Stock.quantity <= Stock.min_stock
     ).count()
     
-    # 管理者に送信
-    admins = User.query.filter_by(role=UserRole.ADMIN, active=True, email_verified=True).all()
-    recipients = [admin.email for admin in admins]
+    recipients = get_recipient_emails()
     
     if not recipients:
         return
@@ -274,31 +465,17 @@ def send_daily_summary():
 
 def send_weekly_report():
     """週次レポートメール送信（定期実行用）"""
-    from datetime import timedelta
-    from models import StockHistory, HistoryAction
-    from sqlalchemy import func
-    
-    week_ago = datetime.utcnow() - timedelta(days=7)
-    
-    # 週間統計
-    week_in = db.session.query(func.sum(StockHistory.quantity)).filter(
-        StockHistory.action == HistoryAction.IN,
-        StockHistory.created_at >= week_ago
-    ).scalar() or 0
-    
-    week_out = db.session.query(func.sum(StockHistory.quantity)).filter(
-        StockHistory.action == HistoryAction.OUT,
-        StockHistory.created_at >= week_ago
-    ).scalar() or 0
-    
-    # マネージャー以上に送信
-    users = User.query.filter(
-        User.role.in_([UserRole.ADMIN, UserRole.MANAGER]),
-        User.active == True,
-        User.email_verified == True
-    ).all()
+    from app import refresh_history_rollup, history_totals
+    
+    week_start = datetime.utcnow().date() - timedelta(days=6)
     
-    recipients = [user.email for user in users]
+    # 週間統計（今日を含む7日分の日次集計から読む。出庫の数量は負で集計されている）
+    refresh_history_rollup()
+    totals = history_totals(week_start)
+    week_in = totals.get('inbound', (0, 0))[1]
+    week_out = -totals.get('outbound', (0, 0))[1]
+    
+    recipients = get_recipient_emails()
     
     if not recipients:
         return
@@ -324,40 +501,70 @@ def send_weekly_report():
 # バッチ処理用通知チェック
 # ========================================
 
-def check_and_notify_low_stock():
-    """在庫不足チェックと通知（定期実行用）
+def notify_low_stock_digest(stocks, commit=True):
+    """在庫不足の商品をまとめて、宛先ごとに1件の通知と1通のメールにする
     
-    crontabで定期実行:
-        0 9 * * * cd /path/to/app && flask check-low-stock
+    Args:
+        stocks: 在庫オブジェクトのリスト
+        commit: False の場合はコミットせず、呼び出し側のトランザクションに含める
     """
-    low_stocks = Stock.query.filter(
+    title = '在庫不足アラート'
+    names = '、'.join(stock.product_name for stock in stocks[:5])
+    if len(stocks) > 5:
+        names += f' ほか{len(stocks) - 5}件'
+    message = f'{len(stocks)}件の商品の在庫が最小在庫数を下回りました（{names}）'
+    link = app_link('inventory_list')
+    
+    # ダイジェストは毎回別の商品を知らせるため、直前のダイジェストとまとめない
+    # （まとめるとアラートは通知済みになるのに、通知が作成されない）
+    notify_users(get_recipient_user_ids(), title, message, type='warning', link=link, commit=commit, coalesce=False)
+    send_low_stock_digest_email(stocks, commit=commit)
+
+
+def get_low_stocks(stock_ids):
+    """アラートの商品のうち、まだ最小在庫数（未設定なら0）以下の商品（削除済みを除く）"""
+    return Stock.query.filter(
+        Stock.id.in_(stock_ids),
         Stock.deleted_at.is_(None),
-        Stock.quantity <= Stock.min_stock
-    ).all()
-    
-    for stock in low_stocks:
-        notify_low_stock(stock)
-    
-    return len(low_stocks)
+        Stock.quantity <= db.func.coalesce(Stock.min_stock, 0)
+    ).order_by(Stock.product_name).all()
 
 
-def check_and_notify_expiring():
-    """期限切れ間近チェックと通知（定期実行用）
+def check_and_notify_low_stock():
+    """在庫不足チェックと通知（定期実行用）
     
-    crontabで定期実行:
-        0 9 * * * cd /path/to/app && flask check-expiring
-    """
-    from datetime import timedelta
+    在庫アラートは通常、記録したときにバックグラウンドのスレッドで通知する（app.save_stock_alerts）。
+    その通知に失敗して未通知のまま残った StockAlert を読み、まだ下回っている商品を
+    宛先ごとに1通のダイジェストで通知する。
+    通知・送信待ちメールの登録とアラートの通知済みは同じトランザクションで
+    コミットするため、登録に失敗したアラートは次回の実行で通知される。
     
-    thirty_days_later = datetime.utcnow() + timedelta(days=30)
+    crontabで定期実行:
+        0 9 * * * cd /path/to/app && flask check-low-stock
     
-    expiring = Stock.query.filter(
-        Stock.deleted_at.is_(None),
-        Stock.expiry_date.isnot(None),
-        Stock.expiry_date <= thirty_days_later
-    ).all()
+    Returns:
+        int: 通知した商品の件数
+    """
+    now = datetime.utcnow()
+    # 複数プロセスで実行しても同じアラートを二重に通知しないよう、取得した行をロックする
+    alerts = StockAlert.query.filter(
+        StockAlert.notified_at.is_(None)
+    ).order_by(StockAlert.id).with_for_update(skip_locked=True).all()
+    
+    if not alerts:
+        db.session.commit()
+        return 0
+    
+    # 同じ商品のアラートは1件にまとめ、在庫が戻った（または削除された）商品は通知済みにするだけ
+    stocks = get_low_stocks({alert.stock_id for alert in alerts})
+    
+    if stocks:
+        notify_low_stock_digest(stocks, commit=False)
+    for alert in alerts:
+        alert.notified_at = now
+    db.session.commit()
     
-    for stock in expiring:
-        notify_expiring_soon(stock)
+    if stocks:
+        wake_mail_sender()
     
-    return len(expiring)
\ No newline at end of file
+    return len(stocks)
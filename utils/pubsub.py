@@ -0,0 +1,184 @@
+"""
+在庫管理システム - イベント配信
+utils/pubsub.py
+
+画面へのプッシュ更新（SSE）用の簡易 pub/sub。
+既定ではプロセス内の購読者にだけ配信し、複数ワーカー構成では Redis の pub/sub を経由して
+すべてのワーカーの購読者に届ける。
+
+イベントには配信時刻を ID として付け、直近のイベントを保持しておく（Redis 経由の場合は
+全ワーカーで共有する Redis のリストに保持する）。再接続した購読者には前回受け取った ID 以降の
+イベントを送り直す（保持範囲より前なら overflowed にして画面を読み直させる）。
+"""
+import json
+import queue
+import threading
+import time
+from collections import deque
+
+
+class Subscription:
+    """1つの購読（SSE の接続1本に対応）"""
+
+    def __init__(self, broker, channel, max_queue, last_id):
+        self.broker = broker
+        self.channel = channel
+        self.queue = queue.Queue(maxsize=max_queue)
+        # 読み出しが追いつかずイベントを取りこぼした場合に True（画面を読み直させる）
+        self.overflowed = False
+        # 最後に受け取ったイベントの ID（再接続時にこの続きから受け取る）
+        self.last_id = last_id
+
+    def put(self, event, event_id):
+        try:
+            self.queue.put_nowait((event_id, event))
+        except queue.Full:
+            self.overflowed = True
+
+    def get(self, timeout=None):
+        """次のイベント（timeout 秒以内に届かなければ None）"""
+        try:
+            event_id, event = self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        self.last_id = event_id
+        return event
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class LocalBroker:
+    """プロセス内の購読者にイベントを配信する
+
+    replay_overlap: 再接続時に送り直す範囲を前回の ID より何秒さかのぼるか。
+        ワーカー間で配信時刻の前後が入れ替わっても取りこぼさないためのもので、
+        イベントは出庫予定の最新の状態なので重複して届いても画面の結果は変わらない
+    """
+
+    def __init__(self, max_queue=100, replay_overlap=2):
+        self.max_queue = max_queue
+        self.replay_overlap = replay_overlap
+        self._subscriptions = {}
+        self._recent = {}
+        # チャンネルごとに、この時刻以降のイベントはすべて _recent に残っている
+        # （このプロセスで配信したイベントはすべて、作成後に _recent を通る）
+        self._complete_since = {}
+        self._lock = threading.Lock()
+
+    def publish(self, channel, event):
+        self.deliver(channel, event, time.time())
+
+    def deliver(self, channel, event, event_id):
+        with self._lock:
+            recent = self._recent.setdefault(channel, deque())
+            recent.append((event_id, event))
+            if len(recent) > self.max_queue:
+                self._complete_since[channel] = recent.popleft()[0]
+            subscriptions = list(self._subscriptions.get(channel, ()))
+        for subscription in subscriptions:
+            subscription.put(event, event_id)
+
+    def subscribe(self, channel, last_id=None):
+        """購読を開始する（last_id を指定すると、その続きのイベントを先に受け取る）"""
+        with self._lock:
+            subscription = Subscription(self, channel, self.max_queue, last_id or time.time())
+            if last_id is not None:
+                if last_id < self._complete_since.get(channel, 0):
+                    subscription.overflowed = True
+                else:
+                    since = last_id - self.replay_overlap
+                    for event_id, event in self._recent.get(channel, ()):
+                        if event_id > since:
+                            subscription.put(event, event_id)
+            self._subscriptions.setdefault(channel, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.channel)
+            if subscriptions:
+                subscriptions.discard(subscription)
+
+
+class RedisBroker(LocalBroker):
+    """Redis の pub/sub を経由して、全ワーカーの購読者にイベントを配信する
+
+    ワーカーごとに受信用のスレッドを1本だけ起動し、受け取ったイベントを
+    そのワーカー内の購読者へ配る。再接続時に送り直す直近のイベントは Redis のリストに
+    保持するため、前回と別のワーカーに再接続しても続きから受け取れる。
+    """
+
+    def __init__(self, url, prefix='inventory:', max_queue=100, replay_overlap=2, connect_timeout=2):
+        import redis
+
+        super().__init__(max_queue, replay_overlap)
+        self.prefix = prefix
+        self.connect_timeout = connect_timeout
+        self.client = redis.Redis.from_url(url)
+        self._listener = None
+        self._listening = threading.Event()
+
+    def publish(self, channel, event):
+        message = json.dumps({'id': time.time(), 'event': event}, ensure_ascii=False)
+        pipeline = self.client.pipeline()
+        pipeline.lpush(self.prefix + 'recent:' + channel, message)
+        pipeline.ltrim(self.prefix + 'recent:' + channel, 0, self.max_queue - 1)
+        pipeline.publish(self.prefix + channel, message)
+        pipeline.execute()
+
+    def subscribe(self, channel, last_id=None):
+        with self._lock:
+            if self._listener is None:
+                self._listener = threading.Thread(target=self._listen, daemon=True)
+                self._listener.start()
+        # 受信を始める前に配信されたイベントは届かないため、受信の開始を待つ
+        if not self._listening.wait(self.connect_timeout):
+            raise ConnectionError('Redis の購読を開始できませんでした')
+
+        with self._lock:
+            subscription = Subscription(self, channel, self.max_queue, last_id or time.time())
+            self._subscriptions.setdefault(channel, set()).add(subscription)
+        if last_id is not None:
+            # 購読の登録後に読むため、読み出し中に届いたイベントは重複して届くことがある（取りこぼしはない）
+            recent = [json.loads(message) for message in reversed(self.client.lrange(self.prefix + 'recent:' + channel, 0, -1))]
+            if len(recent) >= self.max_queue and recent[0]['id'] > last_id:
+                subscription.overflowed = True
+            else:
+                since = last_id - self.replay_overlap
+                for message in recent:
+                    if message['id'] > since:
+                        subscription.put(message['event'], message['id'])
+        return subscription
+
+    def deliver(self, channel, event, event_id):
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(channel, ()))
+        for subscription in subscriptions:
+            subscription.put(event, event_id)
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+                pubsub.psubscribe(self.prefix + '*')
+                self._listening.set()
+                for message in pubsub.listen():
+                    channel = message['channel'].decode()[len(self.prefix):]
+                    data = json.loads(message['data'])
+                    self.deliver(channel, data['event'], data['id'])
+            except Exception:
+                # 接続が切れていた間のイベントは届いていないため、購読中の画面は読み直させる
+                self._listening.clear()
+                with self._lock:
+                    subscriptions = [subscription for channel in self._subscriptions.values() for subscription in channel]
+                for subscription in subscriptions:
+                    subscription.overflowed = True
+                # 少し待って購読し直す
+                time.sleep(1)